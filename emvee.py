@@ -2,7 +2,33 @@ import sublime, sublime_plugin
 import threading
 import sys
 import difflib
+import bisect
+import re
+import collections
+import functools
+import itertools
 import datetime
+import array
+import os
+import json
+import time
+import hashlib
+import zlib
+import concurrent.futures
+import cProfile
+import pstats
+import io
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 3.3 plugin host.
+    tracemalloc = None
 
 LOG_LEVEL_ERROR = 1
 LOG_LEVEL_DEBUG = 0
@@ -36,7 +62,7 @@ INSERT_MODE = 'INSERT'
 SELECT_MODE = 'SELECT'
 all_modes = (NORMAL_MODE, INSERT_MODE, SELECT_MODE)
 
-def set_mode(view, new_mode, show_info=True):
+def set_mode(view, new_mode):
     old_mode = get_mode(view)
     debug_log(old_mode, "=>", new_mode)
     inverse_caret_state = None
@@ -56,8 +82,7 @@ def set_mode(view, new_mode, show_info=True):
     view.settings().set('command_mode', command_mode)
     view.settings().set('inverse_caret_state', inverse_caret_state)
     view.settings().set('emvee_mode', new_mode)
-    if show_info:
-        show_display_info(view, new_mode, context='New mode:', force=(LOG_LEVEL <= LOG_LEVEL_DEBUG))
+    StatusIndicator.schedule(view)
     return True
 
 def get_mode(view):
@@ -85,6 +110,8 @@ class Delay:
             debug_log('delay[{},{}] executing'.format(id, delay.id))
             callback()
             delay.done = True
+            if cls.delaysInFlight.get(id) is delay:
+                del cls.delaysInFlight[id]
 
         cls.delaysInFlight[id] = delay
         sublime.set_timeout(wrapped_callback, timeout_ms)
@@ -92,7 +119,7 @@ class Delay:
 
     @classmethod
     def cancel(cls, id):
-        prevDelay = cls.delaysInFlight.get(id, None)
+        prevDelay = cls.delaysInFlight.pop(id, None)
         if prevDelay and not prevDelay.done:
             debug_log('delay[{},{}] cancelling'.format(id, prevDelay.id))
             prevDelay.done = True
@@ -100,7 +127,7 @@ class Delay:
 
 def show_display_info(view, info, *, context, force=False, fg='var(--foreground)', bg='var(--background)'):
     # Disable for now.
-    if not force:
+    if not force or is_large_file(view):
         return
 
     htmlTemplate = '<body style="color: {fg}; background-color: {bg}; margin: 0; padding: 1rem;">{context}<div style="font-size: 3rem; font-weight: bold;">{info}</div> </body>'
@@ -151,6 +178,53 @@ def find_display_pos(view, *, force):
             result = last_line.begin()
     return result
 
+# Status updates within this many milliseconds are drawn once.
+STATUS_FRAME_MS = 16
+
+class StatusIndicator:
+    '''Mode, pending count and operator, and macro recording in the status bar.
+
+    Updates are coalesced per frame and the status is only set when what it
+    shows actually changed.'''
+    KEY = 'emvee'
+    shown = {}
+
+    @classmethod
+    def schedule(cls, view):
+        Delay.reset(('status', view.id()), STATUS_FRAME_MS, lambda: cls.update(view))
+
+    @classmethod
+    def update(cls, view):
+        if not view.is_valid():
+            return cls.discard(view)
+        state = get_state(view)
+        key = (get_mode(view), state.operator_amount, state.operator, state.amount, MacroRecorder.register)
+        if cls.shown.get(view.id()) == key:
+            return
+        cls.shown[view.id()] = key
+        mode, operator_amount, operator, amount, recording = key
+        if not mode:
+            view.erase_status(cls.KEY)
+            return
+        parts = [mode]
+        parts.extend(str(part) for part in (operator_amount, operator, amount) if part)
+        if recording:
+            parts.append('recording @{}'.format(recording))
+        view.set_status(cls.KEY, ' '.join(parts))
+
+    @classmethod
+    def discard(cls, view):
+        Delay.cancel(('status', view.id()))
+        cls.shown.pop(view.id(), None)
+
+    @classmethod
+    def clear(cls, view):
+        cls.discard(view)
+        view.erase_status(cls.KEY)
+
+# How long after the last modification the indexes of a view are rebuilt.
+INDEX_DELAY_MS = 500
+
 def get_default_mode(view):
     if view.settings().get('emvee_start_in_normal_mode', True):
         return NORMAL_MODE
@@ -164,37 +238,153 @@ def plugin_unloaded():
             # TODO: Is it enough to set the mode to INSERT? We are being unloaded
             # afterall so only resetting certain built-in variables might be enough.
             set_mode(view, INSERT_MODE)
+            StatusIndicator.clear(view)
+    Batch.shutdown()
+    settings = sublime.load_settings('Preferences.sublime-settings')
+    settings.clear_on_change('emvee_record_session')
+    settings.clear_on_change('emvee_layout')
 
 def plugin_loaded():
     for window in sublime.windows():
         for view in window.views():
+            if ViewFlags.is_active(view):
+                set_mode(view, get_default_mode(view))
+    settings = sublime.load_settings('Preferences.sublime-settings')
+    settings.add_on_change('emvee_record_session', SessionRecorder.update_enabled)
+    # Zooming changes the global font size.
+    settings.add_on_change('emvee_layout', LayoutMetrics.invalidate_all)
+    SessionRecorder.update_enabled()
+
+def clear_mode(view):
+    '''Undo what `set_mode` did to the settings of `view`.'''
+    settings = view.settings()
+    settings.set('command_mode', False)
+    settings.set('inverse_caret_state', False)
+    settings.erase('emvee_mode')
+    StatusIndicator.clear(view)
+
+class ViewFlags:
+    '''Whether Emvee handles a view at all: `emvee_enabled` is on and the
+    view is not a widget.
+
+    This is decided once per view and kept up to date by a settings callback,
+    so for disabled views and widgets every event costs one dict lookup.'''
+    active = {}
+
+    @classmethod
+    def is_active(cls, view):
+        active = cls.active.get(view.id())
+        if active is None:
+            active = cls.active[view.id()] = cls.compute(view)
+            view.settings().add_on_change('emvee_enabled', lambda: cls.update(view))
+        return active
+
+    @staticmethod
+    def compute(view):
+        settings = view.settings()
+        return bool(settings.get('emvee_enabled', True)) and not settings.get('is_widget', False)
+
+    @classmethod
+    def update(cls, view):
+        active = cls.compute(view)
+        if cls.active.get(view.id()) == active:
+            return
+        cls.active[view.id()] = active
+        if active:
             set_mode(view, get_default_mode(view))
+        else:
+            clear_mode(view)
+
+    @classmethod
+    def discard(cls, view):
+        if cls.active.pop(view.id(), None) is not None:
+            view.settings().clear_on_change('emvee_enabled')
 
 class EmveeEventListener(sublime_plugin.EventListener):
     def on_new(self, view):
-        set_mode(view, get_default_mode(view), show_info=False)
+        if ViewFlags.is_active(view):
+            set_mode(view, get_default_mode(view))
 
     def on_load(self, view):
-        set_mode(view, get_default_mode(view))
+        if not ViewFlags.is_active(view):
+            return
+        # A reverted view keeps the mode restored for it.
+        if view.id() not in PersistedState.applied:
+            set_mode(view, get_default_mode(view))
+        PersistedState.restore(view)
 
-    def on_query_context(self, view, key, operator, operand, match_all):
-        global current_state
+    def on_activated(self, view):
+        if not ViewFlags.is_active(view):
+            return
+        PersistedState.restore(view)
+        Indexer.schedule_all(view)
+        RelativeNumbers.schedule(view)
+
+    def on_deactivated(self, view):
+        if ViewFlags.is_active(view):
+            PersistedState.save(view)
+
+    def on_pre_close(self, view):
+        if ViewFlags.is_active(view):
+            PersistedState.save(view, closing=True)
 
-        is_enabled = view.settings().get('emvee_enabled', True)
-        if not is_enabled:
-            set_mode(view, None)
+    def on_modified(self, view):
+        if not ViewFlags.is_active(view):
             return
+        Folds.invalidate(view)
+        LayoutMetrics.invalidate(view)
+        # Rebuild once typing pauses rather than on the next keypress.
+        Delay.reset(('index', view.buffer_id()), INDEX_DELAY_MS, lambda: Indexer.schedule_all(view))
+        RelativeNumbers.schedule(view)
+
+    def on_selection_modified(self, view):
+        if ViewFlags.is_active(view):
+            RelativeNumbers.schedule(view)
+
+    def on_close(self, view):
+        ViewFlags.discard(view)
+        PersistedState.restored.discard(view.id())
+        PersistedState.applied.discard(view.id())
+        view_states.pop(view.id(), None)
+        buffer_id = BufferViews.detach(view)
+        if buffer_id is not None:
+            Delay.cancel(('index', buffer_id))
+            Indexer.discard(buffer_id)
+            SearchIndex.discard(buffer_id)
+            Caches.forget(buffer_id)
+        RelativeNumbers.discard(view)
+        StatusIndicator.discard(view)
+        WordBoundaries.discard(view)
+        Folds.invalidate(view)
+        LayoutMetrics.discard(view)
+
+    def on_text_command(self, view, command_name, args):
+        if ViewFlags.is_active(view):
+            LastChange.on_text_command(view, command_name, args)
+
+    def on_post_text_command(self, view, command_name, args):
+        if not ViewFlags.is_active(view):
+            return
+        if 'fold' in command_name:
+            Folds.invalidate(view)
+            LayoutMetrics.invalidate(view)
+        # Scrolling moves the visible region without touching the selection.
+        RelativeNumbers.schedule(view)
+
+    def on_query_context(self, view, key, operator, operand, match_all):
+        if not ViewFlags.is_active(view):
+            return None
+        if SessionRecorder.enabled:
+            SessionRecorder.queries.append((key, operator, operand))
 
         if key == 'emvee_display_current_mode':
             if view.is_popup_visible():
                 hide_display_info(view)
             else:
-                amount = current_state.amount or 1
+                amount = get_state(view).amount or 1
                 show_display_info(view, get_mode(view), force=True, context='Current mode [{}]'.format(amount))
             return False
 
-        hide_display_info(view)
-
         if key == 'emvee_current_mode':
             if operand:
                 allowedModes = [x for x in operand.split(',') if x]
@@ -205,1074 +395,3603 @@ class EmveeEventListener(sublime_plugin.EventListener):
             return True
 
         if key == 'emvee_clear_state':
-            current_state = EmveeState()
+            get_state(view).clear()
+            StatusIndicator.schedule(view)
             return True
 
         if key == 'emvee_early_out':
             return False
 
 class EmveeState:
+    '''Pending input of a view: the count prefix, an operator waiting for its
+    motion together with the count typed before it, and the register the next
+    operator or paste uses.'''
+    __slots__ = ('amount', 'operator', 'operator_amount', 'register')
+
     def __init__(self):
+        self.clear()
+
+    def clear(self):
         self.amount = None
+        self.operator = None
+        self.operator_amount = None
+        self.register = None
+
+view_states = {}
+
+def get_state(view):
+    state = view_states.get(view.id())
+    if state is None:
+        state = view_states[view.id()] = EmveeState()
+    return state
+
+def set_selection(view, selection):
+    view.sel().clear()
+    view.sel().add_all(selection)
+
+def merge_regions(regions):
+    '''Sort regions and merge the ones that overlap.'''
+    result = []
+    for region in sorted(regions, key=sublime.Region.begin):
+        if result and region.begin() <= result[-1].end():
+            result[-1] = sublime.Region(result[-1].begin(), max(result[-1].end(), region.end()))
+        else:
+            result.append(sublime.Region(region.begin(), region.end()))
+    return result
 
-current_state = EmveeState()
+emvee_actions = {}
+
+def emvee_action(name):
+    '''Register the decorated EmveeAction class under `name`.'''
+    def decorator(cls):
+        cls.name = name
+        emvee_actions[name] = cls
+        return cls
+    return decorator
+
+def make_action(name, amount, kwargs):
+    '''Look up and construct the action `name`. Returns None on failure.
+
+    Construction parses and validates all arguments, so the result can be run
+    any number of times without going through the lookup again.'''
+    if not name:
+        err('missing "action" parameter')
+        return None
+
+    action_class = emvee_actions.get(name)
+    if not action_class:
+        err('No such emvee action:', name)
+        name_match_threshold = 0.6
+        matches = []
+        for other_name in emvee_actions:
+            if difflib.SequenceMatcher(None, name, other_name).ratio() > name_match_threshold:
+                matches.append(other_name)
+        if matches:
+            err('Did you mean:', '\n  '.join(matches))
+        return None
+
+    try:
+        return action_class(amount, **kwargs)
+    except (TypeError, ValueError) as e:
+        err('Invalid arguments for', name, kwargs, e)
+        return None
 
 class EmveeCommand(sublime_plugin.TextCommand):
     def run(self, edit, *, action, **kwargs):
-        global current_state
+        if SessionRecorder.enabled:
+            start = time.perf_counter()
+            self.run_action(edit, action, kwargs)
+            SessionRecorder.record(self.view, action, kwargs, time.perf_counter() - start)
+        else:
+            self.run_action(edit, action, kwargs)
 
+    def run_action(self, edit, action, kwargs):
         view = self.view
-        amount = current_state.amount or 1
-        if amount < 1:
-            amount = 1
-
-        all_actions = set()
-        def wants_action(name):
-            all_actions.add(name)
-            if name != action:
-                    return False
-            debug_log('action:', action)
-            return True
-
-        def consume_amount():
-            current_state.amount = None
+        state = get_state(view)
+        amount = state.amount
+        if state.operator and state.operator_amount:
+            amount = state.operator_amount * (amount or 1)
+        emvee_action = make_action(action, amount, kwargs)
+        if not emvee_action:
+            return
 
-        if wants_action('enter_normal_mode'):
-            consume_amount()
-            # ExitInsertMode(current_state.amount, **kwargs).run(self, edit)
-            selection = []
-            for region in view.sel():
+        debug_log('action:', action)
+        if state.operator:
+            if isinstance(emvee_action, SetOperator) and emvee_action.operator == state.operator:
+                # `dd`, `cc` and `yy` work on whole lines.
+                emvee_action = ApplyOperator(state.operator, state.register, CurrentLines(amount))
+            elif emvee_action.is_motion:
+                emvee_action = ApplyOperator(state.operator, state.register, emvee_action)
+            if emvee_action.consumes_amount:
+                state.operator = state.operator_amount = state.register = None
+        if emvee_action.consumes_amount:
+            state.amount = None
+        if emvee_action.recordable:
+            MacroRecorder.record(emvee_action)
+        if emvee_action.is_change:
+            LastChange.capture(view, emvee_action, action, kwargs)
+        elif emvee_action.consumes_amount:
+            LastChange.stop_typing()
+        emvee_action.run(view, edit)
+        StatusIndicator.schedule(view)
+
+class EmveeAction:
+    '''Base class for emvee actions.
+
+    An action is constructed from the count prefix and the arguments of the
+    key binding and can then be run any number of times.'''
+    name = None
+    # Whether running this action clears the count prefix.
+    consumes_amount = True
+    # Whether this action is captured by the macro recorder.
+    recordable = True
+    # Whether this action changes the buffer and can be repeated with `repeat_change`.
+    is_change = False
+    # Whether a pending operator applies to this action (see `motion_ranges`).
+    is_motion = False
+    # Whether the ranges of this motion are whole lines.
+    linewise = False
+    # Whether `plan` computes the edits of this action (see Batch).
+    plannable = False
+
+    def __init__(self, amount):
+        # The count prefix as given, None if there was none.
+        self.count = amount
+        self.amount = max(amount or 1, 1)
+
+    def run(self, view, edit):
+        raise NotImplementedError()
+
+    def plan(self, text, selection, separators):
+        '''The edits this action makes to a buffer containing `text`, with
+        the selection given as (a, b) pairs and `separators` as the
+        `word_separators` setting of the view. Returns (begin, end,
+        replacement) triples in buffer order. Called from worker threads, so it
+        must not touch the view or any shared state.'''
+        raise NotImplementedError()
+
+    def motion_ranges(self, view, edit, selection):
+        '''The ranges a pending operator works on, one for each region of
+        `selection`. By default that is from each caret to where the motion
+        moves it.'''
+        self.run(view, edit)
+        targets = list(view.sel())
+        if len(targets) != len(selection):
+            # Carets were merged by the motion.
+            return targets
+        return [sublime.Region(old.b, new.b) for old, new in zip(selection, targets)]
+
+class SelectionAction(EmveeAction):
+    '''An action that does nothing but transform the selection.
+
+    `transform` maps a list of regions to a new list of regions without
+    touching `view.sel()`, so consecutive selection actions can be chained in
+    Python with a single selection update at the end (see `run_plan`).'''
+    def transform(self, view, selection):
+        raise NotImplementedError()
+
+    def run(self, view, edit):
+        set_selection(view, self.transform(view, list(view.sel())))
+
+    def motion_ranges(self, view, edit, selection):
+        targets = self.transform(view, [sublime.Region(region.a, region.b) for region in selection])
+        return [sublime.Region(old.b, new.b) for old, new in zip(selection, targets)]
+
+@emvee_action('enter_normal_mode')
+class EnterNormalMode(SelectionAction):
+    def transform(self, view, selection):
+        if CaretArrays.wanted(selection):
+            carets = CaretArrays(selection)
+            carets.collapse()
+            selection = carets.regions()
+        else:
+            for region in selection:
                 region.a = region.b
-                selection.append(region)
-            view.sel().clear()
-            view.sel().add_all(selection)
-            set_mode(view, NORMAL_MODE)
-
-        elif wants_action('enter_insert_mode'):
-            consume_amount()
-            # EnterInsertMode(current_state.amount, **kwargs).run(self, edit)
-            location = kwargs.get('location', 'current')
-            append = bool(kwargs.get('append', False))
-            if location == 'current':
-                if append:
-                    selection = []
-                    for region in view.sel():
-                        isExtended = region.size() > 0
-                        if not (view.classify(region.b) & sublime.CLASS_LINE_END):
-                            region.b += 1
-                        if not isExtended:
-                            region.a = region.b
-                        selection.append(region)
-                    view.sel().clear();
-                    view.sel().add_all(selection);
-                else:
-                    pass # Stay where we are and enter insert mode.
-            elif location == 'line_limit':
-                if append:
-                    view.run_command('move_to', { 'to': 'hardeol', 'extend': False })
-                else:
-                    view.run_command('move_to', { 'to': 'hardbol', 'extend': False })
-            set_mode(view, INSERT_MODE)
+        set_mode(view, NORMAL_MODE)
+        return selection
+
+@emvee_action('enter_insert_mode')
+class EnterInsertMode(SelectionAction):
+    def __init__(self, amount, *, location='current', append=False):
+        '''location: current, line_limit'''
+        super().__init__(amount)
+        supported_locations = ('current', 'line_limit')
+        if location not in supported_locations:
+            raise ValueError('Don\'t know "{}". Supported arguments for "location": {}'.format(location, supported_locations))
+        self.location = location
+        self.append = bool(append)
+
+    def transform(self, view, selection):
+        index = Indexer.get(view, 'lines') if CaretArrays.wanted(selection) else None
+        if index:
+            selection = self.transform_arrays(view, index, CaretArrays(selection))
+        elif self.location == 'current':
+            if self.append:
+                for region in selection:
+                    isExtended = region.size() > 0
+                    if not (view.classify(region.b) & sublime.CLASS_LINE_END):
+                        region.b += 1
+                    if not isExtended:
+                        region.a = region.b
+            else:
+                pass # Stay where we are and enter insert mode.
+        elif self.location == 'line_limit':
+            for region in selection:
+                line = view.line(region.b)
+                region.b = line.b if self.append else line.a
+                region.a = region.b
+        set_mode(view, INSERT_MODE)
+        return selection
+
+    def transform_arrays(self, view, index, carets):
+        if self.location == 'current' and not self.append:
+            return carets.regions()
+        begins, ends = CaretArrays.line_bounds(index, view.size(), carets.b)
+        if self.location == 'line_limit':
+            carets.b = ends if self.append else begins
+            carets.collapse()
+        elif numpy:
+            is_empty = carets.a == carets.b
+            carets.move(carets.b != ends)
+            carets.collapse(is_empty)
+        else:
+            is_empty = [a == b for a, b in zip(carets.a, carets.b)]
+            carets.move([int(b != end) for b, end in zip(carets.b, ends)])
+            carets.collapse(is_empty)
+        return carets.regions()
+
+@emvee_action('push_digit')
+class PushDigit(EmveeAction):
+    consumes_amount = False
+    recordable = False
+
+    def __init__(self, amount, *, digit=1):
+        super().__init__(amount)
+        self.digit = int(digit)
+
+    def run(self, view, edit):
+        state = get_state(view)
+        try:
+            new_amount = int(state.amount) * 10 + self.digit
+        except:
+            new_amount = self.digit
+        if new_amount > 9999:
+            new_amount = 9999 # TODO: What should this limit be?
+        state.amount = new_amount
+
+@emvee_action('flatten_selections')
+class FlattenSelections(SelectionAction):
+    def transform(self, view, selection):
+        for reg in selection:
+            if reg.a < reg.b and get_mode(view) == NORMAL_MODE:
+                reg.b -= 1
+            reg.a = reg.b
+        return selection
+
+@emvee_action('flip_cursors_within_selections')
+class FlipCursorsWithinSelections(SelectionAction):
+    def transform(self, view, selection):
+        for reg in selection:
+            reg.a, reg.b = reg.b, reg.a
+        return selection
+
+@emvee_action('swap_cursor_with_anchor')
+class SwapCursorWithAnchor(SelectionAction):
+    def __init__(self, amount, *, side='toggle'):
+        super().__init__(amount)
+        supported_sides = ('toggle', 'begin', 'end')
+        if side not in supported_sides:
+            raise ValueError('Don\'t know "{}". Supported arguments for "side": {}'.format(side, supported_sides))
+        self.side = side
+
+    def transform(self, view, selection):
+        if self.side == 'toggle':
+            return [sublime.Region(reg.b, reg.a) for reg in selection]
+        if self.side == 'begin':
+            return [sublime.Region(reg.end(), reg.begin()) for reg in selection]
+        return [sublime.Region(reg.begin(), reg.end()) for reg in selection]
+
+@emvee_action('move_by_char')
+class MoveByChar(SelectionAction):
+    is_motion = True
+
+    def __init__(self, amount, *, forward=True, stay_in_line=False, extend=False):
+        super().__init__(amount)
+        self.forward = bool(forward)
+        self.stay_in_line = bool(stay_in_line)
+
+    def transform(self, view, selection):
+        extend = get_mode(view) == SELECT_MODE
+        advance = self.amount if self.forward else -self.amount
+        if CaretArrays.wanted(selection):
+            index = Indexer.get(view, 'lines') if self.stay_in_line else None
+            if index or not self.stay_in_line:
+                carets = CaretArrays(selection)
+                if self.stay_in_line:
+                    lines = CaretArrays.line_bounds(index, view.size(), carets.ends())
+                carets.move(advance)
+                if self.stay_in_line:
+                    carets.clamp(*lines)
+                if not extend:
+                    carets.collapse()
+                return carets.regions()
+        for region in selection:
+            line = view.line(region.end())
+            region.b += advance
+            if self.stay_in_line:
+                if region.b < line.a:
+                    region.b = line.a
+                if region.b > line.b:
+                    region.b = line.b
+            if not extend:
+                region.a = region.b
+        return selection
+
+@emvee_action('move_by_line')
+class MoveByLine(SelectionAction):
+    '''Moves `count` lines down or up. A fold counts as a single line.
+
+    Carets keep their horizontal layout position (`xpos`) like the built-in
+    `move` command.'''
+    is_motion = True
+    linewise = True
+
+    def __init__(self, amount, *, forward=True, extend=False):
+        super().__init__(amount)
+        self.forward = bool(forward)
+
+    def transform(self, view, selection):
+        folds = Folds.get(view)
+        extend = get_mode(view) == SELECT_MODE
+        delta = self.amount if self.forward else -self.amount
+        last_display_row = folds.display_row(view.rowcol(view.size())[0])
+        result = []
+        for region in selection:
+            display_row = folds.display_row(view.rowcol(region.b)[0]) + delta
+            row = folds.buffer_row(min(max(display_row, 0), last_display_row))
+            line = view.line(view.text_point(row, 0))
+            x = region.xpos if region.xpos >= 0 else view.text_to_layout(region.b)[0]
+            point = view.layout_to_text((x, view.text_to_layout(line.a)[1]))
+            point = min(max(point, line.a), line.b, folds.visible_end(row, line.b))
+            result.append(sublime.Region(region.a if extend else point, point, x))
+        return result
+
+    def run(self, view, edit):
+        super().run(view, edit)
+        view.show(view.sel()[-1])
+
+    def motion_ranges(self, view, edit, selection):
+        # Operators work on whole lines with this motion.
+        result = []
+        for region in super().motion_ranges(view, edit, selection):
+            result.append(sublime.Region(view.line(region.begin()).a, view.full_line(region.end()).b))
+        return result
+
+class WordMove(SelectionAction):
+    '''Moves to the `count`th word boundary found by `find_word_boundary`.'''
+    is_motion = True
+    subwords = False
+    ends = False
+
+    def __init__(self, amount, *, forward=True, extend=False):
+        super().__init__(amount)
+        self.forward = bool(forward)
+
+    def transform(self, view, selection):
+        regex = WordBoundaries.get(view, self.subwords)
+        extend = get_mode(view) == SELECT_MODE
+        for region in selection:
+            region.b = find_word_boundary(view, regex, region.b, self.forward, self.ends, self.amount)
+            if not extend:
+                region.a = region.b
+        return selection
+
+    def run(self, view, edit):
+        super().run(view, edit)
+        view.show(view.sel()[-1])
+
+@emvee_action('move_by_word_begin')
+class MoveByWordBegin(WordMove):
+    pass
+
+@emvee_action('move_by_word_end')
+class MoveByWordEnd(WordMove):
+    ends = True
+
+@emvee_action('move_by_subword_begin')
+class MoveBySubwordBegin(WordMove):
+    subwords = True
+
+@emvee_action('move_by_subword_end')
+class MoveBySubwordEnd(WordMove):
+    subwords = True
+    ends = True
+
+@emvee_action('move_to_line_limit')
+class MoveToLineLimit(EmveeAction):
+    is_motion = True
+
+    def __init__(self, amount, *, forward=True, extend=False):
+        super().__init__(amount)
+        self.forward = bool(forward)
+
+    def run(self, view, edit):
+        args = {
+            'extend': get_mode(view) == SELECT_MODE,
+            'to': 'eol' if self.forward else 'bol'
+        }
+        for _ in range(self.amount):
+            view.run_command('move_to', args)
+
+@emvee_action('move_by_display_line')
+class MoveByDisplayLine(SelectionAction):
+    '''Moves `count` display lines down or up, so wrapped lines are moved
+    through row by row. Carets keep their `xpos` like with `move_by_line`.'''
+    is_motion = True
+
+    def __init__(self, amount, *, forward=True, extend=False):
+        super().__init__(amount)
+        self.forward = bool(forward)
+
+    def transform(self, view, selection):
+        metrics = LayoutMetrics.get(view)
+        delta = (self.amount if self.forward else -self.amount) * metrics.line_height
+        return metrics.move_carets(view, selection, delta, get_mode(view) == SELECT_MODE)
+
+    def run(self, view, edit):
+        super().run(view, edit)
+        view.show(view.sel()[-1])
+
+@emvee_action('move_to_display_line_limit')
+class MoveToDisplayLineLimit(SelectionAction):
+    '''Moves to the beginning or end of the display line. Moving to the end
+    goes `count` - 1 display lines down first.'''
+    is_motion = True
+
+    def __init__(self, amount, *, forward=True, extend=False):
+        super().__init__(amount)
+        self.forward = bool(forward)
+
+    def transform(self, view, selection):
+        metrics = LayoutMetrics.get(view)
+        extend = get_mode(view) == SELECT_MODE
+        for region in selection:
+            y = view.text_to_layout(region.b)[1]
+            if self.forward:
+                y += (self.amount - 1) * metrics.line_height
+                point = metrics.display_point(view, metrics.layout_extent[0], y)
+                # Past the end of a wrapped row is the start of the next one.
+                wrapped = view.text_to_layout(point)[1] > y + metrics.line_height / 2
+                if wrapped and not view.classify(point) & sublime.CLASS_LINE_START:
+                    point -= 1
+            else:
+                point = metrics.display_point(view, 0.0, y)
+            region.b = point
+            if not extend:
+                region.a = region.b
+        return selection
 
-        elif wants_action('push_digit'):
-            # PushDigit(current_state.amount, **kwargs).run(self, edit)
-            digit = int(kwargs.get('digit', 1))
+    def run(self, view, edit):
+        super().run(view, edit)
+        view.show(view.sel()[-1])
 
-            try:
-                new_amount = int(current_state.amount) * 10 + digit
-            except:
-                new_amount = digit
-            if new_amount > 9999:
-                new_amount = 9999 # TODO: What should this limit be?
-            current_state.amount = new_amount
-            show_display_info(view, str(new_amount), force=True, context='Prefix:')
-
-        elif wants_action('flatten_selections'):
-            consume_amount()
-            FlattenSelections(current_state.amount, **kwargs).run(self, edit)
-
-        elif wants_action('flip_cursors_within_selections'):
-            consume_amount()
-            FlipCursorsWithinSelections(current_state.amount, **kwargs).run(self, edit)
-
-        elif wants_action('move_by_char'):
-            consume_amount()
-            # MoveByChar(current_state.amount, **kwargs).run(self, edit)
-            forward = bool(kwargs.get('forward', True))
-            extend = get_mode(view) == SELECT_MODE # bool(kwargs.get('extend', False))
-            stay_in_line = bool(kwargs.get('stay_in_line', False))
-            advance = amount if forward else -amount
-            selection = []
-            for region in view.sel():
-                line = view.lines(region)[-1]
-                region.b += advance
-                if stay_in_line:
-                    if region.b < line.a:
-                        region.b = line.a
-                    if region.b > line.b:
-                        region.b = line.b
+@emvee_action('move_by_empty_line')
+class MoveByEmptyLine(SelectionAction):
+    is_motion = True
+
+    def __init__(self, amount, *, forward=True, select=False, ignore_whitespace=True):
+        super().__init__(amount)
+        self.forward = bool(forward)
+        self.select = bool(select)
+        self.ignore_whitespace = bool(ignore_whitespace)
+
+    def transform(self, view, selection):
+        if self.select and get_mode(view) != SELECT_MODE:
+            set_mode(view, SELECT_MODE)
+
+        extend = get_mode(view) == SELECT_MODE
+
+        if self.ignore_whitespace:
+            # search for empty or "white" lines.
+            folds = Folds.get(view)
+            for region in selection:
+                region.b = find_visible_empty_line(view, folds, region.b, self.forward, self.amount)
+                if not extend:
+                    region.a = region.b
+        else:
+            # Use built-in find_by_class
+            for region in selection:
+                region.b = view.find_by_class(region.b, self.forward, sublime.CLASS_EMPTY_LINE)
                 if not extend:
                     region.a = region.b
-                selection.append(region)
-            view.sel().clear();
-            view.sel().add_all(selection);
-
-        elif wants_action('move_by_line'):
-            consume_amount()
-            # MoveByLine(current_state.amount, **kwargs).run(self, edit)
-            forward = bool(kwargs.get('forward', True))
-            extend = get_mode(view) == SELECT_MODE # bool(kwargs.get('extend', False))
-            args = {
-                'forward': forward,
-                'extend': extend,
-                'by': 'lines'
-            }
-            for _ in range(amount):
-                view.run_command('move', args)
-
-        elif wants_action('move_by_word_begin'):
-            consume_amount()
-            # MoveByWordBegin(current_state.amount, **kwargs).run(self, edit)
-            forward = bool(kwargs.get('forward', True))
-            extend = get_mode(view) == SELECT_MODE # bool(kwargs.get('extend', False))
-            args = {
-                'forward': forward,
-                'extend': extend,
-                'by': 'words'
-            }
-            for _ in range(amount):
-                view.run_command('move', args)
-
-        elif wants_action('move_by_word_end'):
-            consume_amount()
-            # MoveByWordEnd(current_state.amount, **kwargs).run(self, edit)
-            forward = bool(kwargs.get('forward', True))
-            extend = get_mode(view) == SELECT_MODE # bool(kwargs.get('extend', False))
-            args = {
-                'forward': forward,
-                'extend': extend,
-                'by': 'word_ends'
-            }
-            for _ in range(amount):
-                view.run_command('move', args)
-
-        elif wants_action('move_by_subword_begin'):
-            consume_amount()
-            # MoveBySubwordBegin(current_state.amount, **kwargs).run(self, edit)
-            forward = bool(kwargs.get('forward', True))
-            extend = get_mode(view) == SELECT_MODE # bool(kwargs.get('extend', False))
-            args = {
-                'forward': forward,
-                'extend': extend,
-                'by': 'subwords'
-            }
-            for _ in range(amount):
-                view.run_command('move', args)
-
-        elif wants_action('move_by_subword_end'):
-            consume_amount()
-            # MoveBySubwordEnd(current_state.amount, **kwargs).run(self, edit)
-            forward = bool(kwargs.get('forward', True))
-            extend = get_mode(view) == SELECT_MODE # bool(kwargs.get('extend', False))
-            args = {
-                'forward': forward,
-                'extend': extend,
-                'by': 'subword_ends'
-            }
-
-            for _ in range(amount):
-                view.run_command('move', args)
-
-        elif wants_action('move_to_line_limit'):
-            consume_amount()
-            # MoveToLineLimit(current_state.amount, **kwargs).run(self, edit)
-            forward = bool(kwargs.get('forward', True))
-            extend = get_mode(view) == SELECT_MODE # bool(kwargs.get('extend', False))
-            args = {
-                'extend': extend,
-                'to': 'eol' if forward else 'bol'
-            }
-            for _ in range(amount):
-                view.run_command('move_to', args)
-
-        elif wants_action('move_by_empty_line'):
-            consume_amount()
-            # MoveByEmptyLine(current_state.amount, **kwargs).run(self, edit)
-            forward = bool(kwargs.get('forward', True))
-            select = bool(kwargs.get('select', False))
-            if select and get_mode(view) != SELECT_MODE:
-                set_mode(view, SELECT_MODE)
-
-            extend = get_mode(view) == SELECT_MODE
-            ignore_whitespace = bool(kwargs.get('ignore_whitespace', True))
-
-            selection = []
-            if ignore_whitespace:
-                # search for empty or "white" lines.
-                increment = amount if forward else -amount
-                for region in view.sel():
-                    row, col = view.rowcol(region.b)
-                    col = 0
-                    search_point = view.text_point(row, col)
-                    found_non_empty_line = False
-                    while True:
-                        line_region = view.line(search_point)
-                        line = view.substr(line_region)
-                        line_is_empty = len(line.strip()) == 0
-                        if line_is_empty:
-                            if found_non_empty_line:
-                                break
-                        else:
-                            found_non_empty_line = True
-                        old_search_point = search_point
-                        search_point = next_line_point(view, search_point, increment=increment)
-                        if search_point == old_search_point:
-                            break
-
-                    region.b = search_point
-                    if not extend:
-                        region.a = region.b
 
-                    selection.append(region)
+        return selection
+
+    def run(self, view, edit):
+        super().run(view, edit)
+        view.show(view.sel(), True)
+
+@emvee_action('scroll')
+class Scroll(EmveeAction):
+    def __init__(self, amount, *, lines=0, delta_screens_x=0, delta_screens_y=0, center_cursor=False):
+        super().__init__(amount)
+        self.lines = float(lines)
+        self.screens_x = float(delta_screens_x)
+        self.screens_y = float(delta_screens_y)
+        self.center_cursor = bool(center_cursor)
+
+    def run(self, view, edit):
+        lines = self.lines
+        screens_x = self.screens_x
+        screens_y = self.screens_y
+
+        debug_log('screens_y', screens_y)
+
+        if screens_y:
+            metrics = LayoutMetrics.get(view)
+            lines += screens_y * metrics.viewport_extent[1] / metrics.line_height
+
+        if lines:
+            view.run_command('scroll_lines', { 'amount': lines })
+
+        if screens_x:
+            position = view.viewport_position()
+            metrics = LayoutMetrics.get(view)
+            extent = metrics.viewport_extent
+            maxExtent = metrics.layout_extent
+            max_x = maxExtent[0] - extent[0]
+            if max_x > 0:
+                offset_x = screens_x * extent[0]
+                new_x = position[0] + offset_x
+                new_x = max(0, min(new_x, max_x))
+                new_position = (new_x, position[1])
+                view.set_viewport_position(new_position)
+
+        if self.center_cursor:
+            selection = view.sel()
+            if len(selection) > 1:
+                view.show(view.sel(), True)
+            else:
+                extent = view.show_at_center(selection[0])
+
+@emvee_action('move_by_page')
+class MoveByPage(SelectionAction):
+    '''Scrolls `count` times `pages` viewport heights down or up and moves
+    every caret by the same number of display rows.'''
+    def __init__(self, amount, *, forward=True, pages=1.0):
+        super().__init__(amount)
+        self.forward = bool(forward)
+        self.pages = float(pages)
+
+    def delta(self, metrics):
+        rows = max(int(metrics.viewport_extent[1] / metrics.line_height * self.pages), 1) * self.amount
+        return (rows if self.forward else -rows) * metrics.line_height
+
+    def transform(self, view, selection):
+        metrics = LayoutMetrics.get(view)
+        return metrics.move_carets(view, selection, self.delta(metrics), get_mode(view) == SELECT_MODE)
+
+    def run(self, view, edit):
+        metrics = LayoutMetrics.get(view)
+        delta = self.delta(metrics)
+        set_selection(view, metrics.move_carets(view, list(view.sel()), delta, get_mode(view) == SELECT_MODE))
+        x, y = view.viewport_position()
+        bottom = max(metrics.layout_extent[1] - metrics.viewport_extent[1], 0.0)
+        view.set_viewport_position((x, min(max(y + delta, 0.0), bottom)))
+
+@emvee_action('select')
+class Select(SelectionAction):
+    def __init__(self, amount, *, mode='char', complete_partial_lines=False, full_line=True):
+        super().__init__(amount)
+        self.mode = mode
+        self.complete_partial_lines = bool(complete_partial_lines)
+        self.full_line = bool(full_line)
+
+    def transform(self, view, selection):
+        extend = True # bool(kwargs.get('extend', False))
+        getter = view.full_line if self.full_line else view.line
+
+        index = Indexer.get(view, 'lines') if self.mode == 'line' and CaretArrays.wanted(selection) else None
+        if index:
+            selection = self.select_lines_arrays(view, index, CaretArrays(selection))
+        elif self.mode == 'line':
+            complete_partial_lines = True
+            if complete_partial_lines:
+                for reg in selection:
+                    is_cursor_in_front = reg.a <= reg.b
+                    line_a = getter(reg.a)
+                    line_b = getter(reg.b)
+                    reg.a = min(line_a.a, line_b.a)
+                    reg.b = max(line_a.b, line_b.b)
+                    if not is_cursor_in_front:
+                        reg.a, reg.b = reg.b, reg.a
             else:
-                # Use built-in find_by_class
-                for region in view.sel():
-                    region.b = view.find_by_class(region.b, forward, sublime.CLASS_EMPTY_LINE)
+                for reg in selection:
+                    line = getter(reg.b)
+                    reg.b = line.b
                     if not extend:
-                        region.a = region.b
-                    selection.append(region)
+                        reg.a = line.a
+
+        if get_mode(view) != SELECT_MODE:
+            set_mode(view, SELECT_MODE)
+        return selection
+
+    def select_lines_arrays(self, view, index, carets):
+        size = view.size()
+        begins_a, ends_a = CaretArrays.line_bounds(index, size, carets.a, self.full_line)
+        begins_b, ends_b = CaretArrays.line_bounds(index, size, carets.b, self.full_line)
+        if numpy:
+            is_cursor_in_front = carets.a <= carets.b
+            begins = numpy.minimum(begins_a, begins_b)
+            ends = numpy.maximum(ends_a, ends_b)
+            carets.a = numpy.where(is_cursor_in_front, begins, ends)
+            carets.b = numpy.where(is_cursor_in_front, ends, begins)
+        else:
+            begins = array.array('q', map(min, begins_a, begins_b))
+            ends = array.array('q', map(max, ends_a, ends_b))
+            is_cursor_in_front = [a <= b for a, b in zip(carets.a, carets.b)]
+            carets.a = array.array('q', (begin if front else end for begin, end, front in zip(begins, ends, is_cursor_in_front)))
+            carets.b = array.array('q', (end if front else begin for begin, end, front in zip(begins, ends, is_cursor_in_front)))
+        return carets.regions()
+
+    def run(self, view, edit):
+        super().run(view, edit)
+        if self.mode == 'line' and len(view.sel()) == 1:
+            view.show(view.sel()[0], False)
+
+@emvee_action('split_selection')
+class SplitSelection(EmveeAction):
+    def __init__(self, amount, *, forward=True):
+        super().__init__(amount)
+        self.forward = bool(forward)
+
+    def run(self, view, edit):
+        view.run_command('split_selection_by_pattern')
+
+@emvee_action('swap_lines')
+class SwapLines(EmveeAction):
+    '''Move the lines of all selections down (or up) by `count` lines as a
+    single edit. Lines in between keep their order.'''
+    is_change = True
+
+    def __init__(self, amount, *, forward=True):
+        super().__init__(amount)
+        self.forward = bool(forward)
+
+    def run(self, view, edit):
+        selection = list(view.sel())
+        last_line = view.rowcol(view.size())[0]
+        if last_line and view.substr(view.size() - 1) == '\n':
+            # The empty line after a final newline is not a line of its own.
+            last_line -= 1
+        blocks = []
+        for region in selection:
+            first = view.rowcol(region.begin())[0]
+            if first > last_line:
+                continue
+            last_row, last_col = view.rowcol(region.end())
+            if last_col == 0 and last_row > first:
+                last_row -= 1
+            if blocks and first <= blocks[-1][1] + 1:
+                blocks[-1][1] = max(blocks[-1][1], last_row)
+            else:
+                blocks.append([first, last_row])
 
-            view.sel().clear()
-            view.sel().add_all(selection)
-            view.show(view.sel(), True)
-
-        elif wants_action('scroll'):
-            consume_amount()
-            # Scroll(current_state.amount, **kwargs).run(self, edit)
-            # return
-            lines = float(kwargs.get('lines', 0))
-            screens_x = float(kwargs.get('delta_screens_x', 0))
-            screens_y = float(kwargs.get('delta_screens_y', 0))
-            center_cursor = bool(kwargs.get('center_cursor', False))
-
-            debug_log('screens_y', screens_y)
-
-            if screens_y:
-                extent = view.viewport_extent()
-                lines_per_screen = extent[1] / view.line_height()
-                lines += screens_y * lines_per_screen
-
-            if lines:
-                view.run_command('scroll_lines', { 'amount': lines })
-
-            if screens_x:
-                position = view.viewport_position()
-                extent = view.viewport_extent()
-                maxExtent = view.layout_extent()
-                max_x = maxExtent[0] - extent[0]
-                if max_x > 0:
-                    offset_x = screens_x * extent[0]
-                    new_x = position[0] + offset_x
-                    new_x = max(0, min(new_x, max_x))
-                    new_position = (new_x, position[1])
-                    view.set_viewport_position(new_position)
-
-            if center_cursor:
-                selection = view.sel()
-                if len(selection) > 1:
-                    view.show(view.sel(), True)
-                else:
-                    extent = view.show_at_center(selection[0])
-
-        elif wants_action('select'):
-            consume_amount()
-            # ExpandSelectionToLine(current_state.amount, **kwargs).run(self, edit)
-            extend = True # bool(kwargs.get('extend', False))
-            mode = kwargs.get('mode', 'char')
-            complete_partial_lines = bool(kwargs.get('complete_partial_lines', False))
-            full_line = bool(kwargs.get('full_line', True))
-            getter = view.full_line if full_line else view.line
-            selection = []
-
-            if mode == 'line':
-                complete_partial_lines = True
-                if complete_partial_lines:
-                    for reg in view.sel():
-                        is_cursor_in_front = reg.a <= reg.b
-                        line_a = getter(reg.a)
-                        line_b = getter(reg.b)
-                        reg.a = min(line_a.a, line_b.a)
-                        reg.b = max(line_a.b, line_b.b)
-                        if not is_cursor_in_front:
-                            reg.a, reg.b = reg.b, reg.a
-                        selection.append(reg)
-                else:
-                    for reg in view.sel():
-                        line = getter(reg.b)
-                        reg.b = line.b
-                        if not extend:
-                            reg.a = line.a
-                        selection.append(reg)
-
-                view.sel().clear()
-                view.sel().add_all(selection)
-
-                if len(selection) == 1:
-                    view.show(selection[0], False)
-
-            if get_mode(view) != SELECT_MODE:
-                set_mode(view, SELECT_MODE)
-
-        elif wants_action('split_selection'):
-            consume_amount()
-            # SplitSelection(current_state.amount, **kwargs).run(self, edit)
-            view.run_command('split_selection_by_pattern')
-
-        elif wants_action('delete_to_eol') or wants_action('delete_line'):
-            consume_amount()
-            delete_full_line = action == 'delete_line'
-            selection = []
-            for region in view.sel():
-                prev_line = None
-                remaining = amount
-                while remaining > 0:
-                    line_region = view.full_line(region.b) if remaining > 1 else view.line(region.b)
-                    region.b = line_region.b
-                    if delete_full_line and region.a > line_region.a:
-                        region.a = line_region.a
-                    remaining -= 1
-                selection.append(region)
-            view.sel().clear()
-            view.sel().add_all(selection)
+        if not blocks:
+            return
+        if self.forward:
+            amount = min(self.amount, last_line - blocks[-1][1])
+            first_row, last_row = blocks[0][0], blocks[-1][1] + amount
+        else:
+            amount = min(self.amount, blocks[0][0])
+            first_row, last_row = blocks[0][0] - amount, blocks[-1][1]
+        if amount <= 0:
+            return
 
-        elif wants_action('delete'):
-            consume_amount()
-            # Delete(current_state.amount, **kwargs).run(self, edit)
-            delta = float(kwargs.get('delta', 0.0))
-            by = kwargs.get('by')
-            supported_args_for_by = ('char', 'word', 'line_from_cursor', 'line', 'full_line')
-            if by not in supported_args_for_by:
-                raise ValueError('Don\'t know "{}". Supported arguments for "by": {}'.format(by, supported_args_for_by))
-
-            delta = int(delta)
-            if delta == 0:
-                return
+        span = sublime.Region(view.text_point(first_row, 0), view.line(view.text_point(last_row, 0)).b)
+        lines = view.substr(span).split('\n')
+        moving = [False] * len(lines)
+        for first, last in blocks:
+            for row in range(first, last + 1):
+                moving[row - first_row] = True
+
+        # Every moved line ends up with `amount` more (or fewer) unmoved lines before it.
+        unmoved = [index for index, is_moving in enumerate(moving) if not is_moving]
+        shift = amount if self.forward else -amount
+        order = []
+        placed = 0
+        for index, is_moving in enumerate(moving):
+            if is_moving:
+                target = index - len(order) + placed + shift
+                order.extend(unmoved[placed:target])
+                placed = max(placed, target)
+                order.append(index)
+        order.extend(unmoved[placed:])
+
+        old_starts = []
+        offset = 0
+        for line in lines:
+            old_starts.append(offset)
+            offset += len(line) + 1
+        new_starts = [0] * len(lines)
+        offset = 0
+        for index in order:
+            new_starts[index] = offset
+            offset += len(lines[index]) + 1
+
+        def moved(point):
+            index = bisect.bisect_right(old_starts, point - span.a) - 1
+            return point + new_starts[index] - old_starts[index]
+
+        new_selection = []
+        for region in selection:
+            begin, end = region.begin(), region.end()
+            if view.rowcol(begin)[0] <= last_line:
+                begin, end = moved(begin), moved(end)
+                if region.end() > region.begin() and view.rowcol(region.end())[1] == 0:
+                    # Ending at the start of a line, it follows its own last line.
+                    end = min(moved(region.end() - 1) + 1, view.size())
+            new_selection.append(sublime.Region(end, begin) if region.a > region.b else sublime.Region(begin, end))
+
+        view.replace(edit, span, '\n'.join(lines[index] for index in order))
+        set_selection(view, new_selection)
+
+def line_comment_leaders(view, point):
+    '''The line comment starts of the syntax at `point`, longest first.'''
+    variables = {}
+    for variable in view.meta_info('shellVariables', point) or []:
+        variables[variable['name']] = variable['value']
+    leaders = []
+    for name, value in variables.items():
+        if name.startswith('TM_COMMENT_START') and name.replace('START', 'END') not in variables and value.strip():
+            leaders.append(value.strip())
+    return sorted(leaders, key=len, reverse=True)
+
+def join_line_texts(lines, leaders):
+    '''Join `lines` into one, without the indentation of all but the first
+    one. A comment leader the first line starts with is removed from the
+    others. Returns the text and the offset of the last join.'''
+    first = lines[0].lstrip()
+    leader = next((leader for leader in leaders if first.startswith(leader)), None)
+    parts = [lines[0]]
+    length = len(lines[0])
+    join_offset = length
+    for line in lines[1:]:
+        line = line.lstrip()
+        if leader and line.startswith(leader):
+            line = line[len(leader):].lstrip()
+        join_offset = length
+        if line and length and not parts[-1].endswith((' ', '\t')):
+            parts.append(' ')
+            length += 1
+        parts.append(line)
+        length += len(line)
+    return ''.join(parts), join_offset
+
+@emvee_action('join_lines')
+class JoinLines(EmveeAction):
+    '''Join the line of each caret with the `count` lines below it, or all
+    lines of each selection. Every span is read and replaced once, back to
+    front, and the caret ends up at the last join.'''
+    is_change = True
+
+    def run(self, view, edit):
+        last_row = view.rowcol(view.size())[0]
+        spans = []
+        for region in view.sel():
+            first = view.rowcol(region.begin())[0]
+            last = view.rowcol(region.end())[0]
+            if last == first:
+                last = first + self.amount
+            last = min(last, last_row)
+            if spans and first <= spans[-1][1]:
+                spans[-1][1] = max(spans[-1][1], last)
+            else:
+                spans.append([first, last])
+
+        leaders = line_comment_leaders(view, view.sel()[0].b) if len(view.sel()) else []
+        # (caret, characters removed) of each span, last span first.
+        joins = []
+        for first, last in reversed(spans):
+            begin = view.text_point(first, 0)
+            if last == first:
+                joins.append((view.line(begin).b, 0))
+                continue
+            span = sublime.Region(begin, view.line(view.text_point(last, 0)).b)
+            text, join_offset = join_line_texts(view.substr(span).split('\n'), leaders)
+            view.replace(edit, span, text)
+            joins.append((begin + join_offset, span.size() - len(text)))
+        # Carets were computed before the spans in front of them shrank.
+        carets = []
+        removed = 0
+        for point, size in reversed(joins):
+            carets.append(sublime.Region(point - removed))
+            removed += size
+        set_selection(view, carets)
+        set_mode(view, NORMAL_MODE)
+
+@emvee_action('delete_to_eol')
+class DeleteToEol(SelectionAction):
+    is_change = True
+    delete_full_line = False
+
+    def transform(self, view, selection):
+        for region in selection:
+            remaining = self.amount
+            while remaining > 0:
+                line_region = view.full_line(region.b) if remaining > 1 else view.line(region.b)
+                region.b = line_region.b
+                if self.delete_full_line and region.a > line_region.a:
+                    region.a = line_region.a
+                remaining -= 1
+        return selection
+
+@emvee_action('delete_line')
+class DeleteLine(DeleteToEol):
+    delete_full_line = True
+
+@emvee_action('delete')
+class Delete(EmveeAction):
+    is_change = True
+
+    def __init__(self, amount, *, delta=0.0, by=None, object=None, inner=True, delimiter=None):
+        super().__init__(amount)
+        supported_args_for_by = ('char', 'word', 'line_from_cursor', 'line', 'full_line', 'text_object')
+        if by not in supported_args_for_by:
+            raise ValueError('Don\'t know "{}". Supported arguments for "by": {}'.format(by, supported_args_for_by))
+        self.by = by
+        # A count deletes that many times as much.
+        self.delta = int(float(delta)) * self.amount
+        if by == 'text_object':
+            self.text_object = SelectTextObject(amount, object=object, inner=inner, delimiter=delimiter)
+
+    def run(self, view, edit):
+        by = self.by
+        delta = self.delta
+
+        #
+        # By text object
+        #
+        if by == 'text_object':
+            selection = list(view.sel())
+            found = find_text_objects(view, [region.b for region in selection], *self.text_object.args())
+            for region in reversed(merge_regions(r for r in found if r)):
+                view.erase(edit, region)
+            if get_mode(view) == SELECT_MODE:
+                EnterNormalMode(1).run(view, edit)
+            return
 
-            forward = delta > 0
-            amount = abs(delta)
+        if delta == 0:
+            return
 
-            #
-            # By char
-            #
-            if by == 'char':
-                sublCommand = 'right_delete' if forward else 'left_delete'
+        forward = delta > 0
+        amount = abs(delta)
 
-                view.run_command('add_to_kill_ring', { 'forward': forward })
-                for _ in range(amount):
-                    view.run_command(sublCommand)
+        #
+        # By char
+        #
+        if by == 'char':
+            sublCommand = 'right_delete' if forward else 'left_delete'
 
-            #
-            # By word
-            #
-            elif by == 'word':
-                for _ in range(amount):
-                    view.run_command('delete_word', { 'forward': forward })
-
-            #
-            # By line relative to the cursor
-            #
-            elif by in ('line_from_cursor', 'full_line_from_cursor'):
-                sublCommand = 'right_delete' if forward else 'left_delete'
-                selection = list(view.sel())
-                view.sel().clear()
-                func = getattr(view, 'line' if by == 'line_from_cursor' else 'full_line')
-                for index in range(len(selection)):
-                    region = selection[index]
-                    row, _ = view.rowcol(region.end())
-                    line = func(view.text_point(row + amount - 1, 0))
-                    if forward:
-                        region = sublime.Region(region.begin(), line.end())
-                    else:
-                        region = sublime.Region(line.begin(), region.end())
-                    selection[index] = region
-                view.sel().add_all(selection)
-                view.run_command('add_to_kill_ring', { 'forward': forward })
+            view.run_command('add_to_kill_ring', { 'forward': forward })
+            for _ in range(amount):
                 view.run_command(sublCommand)
 
-            #
-            # By line
-            #
-            elif by in ('line', 'full_line'):
+        #
+        # By word
+        #
+        elif by == 'word':
+            for _ in range(amount):
+                view.run_command('delete_word', { 'forward': forward })
+
+        #
+        # By line relative to the cursor
+        #
+        elif by in ('line_from_cursor', 'full_line_from_cursor'):
+            sublCommand = 'right_delete' if forward else 'left_delete'
+            selection = list(view.sel())
+            view.sel().clear()
+            func = getattr(view, 'line' if by == 'line_from_cursor' else 'full_line')
+            for index in range(len(selection)):
+                region = selection[index]
+                row, _ = view.rowcol(region.end())
+                line = func(view.text_point(row + amount - 1, 0))
                 if forward:
-                    for _ in range(amount):
-                        selection = list(view.sel())
-                        view.sel().clear()
-                        func = getattr(view, by)
-                        for index in range(len(selection)):
-                            selection[index] = func(selection[index])
-                        view.sel().add_all(selection)
-                        view.run_command('add_to_kill_ring', { 'forward': forward })
-                    view.run_command('right_delete')
+                    region = sublime.Region(region.begin(), line.end())
                 else:
-                    err('line operations only support positive deltas.')
-
-        elif wants_action('swap_cursor_with_anchor'):
-            consume_amount()
-            SwapCursorWithAnchor(amount, **kwargs).run(self, edit)
-
-        elif wants_action('integer_add'):
-            consume_amount()
-            # IntegerAdd(amount, **kwargs).run(self, edit)
-            delta = int(kwargs.get('delta', 0))
-            for reg in view.sel():
-                if reg.a == reg.b:
-                    reg = view.word(reg)
-                    try:
-                        potentialReg = sublime.Region(reg.begin() - 1, reg.end())
-                        word = view.substr(potentialReg)
-                        if word.startswith('-'):
-                            reg = potentialReg
-                    except:
-                        pass
-
-                word = view.substr(reg)
+                    region = sublime.Region(line.begin(), region.end())
+                selection[index] = region
+            view.sel().add_all(selection)
+            view.run_command('add_to_kill_ring', { 'forward': forward })
+            view.run_command(sublCommand)
+
+        #
+        # By line
+        #
+        elif by in ('line', 'full_line'):
+            if forward:
+                for _ in range(amount):
+                    selection = list(view.sel())
+                    view.sel().clear()
+                    func = getattr(view, by)
+                    for index in range(len(selection)):
+                        selection[index] = func(selection[index])
+                    view.sel().add_all(selection)
+                    view.run_command('add_to_kill_ring', { 'forward': forward })
+                view.run_command('right_delete')
+            else:
+                err('line operations only support positive deltas.')
+
+@emvee_action('integer_add')
+class IntegerAdd(EmveeAction):
+    is_change = True
+    plannable = True
+
+    def __init__(self, amount, *, delta=0):
+        super().__init__(amount)
+        # A count adds that many times as much.
+        self.delta = int(delta) * self.amount
+
+    def run(self, view, edit):
+        for reg in view.sel():
+            if reg.a == reg.b:
+                reg = view.word(reg)
                 try:
-                    value = int(word)
+                    potentialReg = sublime.Region(reg.begin() - 1, reg.end())
+                    word = view.substr(potentialReg)
+                    if word.startswith('-'):
+                        reg = potentialReg
                 except:
+                    pass
+
+            word = view.substr(reg)
+            try:
+                value = int(word)
+            except:
+                continue
+            value += self.delta
+            newWord = str(value)
+            view.replace(edit, reg, newWord)
+
+    def plan(self, text, selection, separators):
+        # Word characters as `view.word` sees them.
+        is_word = lambda char: not char.isspace() and char not in separators
+        edits = []
+        for a, b in selection:
+            begin, end = min(a, b), max(a, b)
+            if begin == end:
+                while begin > 0 and is_word(text[begin - 1]):
+                    begin -= 1
+                while end < len(text) and is_word(text[end]):
+                    end += 1
+                if text[begin - 1:begin] == '-':
+                    begin -= 1
+            if edits and begin < edits[-1][1]:
+                # Another caret in the same number.
+                continue
+            try:
+                value = int(text[begin:end])
+            except ValueError:
+                continue
+            edits.append((begin, end, str(value + self.delta)))
+        return edits
+
+@emvee_action('insert_line')
+class InsertLine(EmveeAction):
+    is_change = True
+
+    def __init__(self, amount, *, above=False):
+        super().__init__(amount)
+        self.above = bool(above)
+
+    def run(self, view, edit):
+        indent_new_lines = view.settings().get('auto_indent', True)
+        lines = []
+        for region in view.sel():
+            line = view.line(region.b)
+            if not lines or lines[-1].a != line.a:
+                lines.append(line)
+
+        inserts = []
+        for line in lines:
+            indent = ''
+            if indent_new_lines:
+                text = view.substr(line)
+                indent = text[:len(text) - len(text.lstrip(' \t'))]
+            # Only the line that gets the caret is indented, the others stay empty.
+            if self.above:
+                blank = '\n' * (self.amount - 1)
+                inserts.append((line.a, blank + indent + '\n', len(blank) + len(indent)))
+            else:
+                text = '\n' * self.amount + indent
+                inserts.append((line.b, text, len(text)))
+
+        carets = []
+        inserted = 0
+        for point, text, caret in inserts:
+            carets.append(point + inserted + caret)
+            inserted += len(text)
+        for point, text, caret in reversed(inserts):
+            view.insert(edit, point, text)
+        set_selection(view, [sublime.Region(point) for point in carets])
+        set_mode(view, INSERT_MODE)
+
+#
+# Boundary scanners
+#
+# Scanners read the buffer in chunks of SCAN_CHUNK_SIZE instead of calling
+# `substr` per line or per character. The `scan_*` functions take points in
+# ascending order and resolve all of them in a single pass.
+#
+
+SCAN_CHUNK_SIZE = 64 * 1024
+
+# Defaults of the settings that decide when a buffer counts as large. Large
+# buffers get no decorations and scans stop after a limited distance.
+LARGE_FILE_SIZE = 64 * 1024 * 1024
+LARGE_FILE_LINES = 1000000
+LARGE_FILE_SCAN_LIMIT = 4 * 1024 * 1024
+
+def is_large_file(view):
+    settings = view.settings()
+    if view.size() >= settings.get('emvee_large_file_size', LARGE_FILE_SIZE):
+        return True
+    return view.rowcol(view.size())[0] >= settings.get('emvee_large_file_lines', LARGE_FILE_LINES)
+
+def scan_limit(view):
+    '''How far a scan may go from where it starts, None for no limit.'''
+    if not is_large_file(view):
+        return None
+    return view.settings().get('emvee_large_file_scan_limit', LARGE_FILE_SCAN_LIMIT)
+
+def report_scan_limit(view, limit):
+    sublime.status_message('Emvee: large file, stopped scanning after {:.1f} MB'.format(limit / (1024 * 1024)))
+
+def is_blank_line(text):
+    return not text.strip()
+
+def iter_lines_forward(view, point, limit=None):
+    '''Yield (begin, text) of every line, starting with the line at `point`.
+    Stops after about `limit` characters if given.'''
+    begin = view.line(point).a
+    size = view.size()
+    stop = size if limit is None else begin + limit
+    while begin <= size:
+        if begin > stop:
+            report_scan_limit(view, limit)
+            return
+        end = min(begin + SCAN_CHUNK_SIZE, size)
+        chunk = view.substr(sublime.Region(begin, end))
+        if end < size:
+            cut = chunk.rfind('\n')
+            if cut < 0:
+                # A single line longer than a chunk.
+                end = view.line(end).b
+                chunk = view.substr(sublime.Region(begin, end))
+            else:
+                chunk = chunk[:cut]
+        for text in chunk.split('\n'):
+            yield begin, text
+            begin += len(text) + 1
+
+def iter_lines_backward(view, point, limit=None):
+    '''Yield (begin, text) of every line, starting with the line at `point`
+    and going towards the beginning of the buffer. Stops after about `limit`
+    characters if given.'''
+    end = view.line(point).b
+    stop = -1 if limit is None else end - limit
+    while end >= 0:
+        if end < stop:
+            report_scan_limit(view, limit)
+            return
+        begin = max(end - SCAN_CHUNK_SIZE, 0)
+        chunk = view.substr(sublime.Region(begin, end))
+        if begin > 0:
+            cut = chunk.find('\n')
+            if cut < 0:
+                # A single line longer than a chunk.
+                begin = view.line(begin).a
+                chunk = view.substr(sublime.Region(begin, end))
+            else:
+                chunk = chunk[cut + 1:]
+                begin += cut + 1
+        for text in reversed(chunk.split('\n')):
+            end -= len(text)
+            yield end, text
+            end -= 1
+
+def find_empty_line(view, point, forward, count=1):
+    '''Find the beginning of the `count`th blank line that follows a non-blank
+    line, starting at the line of `point`. Stops at the first or last line.'''
+    index = Indexer.get(view, 'lines')
+    if index:
+        return index.find_empty_line(point, forward, count)
+
+    limit = scan_limit(view)
+    lines = iter_lines_forward(view, point, limit) if forward else iter_lines_backward(view, point, limit)
+    found_non_empty_line = False
+    result = point
+    for begin, text in lines:
+        result = begin
+        if not is_blank_line(text):
+            found_non_empty_line = True
+        elif found_non_empty_line:
+            count -= 1
+            if count <= 0:
+                break
+            found_non_empty_line = False
+    return result
+
+def iter_paragraph_bounds(view, first, last):
+    '''Yield where each run of lines that are all blank or all non-blank
+    begins, in order, starting with the run before the one at `first`, and
+    finally where the last run ends. Stops after the scan limit past `last`.'''
+    index = Indexer.get(view, 'lines')
+    if index:
+        bounds = index.paragraph_bounds()
+        i = max(bisect.bisect_right(bounds, first) - 2, 0)
+        yield from bounds[i:]
+        yield view.size()
+        return
+
+    limit = scan_limit(view)
+    size = view.size()
+    blank = is_blank_line(view.substr(view.line(first)))
+    # Begins of the run at `first` and the run before it.
+    begins = []
+    begin = None
+    for line_begin, text in iter_lines_backward(view, first, limit):
+        if is_blank_line(text) != blank:
+            begins.append(begin)
+            blank = not blank
+            if len(begins) == 2:
+                break
+        begin = line_begin
+    if len(begins) < 2:
+        begins.append(begin)
+    yield from reversed(begins)
+
+    blank = is_blank_line(view.substr(view.line(first)))
+    end = size
+    for line_begin, text in iter_lines_forward(view, first, None if limit is None else last - first + limit):
+        if is_blank_line(text) != blank:
+            yield line_begin
+            blank = not blank
+        end = min(line_begin + len(text) + 1, size)
+    yield end
+
+def scan_paragraphs(view, points, inner):
+    '''The full lines around each point that are all blank or all non-blank.
+
+    If not `inner`, the lines of the other kind that follow are included as
+    well, or the ones before if nothing follows. This is one forward pass
+    over the runs of lines between the points.'''
+    bounds = iter_paragraph_bounds(view, points[0], points[-1]) if points else None
+    # Run `k` goes from `begins[k]` to `begins[k + 1]`.
+    begins = []
+
+    def bound(k):
+        while len(begins) <= k:
+            begin = next(bounds, None)
+            if begin is None:
+                return None
+            begins.append(begin)
+        return begins[k]
+
+    result = []
+    k = 0
+    for point in points:
+        while bound(k + 2) is not None and point >= bound(k + 1):
+            k += 1
+        begin, end = begins[k], bound(k + 1)
+        if inner:
+            result.append(sublime.Region(begin, end))
+        elif bound(k + 2) is not None and begins[k + 2] > end:
+            result.append(sublime.Region(begin, begins[k + 2]))
+        elif k > 0:
+            result.append(sublime.Region(begins[k - 1], end))
+        else:
+            result.append(sublime.Region(begin, end))
+    return result
+
+WORD_CLASS_SPACE = 0
+WORD_CLASS_SEPARATOR = 1
+WORD_CLASS_WORD = 2
+
+def word_class(char, separators):
+    if char.isspace():
+        return WORD_CLASS_SPACE
+    if char in separators:
+        return WORD_CLASS_SEPARATOR
+    return WORD_CLASS_WORD
+
+def scan_words(view, points, inner):
+    separators = view.settings().get('word_separators', '')
+    result = []
+    line = None
+    for point in points:
+        if line is None or not (line.a <= point <= line.b):
+            line = view.line(point)
+            text = view.substr(line)
+        col = point - line.a
+        if col >= len(text):
+            col -= 1
+        if col < 0:
+            result.append(None)
+            continue
+
+        kind = word_class(text[col], separators)
+        begin = col
+        while begin > 0 and word_class(text[begin - 1], separators) == kind:
+            begin -= 1
+        end = col + 1
+        while end < len(text) and word_class(text[end], separators) == kind:
+            end += 1
+        if not inner and kind != WORD_CLASS_SPACE:
+            around_end = end
+            while around_end < len(text) and text[around_end].isspace():
+                around_end += 1
+            if around_end > end:
+                end = around_end
+            else:
+                while begin > 0 and text[begin - 1].isspace():
+                    begin -= 1
+        result.append(sublime.Region(line.a + begin, line.a + end))
+    return result
+
+@functools.lru_cache(maxsize=16)
+def compile_word_patterns(separators):
+    '''Patterns matching the words and the subwords of a line, given the
+    `word_separators` setting. Runs of separators are words of their own, and
+    so are empty lines, which match as empty strings. Subwords split words at
+    camelCase humps and underscores.'''
+    escaped = ''.join('\\' + char if char in '\\[]^-' else char for char in separators)
+    word_char = '[^\\s{}]'.format(escaped)
+    common = ['[{}]+'.format(escaped)] if escaped else []
+    empty_line = '^(?=\\n)'
+    words = common + [word_char + '+', empty_line]
+    subwords = common + [
+        '[A-Z]+(?=[A-Z][a-z])',
+        '[A-Z]?[a-z]+',
+        '[A-Z]+',
+        '[0-9]+',
+        '(?<![A-Za-z0-9_])_+(?![A-Za-z0-9_])',
+        '(?:(?![A-Za-z0-9_]){})+'.format(word_char),
+        empty_line,
+    ]
+    return re.compile('|'.join(words), re.MULTILINE), re.compile('|'.join(subwords), re.MULTILINE)
+
+class WordBoundaries:
+    '''The compiled word patterns of each view, dropped when its
+    `word_separators` setting changes.'''
+    patterns = {}
+
+    @classmethod
+    def get(cls, view, subwords):
+        entry = cls.patterns.get(view.id())
+        if entry is None:
+            settings = view.settings()
+            separators = settings.get('word_separators', '')
+            entry = cls.patterns[view.id()] = (separators,) + compile_word_patterns(separators)
+
+            def on_change():
+                if settings.get('word_separators', '') != separators:
+                    cls.discard(view)
+            settings.add_on_change('emvee_word_separators', on_change)
+        return entry[2] if subwords else entry[1]
+
+    @classmethod
+    def discard(cls, view):
+        if cls.patterns.pop(view.id(), None) is not None:
+            view.settings().clear_on_change('emvee_word_separators')
+
+def find_word_boundary(view, regex, point, forward, ends, count):
+    '''The position of the `count`th beginning (or end, if `ends`) of a match
+    of `regex` after or before `point`. Stops at the beginning or end of the
+    buffer. Matches must not span lines, the buffer is read in chunks of
+    whole lines.'''
+    size = view.size()
+    if forward:
+        begin = view.line(point).a
+        while begin < size:
+            end = min(begin + SCAN_CHUNK_SIZE, size)
+            if end < size:
+                end = view.full_line(end).b
+            for match in regex.finditer(view.substr(sublime.Region(begin, end))):
+                if ends and match.end() == match.start():
                     continue
-                value += delta
-                newWord = str(value)
-                view.replace(edit, reg, newWord)
-
-        elif wants_action('insert_line'):
-            consume_amount()
-            # InsertLine(amount, **kwargs).run(self, edit)
-            above = bool(kwargs.get('above', False))
-            if above:
-                view.run_command('move_to', { 'to': 'hardbol' })
+                boundary = begin + (match.end() if ends else match.start())
+                if boundary > point:
+                    count -= 1
+                    if count == 0:
+                        return boundary
+            begin = end
+        return size
+
+    end = view.full_line(point).b
+    while end > 0:
+        begin = max(end - SCAN_CHUNK_SIZE, 0)
+        if begin > 0:
+            begin = view.line(begin).a
+        boundaries = []
+        for match in regex.finditer(view.substr(sublime.Region(begin, end))):
+            if ends and match.end() == match.start():
+                continue
+            boundary = begin + (match.end() if ends else match.start())
+            if boundary < point:
+                boundaries.append(boundary)
+        if len(boundaries) >= count:
+            return boundaries[-count]
+        count -= len(boundaries)
+        end = begin
+    return 0
+
+def scan_brackets(view, points, inner, delimiter):
+    '''Find the innermost pair of `delimiter` (e.g. "()") around each point.
+
+    This is one forward pass over the buffer with a stack of open brackets.
+    A point on an opening or closing bracket is inside of that pair. In large
+    files the pass only covers the scan limit around the points.'''
+    opener, closer = delimiter[0], delimiter[1]
+    index = BracketIndex.get(view) if opener in BRACKETS else None
+    if index:
+        return [index.enclosing_region(point, inner, opener) for point in points]
+
+    pattern = re.compile('[' + re.escape(opener + closer) + ']')
+    count = len(points)
+    enclosing = [None] * count
+    closers = {}
+    unclosed = set()
+    stack = []
+    index = 0
+
+    def assign(pos, inclusive):
+        nonlocal index
+        while index < count and (points[index] < pos or (inclusive and points[index] == pos)):
+            if stack:
+                enclosing[index] = stack[-1]
+                if stack[-1] not in closers:
+                    unclosed.add(stack[-1])
+            index += 1
+
+    size = view.size()
+    begin = 0
+    limit = scan_limit(view)
+    if limit is not None and count:
+        begin = max(points[0] - limit, 0)
+        size = min(points[-1] + limit, size)
+        if begin > 0 or size < view.size():
+            report_scan_limit(view, limit)
+    while begin < size:
+        end = min(begin + SCAN_CHUNK_SIZE, size)
+        chunk = view.substr(sublime.Region(begin, end))
+        for match in pattern.finditer(chunk):
+            pos = begin + match.start()
+            if chunk[match.start()] == opener:
+                assign(pos, False)
+                stack.append(pos)
+                assign(pos, True)
             else:
-                view.run_command('move_to', { 'to': 'hardeol' })
+                assign(pos, True)
+                if stack:
+                    open_pos = stack.pop()
+                    closers[open_pos] = pos
+                    unclosed.discard(open_pos)
+        begin = end
+        if index == count and not unclosed:
+            break
+    assign(size, True)
+
+    result = []
+    for open_pos in enclosing:
+        close_pos = closers.get(open_pos)
+        if close_pos is None:
+            result.append(None)
+        elif inner:
+            result.append(sublime.Region(open_pos + 1, close_pos))
+        else:
+            result.append(sublime.Region(open_pos, close_pos + 1))
+    return result
 
-            for _ in range(amount):
-                view.run_command('insert', { 'characters': '\n' })
+def find_quotes(text, quote):
+    '''Positions of all unescaped `quote` characters in `text`.'''
+    result = []
+    pos = text.find(quote)
+    while pos >= 0:
+        backslashes = 0
+        while pos - backslashes > 0 and text[pos - backslashes - 1] == '\\':
+            backslashes += 1
+        if backslashes % 2 == 0:
+            result.append(pos)
+        pos = text.find(quote, pos + 1)
+    return result
 
-            if above:
-                view.run_command('move', { 'by': 'lines', 'forward': False })
-                view.run_command('reindent', { 'force_indent': False })
+def scan_quotes(view, points, inner, delimiter):
+    '''Find the quoted string around each point, or the next one on the same
+    line. Quotes are paired up from the beginning of the line.'''
+    result = []
+    line = None
+    for point in points:
+        if line is None or not (line.a <= point <= line.b):
+            line = view.line(point)
+            quotes = find_quotes(view.substr(line), delimiter)
+        col = point - line.a
+        found = None
+        for index in range(0, len(quotes) - 1, 2):
+            open_col, close_col = quotes[index], quotes[index + 1]
+            if open_col <= col <= close_col or open_col > col:
+                if inner:
+                    found = sublime.Region(line.a + open_col + 1, line.a + close_col)
+                else:
+                    found = sublime.Region(line.a + open_col, line.a + close_col + 1)
+                break
+        result.append(found)
+    return result
 
-            if get_mode(view) != INSERT_MODE:
-                view.run_command('emvee', { 'action': 'enter_insert_mode' })
+text_object_scanners = {
+    'word':      lambda view, points, inner, delimiter: scan_words(view, points, inner),
+    'paragraph': lambda view, points, inner, delimiter: scan_paragraphs(view, points, inner),
+    'brackets':  scan_brackets,
+    'quotes':    scan_quotes,
+}
+
+def find_text_objects(view, points, kind, inner, delimiter=None):
+    '''Resolve the text object `kind` for each of `points`.
+
+    Returns a Region, or None if there is no such object, for each point in
+    the order given.'''
+    order = sorted(range(len(points)), key=points.__getitem__)
+    found = text_object_scanners[kind](view, [points[i] for i in order], inner, delimiter)
+    result = [None] * len(points)
+    for index, region in zip(order, found):
+        result[index] = region
+    return result
 
+#
+# Background indexing
+#
+
+def finish(builder):
+    '''Run a builder generator to the end and return its result.'''
+    while True:
+        try:
+            next(builder)
+        except StopIteration as done:
+            return done.value
+
+class BufferViews:
+    '''Counts the views of each buffer that use buffer-level caches.
+
+    Indexes describe the text, so clones of a buffer share them, keyed by
+    `view.buffer_id()`. They are dropped when the last of those views closes.'''
+    buffers = {}
+    counts = collections.Counter()
+
+    @classmethod
+    def attach(cls, view):
+        '''Return the buffer id of `view`, counting the view if it is new.'''
+        buffer_id = cls.buffers.get(view.id())
+        if buffer_id is None:
+            buffer_id = cls.buffers[view.id()] = view.buffer_id()
+            cls.counts[buffer_id] += 1
+        return buffer_id
+
+    @classmethod
+    def detach(cls, view):
+        '''Forget `view`. Returns its buffer id if it was the last view of
+        that buffer, None otherwise.'''
+        buffer_id = cls.buffers.pop(view.id(), None)
+        if buffer_id is None:
+            return None
+        cls.counts[buffer_id] -= 1
+        if cls.counts[buffer_id] > 0:
+            return None
+        del cls.counts[buffer_id]
+        return buffer_id
+
+# Default of the `emvee_cache_budget` setting, in bytes.
+CACHE_BUDGET = 64 * 1024 * 1024
+INT_SIZE = sys.getsizeof(1 << 40)
+
+def list_size(values):
+    '''Approximate size in bytes of a list of ints.'''
+    return sys.getsizeof(values) + len(values) * INT_SIZE
+
+class Caches:
+    '''Keeps the buffer-level caches within `emvee_cache_budget` bytes.
+
+    A cache registers under a name and provides `cache_entries()`, which
+    yields a (buffer_id, size) pair per entry, and `evict(buffer_id)`. Entries
+    with a buffer_id of None are only reported. When the total grows over
+    the budget, the least recently used buffers are evicted first, and the
+    buffer of the active view never is.'''
+    caches = collections.OrderedDict()
+    recent = collections.OrderedDict()
+    hits = collections.Counter()
+    misses = collections.Counter()
+
+    @classmethod
+    def register(cls, name, cache):
+        cls.caches[name] = cache
+
+    @classmethod
+    def touch(cls, buffer_id):
+        cls.recent[buffer_id] = None
+        cls.recent.move_to_end(buffer_id)
+
+    @classmethod
+    def forget(cls, buffer_id):
+        cls.recent.pop(buffer_id, None)
+
+    @classmethod
+    def count(cls, name, hit):
+        if hit:
+            cls.hits[name] += 1
         else:
-            if not action:
-                err('missing "action" parameter')
+            cls.misses[name] += 1
+
+    @classmethod
+    def trim(cls):
+        budget = sublime.load_settings('Preferences.sublime-settings').get('emvee_cache_budget', CACHE_BUDGET)
+        sizes = collections.Counter()
+        for cache in cls.caches.values():
+            for buffer_id, size in cache.cache_entries():
+                sizes[buffer_id] += size
+        total = sum(sizes.values())
+        if total <= budget:
+            return
+
+        window = sublime.active_window()
+        active_view = window and window.active_view()
+        active = active_view.buffer_id() if active_view else None
+        untouched = [buffer_id for buffer_id in sizes if buffer_id not in cls.recent]
+        for buffer_id in untouched + list(cls.recent):
+            if total <= budget:
+                break
+            if buffer_id is None or buffer_id == active or buffer_id not in sizes:
+                continue
+            debug_log('cache[{}] evicting {} bytes'.format(buffer_id, sizes[buffer_id]))
+            for cache in cls.caches.values():
+                cache.evict(buffer_id)
+            total -= sizes[buffer_id]
+
+class EmveeCacheStatsCommand(sublime_plugin.ApplicationCommand):
+    '''Print the size and hit rate of every Emvee cache to the console.'''
+    def run(self):
+        total = 0
+        for name, cache in Caches.caches.items():
+            entries = list(cache.cache_entries())
+            size = sum(size for _, size in entries)
+            total += size
+            lookups = Caches.hits[name] + Caches.misses[name]
+            hit_rate = '{:.0%}'.format(Caches.hits[name] / lookups) if lookups else '-'
+            print('emvee: {:<10} {:>6} entries {:>10.1f} KB  hit rate {}'.format(name, len(entries), size / 1024, hit_rate))
+        info = compile_search_pattern.cache_info()
+        print('emvee: {:<10} {:>6} entries {:>13}  hit rate {}'.format('patterns', info.currsize, '', '{:.0%}'.format(info.hits / (info.hits + info.misses)) if info.hits + info.misses else '-'))
+        if tracemalloc and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            print('emvee: traced memory {:.1f} KB, peak {:.1f} KB'.format(current / 1024, peak / 1024))
+        sublime.status_message('Emvee: caches use {:.1f} KB, see console'.format(total / 1024))
+
+class Indexer:
+    '''Builds indexes of buffers in the background.
+
+    A builder is a generator function that takes a view, yields between
+    chunks of work and returns the index. Every chunk runs as its own async
+    callback, and a build is cancelled as soon as the view changes under it.
+    Indexes carry the `change_count` of the view they describe and `get` only
+    hands them out while it matches, so callers scan the view directly
+    otherwise. All views of a buffer share its indexes (see BufferViews).
+
+    Large files get no indexes, they would not fit the cache budget. Callers
+    use the scanners there, which stop at the scan limit.'''
+    builders = {}
+    indexes = {}
+    jobs = {}
+
+    @classmethod
+    def register(cls, kind, builder):
+        cls.builders[kind] = builder
+
+    @classmethod
+    def get(cls, view, kind):
+        '''Return the index of `view` if it is up to date. Otherwise start
+        building one and return None.'''
+        buffer_id = BufferViews.attach(view)
+        if is_large_file(view):
+            # The buffer may have grown past the threshold since the build.
+            cls.indexes.pop((buffer_id, kind), None)
+            return None
+        Caches.touch(buffer_id)
+        index = cls.indexes.get((buffer_id, kind))
+        if index is not None and index.change_count == view.change_count():
+            Caches.count('indexes', True)
+            return index
+        Caches.count('indexes', False)
+        cls.schedule(view, kind)
+        return None
+
+    @classmethod
+    def peek(cls, view, kind):
+        '''Return the index of `view`, up to date or not.'''
+        return cls.indexes.get((BufferViews.attach(view), kind))
+
+    @classmethod
+    def drop(cls, view, kind):
+        cls.indexes.pop((BufferViews.attach(view), kind), None)
+
+    @classmethod
+    def discard(cls, buffer_id):
+        cls.evict(buffer_id)
+        for key in [key for key in cls.jobs if key[0] == buffer_id]:
+            del cls.jobs[key]
+
+    @classmethod
+    def evict(cls, buffer_id):
+        for key in [key for key in cls.indexes if key[0] == buffer_id]:
+            del cls.indexes[key]
+
+    @classmethod
+    def cache_entries(cls):
+        for (buffer_id, kind), index in cls.indexes.items():
+            yield buffer_id, index.size()
+
+    @classmethod
+    def schedule_all(cls, view):
+        for kind in cls.builders:
+            cls.get(view, kind)
+
+    @classmethod
+    def schedule(cls, view, kind):
+        if is_large_file(view):
+            return
+        key = (BufferViews.attach(view), kind)
+        change_count = view.change_count()
+        if cls.jobs.get(key) == change_count:
+            return
+        # Replacing the job cancels a build for an older change_count.
+        cls.jobs[key] = change_count
+        builder = cls.builders[kind](view)
+
+        def is_current():
+            return cls.jobs.get(key) == change_count
+
+        def step():
+            if not is_current() or view.change_count() != change_count:
+                debug_log('index[{},{}] cancelled'.format(*key))
+                if is_current():
+                    del cls.jobs[key]
+                return
+            try:
+                next(builder)
+            except StopIteration as done:
+                index = done.value
+                # Commit on the main thread so no edit can slip in between the check and the commit.
+                sublime.set_timeout(lambda: commit(index), 0)
+                return
+            except:
+                if is_current():
+                    del cls.jobs[key]
+                raise
+            sublime.set_timeout_async(step, 0)
+
+        def commit(index):
+            if not is_current():
+                return
+            del cls.jobs[key]
+            if view.is_valid() and view.change_count() == change_count:
+                cls.indexes[key] = index
+                debug_log('index[{},{}] built'.format(*key))
+                Caches.trim()
+
+        sublime.set_timeout_async(step, 0)
+
+#
+# Line index
+#
+
+# Number of lines the line index builder processes between yields.
+LINE_INDEX_STEP = 4096
+
+class LineIndex:
+    '''Line starts and paragraph boundaries of a view.
+
+    `paragraph_ends` holds the start of every blank line that follows a
+    non-blank line, `paragraph_starts` the start of every blank line followed
+    by a non-blank line. These are the targets of `find_empty_line` going
+    forward and backward.'''
+    def __init__(self, change_count, starts, paragraph_ends, paragraph_starts):
+        self.change_count = change_count
+        self.starts = starts
+        self.paragraph_ends = paragraph_ends
+        self.paragraph_starts = paragraph_starts
+        self.start_array = None
+        self.bounds = None
+
+    def size(self):
+        result = list_size(self.starts) + list_size(self.paragraph_ends) + list_size(self.paragraph_starts)
+        if self.bounds is not None:
+            result += list_size(self.bounds)
+        if self.start_array is not None:
+            result += self.start_array.nbytes
+        return result
+
+    def paragraph_bounds(self):
+        '''Where each run of lines that are all blank or all non-blank begins.'''
+        if self.bounds is None:
+            # A run of blank lines ends with the line after each paragraph start.
+            after_blanks = [self.starts[bisect.bisect_right(self.starts, point)] for point in self.paragraph_starts]
+            self.bounds = [0] + sorted(set(self.paragraph_ends + after_blanks) - {0})
+        return self.bounds
+
+    def starts_as_array(self):
+        if self.start_array is None:
+            self.start_array = numpy.array(self.starts, dtype=numpy.int64)
+        return self.start_array
+
+    def find_empty_line(self, point, forward, count):
+        line_begin = self.starts[bisect.bisect_right(self.starts, point) - 1]
+        if forward:
+            i = bisect.bisect_right(self.paragraph_ends, line_begin) + count - 1
+            if i < len(self.paragraph_ends):
+                return self.paragraph_ends[i]
+            return self.starts[-1]
+        i = bisect.bisect_left(self.paragraph_starts, line_begin) - count
+        if i >= 0:
+            return self.paragraph_starts[i]
+        return 0
+
+def build_line_index(view):
+    change_count = view.change_count()
+    starts = []
+    paragraph_ends = []
+    paragraph_starts = []
+    previous_blank = True
+    previous_begin = None
+    for begin, text in iter_lines_forward(view, 0):
+        blank = is_blank_line(text)
+        if blank and not previous_blank:
+            paragraph_ends.append(begin)
+        if previous_blank and not blank and previous_begin is not None:
+            paragraph_starts.append(previous_begin)
+        starts.append(begin)
+        previous_blank = blank
+        previous_begin = begin
+        if len(starts) % LINE_INDEX_STEP == 0:
+            yield
+    return LineIndex(change_count, starts, paragraph_ends, paragraph_starts)
+
+Indexer.register('lines', build_line_index)
+Caches.register('indexes', Indexer)
+
+#
+# Caret arrays
+#
+
+# Selections with at least this many regions are transformed as CaretArrays.
+CARET_ARRAY_THRESHOLD = 1000
+
+class CaretArrays:
+    '''The `a` and `b` values of many regions packed into int64 arrays, so a
+    transform costs neither a Region nor a view API call per caret.
+
+    With NumPy the operations are vectorized, without it they are plain loops
+    over `array.array`. Line bounds come from a LineIndex, which callers
+    have to check is fresh.'''
+    def __init__(self, selection):
+        if numpy:
+            self.a = numpy.fromiter((region.a for region in selection), numpy.int64, len(selection))
+            self.b = numpy.fromiter((region.b for region in selection), numpy.int64, len(selection))
+        else:
+            self.a = array.array('q', (region.a for region in selection))
+            self.b = array.array('q', (region.b for region in selection))
+
+    @staticmethod
+    def wanted(selection):
+        return len(selection) >= CARET_ARRAY_THRESHOLD
+
+    def regions(self):
+        return [sublime.Region(a, b) for a, b in zip(self.a.tolist(), self.b.tolist())]
+
+    def begins(self):
+        if numpy:
+            return numpy.minimum(self.a, self.b)
+        return array.array('q', map(min, self.a, self.b))
+
+    def ends(self):
+        if numpy:
+            return numpy.maximum(self.a, self.b)
+        return array.array('q', map(max, self.a, self.b))
+
+    def collapse(self, mask=None):
+        '''Set `a` to `b`, only where `mask` is true if given.'''
+        if numpy:
+            self.a = self.b.copy() if mask is None else numpy.where(mask, self.b, self.a)
+        elif mask is None:
+            self.a = array.array('q', self.b)
+        else:
+            self.a = array.array('q', (b if m else a for a, b, m in zip(self.a, self.b, mask)))
+
+    def move(self, offsets):
+        '''Add `offsets`, a number or one per caret, to `b`.'''
+        if numpy:
+            self.b = self.b + offsets
+        elif isinstance(offsets, int):
+            self.b = array.array('q', (b + offsets for b in self.b))
+        else:
+            self.b = array.array('q', map(int.__add__, self.b, offsets))
+
+    def clamp(self, lower, upper):
+        '''Limit each `b` to the bounds of its caret.'''
+        if numpy:
+            self.b = numpy.minimum(numpy.maximum(self.b, lower), upper)
+        else:
+            self.b = array.array('q', (min(max(b, low), high) for b, low, high in zip(self.b, lower, upper)))
+
+    @staticmethod
+    def line_bounds(index, size, points, full=False):
+        '''The beginning and end of the line at each of `points`, like
+        `view.line` or, if `full`, `view.full_line`.'''
+        starts = index.starts
+        end_offset = 0 if full else 1
+        if numpy:
+            start_array = index.starts_as_array()
+            line = numpy.searchsorted(start_array, points, 'right') - 1
+            is_last = line + 1 >= len(start_array)
+            following = start_array[numpy.minimum(line + 1, len(start_array) - 1)]
+            return start_array[line], numpy.where(is_last, size, following - end_offset)
+        begins = array.array('q')
+        ends = array.array('q')
+        for point in points:
+            line = bisect.bisect_right(starts, point) - 1
+            begins.append(starts[line])
+            ends.append(starts[line + 1] - end_offset if line + 1 < len(starts) else size)
+        return begins, ends
+
+#
+# Folds
+#
+
+class Folds:
+    '''Rows hidden by folds, read from `view.folded_regions()` again only
+    after an edit or a fold command (see EmveeEventListener).
+
+    A fold from row `start` to row `end` shows as the single display row of
+    `start`. Display rows and buffer rows are mapped with a bisect over the
+    folds, so motions cost O(log folds) regardless of distance.'''
+    cache = {}
+
+    def __init__(self, view):
+        self.starts = []
+        self.ends = []
+        # Where the visible text of the first row of each fold ends.
+        self.begins = []
+        for region in view.folded_regions():
+            start = view.rowcol(region.begin())[0]
+            end = view.rowcol(region.end())[0]
+            if end == start:
+                continue
+            if self.ends and start <= self.ends[-1]:
+                self.ends[-1] = max(self.ends[-1], end)
+            else:
+                self.starts.append(start)
+                self.ends.append(end)
+                self.begins.append(region.begin())
+        # Number of hidden rows before each fold and including it.
+        self.hidden = []
+        hidden = 0
+        for start, end in zip(self.starts, self.ends):
+            hidden += end - start
+            self.hidden.append(hidden)
+        self.display_starts = [start - (hidden - (end - start)) for start, end, hidden in zip(self.starts, self.ends, self.hidden)]
+
+    @classmethod
+    def get(cls, view):
+        folds = cls.cache.get(view.id())
+        if folds is None:
+            folds = cls.cache[view.id()] = Folds(view)
+        return folds
+
+    @classmethod
+    def invalidate(cls, view):
+        cls.cache.pop(view.id(), None)
+
+    def fold_index(self, row):
+        '''The index of the fold that contains `row`, or -1.'''
+        i = bisect.bisect_right(self.starts, row) - 1
+        if i >= 0 and row <= self.ends[i]:
+            return i
+        return -1
+
+    def display_row(self, row):
+        i = bisect.bisect_right(self.starts, row) - 1
+        if i < 0:
+            return row
+        if row <= self.ends[i]:
+            return self.display_starts[i]
+        return row - self.hidden[i]
+
+    def buffer_row(self, display_row):
+        i = bisect.bisect_right(self.display_starts, display_row) - 1
+        if i < 0:
+            return display_row
+        if display_row == self.display_starts[i]:
+            return self.starts[i]
+        return display_row + self.hidden[i]
+
+    def visible_end(self, row, default):
+        '''Where the visible text of `row` ends if a fold starts on it.'''
+        i = self.fold_index(row)
+        if i >= 0 and self.starts[i] == row:
+            return self.begins[i]
+        return default
+
+def find_visible_empty_line(view, folds, point, forward, count):
+    '''`find_empty_line`, skipping blank lines hidden in folds.'''
+    if not folds.starts:
+        return find_empty_line(view, point, forward, count)
+    for _ in range(count):
+        point = find_empty_line(view, point, forward, 1)
+        i = folds.fold_index(view.rowcol(point)[0])
+        while i >= 0 and view.rowcol(point)[0] != folds.starts[i]:
+            edge = view.text_point(folds.ends[i] if forward else folds.starts[i], 0)
+            if not forward and is_blank_line(view.substr(view.line(edge))):
+                # The fold itself shows as a blank line.
+                point = edge
+                break
+            point = find_empty_line(view, edge, forward, 1)
+            next_i = folds.fold_index(view.rowcol(point)[0])
+            if next_i == i:
+                # Nothing outside of the fold.
+                break
+            i = next_i
+    return point
+
+#
+# Layout metrics
+#
+
+# View settings that change how text is laid out.
+LAYOUT_SETTINGS = ('font_face', 'font_size', 'line_padding_top', 'line_padding_bottom', 'word_wrap', 'wrap_width')
+
+class LayoutMetrics:
+    '''Line height, viewport and layout extents of a view.
+
+    Kept until an edit or fold (see EmveeEventListener), a change of one of
+    LAYOUT_SETTINGS, or a resize. A resize has no event, so `get` compares the
+    viewport extent, which replaces three API calls with one.'''
+    cache = {}
+
+    def __init__(self, view, viewport_extent):
+        self.viewport_extent = viewport_extent
+        self.line_height = view.line_height()
+        self.layout_extent = view.layout_extent()
+
+    @classmethod
+    def get(cls, view):
+        viewport_extent = view.viewport_extent()
+        metrics = cls.cache.get(view.id())
+        if metrics is None or metrics.viewport_extent != viewport_extent:
+            if view.id() not in cls.cache:
+                settings = view.settings()
+                values = [settings.get(name) for name in LAYOUT_SETTINGS]
+
+                def on_change():
+                    current = [settings.get(name) for name in LAYOUT_SETTINGS]
+                    if current != values:
+                        values[:] = current
+                        cls.invalidate(view)
+                settings.add_on_change('emvee_layout', on_change)
+            metrics = cls.cache[view.id()] = LayoutMetrics(view, viewport_extent)
+        return metrics
+
+    @classmethod
+    def invalidate(cls, view):
+        # Keeps the settings callback, an empty entry is rebuilt by `get`.
+        if view.id() in cls.cache:
+            cls.cache[view.id()] = None
+
+    @classmethod
+    def invalidate_all(cls):
+        for view_id in cls.cache:
+            cls.cache[view_id] = None
+
+    @classmethod
+    def discard(cls, view):
+        if view.id() in cls.cache:
+            del cls.cache[view.id()]
+            view.settings().clear_on_change('emvee_layout')
+
+    def move_carets(self, view, selection, delta, extend):
+        '''Moves the carets of `selection` `delta` pixels down, keeping their
+        `xpos`.'''
+        result = []
+        for region in selection:
+            x, y = view.text_to_layout(region.b)
+            if region.xpos >= 0:
+                x = region.xpos
+            point = self.display_point(view, x, y + delta)
+            result.append(sublime.Region(region.a if extend else point, point, x))
+        return result
+
+    def display_point(self, view, x, y):
+        '''The point shown at layout position (`x`, `y`), with `y` clamped to
+        the rows of the layout.'''
+        y = min(max(y, 0.0), self.layout_extent[1] - self.line_height)
+        # The middle of the row is safe from rounding at its edges.
+        return view.layout_to_text((x, y + self.line_height / 2))
+
+#
+# Bracket index
+#
+
+BRACKETS = { '(': ')', '[': ']', '{': '}' }
+BRACKET_PATTERN = re.compile(r'[()\[\]{}]')
+IGNORED_BRACKET_SELECTOR = 'string, comment'
+# Edits that would need more than this many characters rescanned rebuild
+# the whole index in the background instead.
+BRACKET_REPAIR_LIMIT = 256 * 1024
+# Edits that would need more than this many brackets rekeyed, because they
+# are far from the previous edit, also rebuild the index in the background.
+BRACKET_SHIFT_LIMIT = 4096
+# Keys of brackets behind the last edit start this far above their
+# position, see BracketIndex. Buffers never grow by that much.
+BRACKET_TAIL_BASE = 1 << 48
+
+def make_region_test(regions):
+    '''Make a test whether a point is in one of the sorted `regions`.
+    The test must be called with ascending points.'''
+    index = 0
+    def test(point):
+        nonlocal index
+        while index < len(regions) and regions[index].end() <= point:
+            index += 1
+        return index < len(regions) and regions[index].begin() <= point
+    return test
+
+def scan_bracket_pairs(view, begin, end, is_ignored):
+    '''Pair up all brackets in [begin, end) for which `is_ignored` is false.
+
+    Returns (openers, closers, balanced). `openers` maps an opening bracket to
+    (closer, char), `closers` maps a closing bracket to its opener.'''
+    return finish(iter_bracket_pairs(view, begin, end, is_ignored))
+
+def iter_bracket_pairs(view, begin, end, is_ignored):
+    '''`scan_bracket_pairs` as a builder that yields after every chunk.'''
+    openers = {}
+    closers = {}
+    stack = []
+    balanced = True
+    pos = begin
+    while pos < end:
+        chunk_end = min(pos + SCAN_CHUNK_SIZE, end)
+        chunk = view.substr(sublime.Region(pos, chunk_end))
+        for match in BRACKET_PATTERN.finditer(chunk):
+            point = pos + match.start()
+            char = match.group()
+            if is_ignored(point):
+                continue
+            if char in BRACKETS:
+                stack.append((point, char))
+            elif stack and BRACKETS[stack[-1][1]] == char:
+                open_point, open_char = stack.pop()
+                openers[open_point] = (point, open_char)
+                closers[point] = open_point
+            else:
+                balanced = False
+        pos = chunk_end
+        yield
+    return openers, closers, balanced and not stack
+
+def build_bracket_index(view):
+    change_count = view.change_count()
+    # The next edit is most likely at the caret.
+    boundary = view.sel()[0].b if len(view.sel()) else 0
+    is_ignored = make_region_test(view.find_by_selector(IGNORED_BRACKET_SELECTOR))
+    openers, closers, balanced = yield from iter_bracket_pairs(view, 0, view.size(), is_ignored)
+    return BracketIndex(change_count, openers, closers, balanced, boundary)
+
+class BracketIndex:
+    '''Maps every bracket in a view to its partner. Brackets in strings and
+    comments are ignored.
+
+    Indexes are built by the Indexer. Edits are repaired in place by
+    `apply_changes`.
+
+    Positions are stored as keys so that an edit does not have to touch every
+    bracket behind it. Brackets before `boundary` are keyed by their position.
+    Brackets after it are keyed by their position plus `tail_offset`, which
+    keeps their keys above `boundary` and lets an edit move all of them by
+    changing `tail_offset` alone. Only the brackets between the
+    previous edit and the next one are rekeyed, so typing in one place costs
+    the same regardless of the size of the buffer.'''
+    def __init__(self, change_count, openers, closers, balanced, boundary=0):
+        self.change_count = change_count
+        # Repairs are only exact if every bracket in the buffer has a partner.
+        self.balanced = balanced
+        self.boundary = boundary
+        self.tail_offset = BRACKET_TAIL_BASE
+        self.openers = {}
+        self.closers = {}
+        self.positions = []
+        self.insert(openers, closers)
+
+    @classmethod
+    def get(cls, view):
+        return Indexer.get(view, 'brackets')
+
+    def size(self):
+        pair_size = sys.getsizeof(('', 0)) + 2 * INT_SIZE
+        return sys.getsizeof(self.openers) + sys.getsizeof(self.closers) + list_size(self.positions) \
+            + len(self.openers) * pair_size + len(self.closers) * 2 * INT_SIZE
+
+    @classmethod
+    def apply_changes(cls, view, changes):
+        index = Indexer.peek(view, 'brackets')
+        if index and not index.repair(view, changes):
+            Indexer.drop(view, 'brackets')
+            Indexer.schedule(view, 'brackets')
+
+    def key(self, point):
+        return point if point < self.boundary else point + self.tail_offset
+
+    def point(self, key):
+        return key if key < self.boundary else key - self.tail_offset
+
+    def insert(self, openers, closers):
+        '''Add pairs given by position, none of them may be indexed yet.'''
+        key = self.key
+        for open_point, (close_point, char) in openers.items():
+            self.openers[key(open_point)] = (key(close_point), char)
+        for close_point, open_point in closers.items():
+            self.closers[key(close_point)] = key(open_point)
+        keys = sorted(key(point) for point in itertools.chain(openers, closers))
+        if keys:
+            lo = bisect.bisect_left(self.positions, keys[0])
+            self.positions[lo:lo] = keys
+
+    def partner(self, point):
+        key = self.key(point)
+        pair = self.openers.get(key)
+        if pair:
+            return self.point(pair[0])
+        partner = self.closers.get(key)
+        return None if partner is None else self.point(partner)
+
+    def enclosing(self, point, char=None):
+        '''The innermost (opener, closer) around `point` whose opening bracket
+        is `char`, or any bracket if `char` is None. A point on a bracket is
+        inside of that pair.'''
+        # Keys are in the same order as positions, so the search stays in keys.
+        point = self.key(point)
+        positions = self.positions
+        i = bisect.bisect_right(positions, point) - 1
+        if i >= 0 and positions[i] == point and point in self.closers:
+            i = bisect.bisect_left(positions, self.closers[point])
+        while i >= 0:
+            pos = positions[i]
+            pair = self.openers.get(pos)
+            if pair:
+                if pair[0] >= point and (char is None or pair[1] == char):
+                    return self.point(pos), self.point(pair[0])
+                i -= 1
+            else:
+                # Skip over the pair that ends before `point`.
+                i = bisect.bisect_left(positions, self.closers[pos]) - 1
+        return None
+
+    def enclosing_region(self, point, inner, char=None):
+        pair = self.enclosing(point, char)
+        if not pair:
+            return None
+        if inner:
+            return sublime.Region(pair[0] + 1, pair[1])
+        return sublime.Region(pair[0], pair[1] + 1)
+
+    def jump_target(self, point):
+        '''Where `m` goes from `point`: the partner of the bracket at or right
+        before `point`, else the closer of the enclosing pair.'''
+        target = self.partner(point)
+        if target is None and point > 0:
+            target = self.partner(point - 1)
+        if target is None:
+            pair = self.enclosing(point)
+            if pair:
+                target = pair[1]
+        return target
+
+    def repair_range(self, begin, end):
+        '''Grow [begin, end) to the outermost pairs around either end, so that
+        no pair crosses the boundaries of the result.'''
+        for point in (begin, end):
+            pair = self.enclosing(point)
+            while pair:
+                begin = min(begin, pair[0])
+                end = max(end, pair[1] + 1)
+                pair = self.enclosing(pair[0] - 1) if pair[0] > 0 else None
+        return begin, end
+
+    def remove(self, begin, end):
+        lo = bisect.bisect_left(self.positions, self.key(begin))
+        hi = bisect.bisect_left(self.positions, self.key(end))
+        for pos in self.positions[lo:hi]:
+            self.openers.pop(pos, None)
+            self.closers.pop(pos, None)
+        del self.positions[lo:hi]
+
+    def rekey(self, lo, hi, convert):
+        '''Give the brackets in `positions[lo:hi]` the keys `convert` maps
+        their keys to, keeping the order.'''
+        moved = self.positions[lo:hi]
+        keys = { key: convert(key) for key in moved }
+        openers = {}
+        closers = {}
+        for key in moved:
+            pair = self.openers.pop(key, None)
+            if pair:
+                partner = keys.get(pair[0])
+                if partner is None:
+                    partner = pair[0]
+                    self.closers[partner] = keys[key]
+                openers[keys[key]] = (partner, pair[1])
+            else:
+                opener = self.closers.pop(key)
+                partner = keys.get(opener)
+                if partner is None:
+                    partner = opener
+                    self.openers[partner] = (keys[key], self.openers[partner][1])
+                closers[keys[key]] = partner
+        self.openers.update(openers)
+        self.closers.update(closers)
+        self.positions[lo:hi] = [keys[key] for key in moved]
+
+    def shift(self, begin, delta):
+        '''Move everything at or after `begin` by `delta`. No pair may cross
+        `begin`. Returns False if more than BRACKET_SHIFT_LIMIT brackets lie
+        between `begin` and the previous edit.'''
+        if begin != self.boundary:
+            lo = bisect.bisect_left(self.positions, self.key(min(begin, self.boundary)))
+            hi = bisect.bisect_left(self.positions, self.key(max(begin, self.boundary)))
+            if hi - lo > BRACKET_SHIFT_LIMIT:
+                return False
+            if begin > self.boundary:
+                self.rekey(lo, hi, self.point)
+            else:
+                tail_offset = self.tail_offset
+                self.rekey(lo, hi, lambda key: key + tail_offset)
+        self.tail_offset -= delta
+        self.boundary = begin + delta
+        return True
+
+    def repair(self, view, changes):
+        '''Update the index for a list of `sublime.TextChange`s. Only the edited
+        ranges are rescanned. Returns False if the index has to be rebuilt.'''
+        if not self.balanced:
+            return False
+        dirty = None
+        for change in changes:
+            begin, end = self.repair_range(change.a.pt, change.b.pt)
+            delta = len(change.str) - (change.b.pt - change.a.pt)
+            self.remove(begin, end)
+            if not self.shift(end, delta):
+                return False
+            if dirty is None:
+                dirty = (begin, end + delta)
+            else:
+                def moved(point):
+                    if point >= end:
+                        return point + delta
+                    return min(point, begin) if point <= begin else end + delta
+                dirty = (min(moved(dirty[0]), begin), max(moved(dirty[1]), end + delta))
+
+        if dirty is None:
+            return True
+        begin, end = dirty
+        if end - begin > BRACKET_REPAIR_LIMIT:
+            return False
+        self.remove(begin, end)
+        is_ignored = lambda point: view.match_selector(point, IGNORED_BRACKET_SELECTOR)
+        openers, closers, balanced = scan_bracket_pairs(view, begin, end, is_ignored)
+        if not balanced:
+            return False
+        self.insert(openers, closers)
+        self.change_count = view.change_count()
+        return True
+
+Indexer.register('brackets', build_bracket_index)
+
+if hasattr(sublime_plugin, 'TextChangeListener'):
+    class EmveeTextChangeListener(sublime_plugin.TextChangeListener):
+        def on_text_changed(self, changes):
+            # The index is shared by all views of the buffer, repair it once.
+            view = self.buffer.primary_view()
+            if view:
+                BracketIndex.apply_changes(view, changes)
+
+def find_bracket_jump(view, point):
+    '''`BracketIndex.jump_target` without an index.'''
+    for candidate in (point, point - 1):
+        char = view.substr(candidate) if candidate >= 0 else ''
+        for opener, closer in BRACKETS.items():
+            if char in (opener, closer):
+                region = scan_brackets(view, [candidate], False, opener + closer)[0]
+                if region and candidate in (region.begin(), region.end() - 1):
+                    return region.end() - 1 if char == opener else region.begin()
+    innermost = None
+    for opener, closer in BRACKETS.items():
+        region = scan_brackets(view, [point], False, opener + closer)[0]
+        if region and (innermost is None or region.begin() > innermost.begin()):
+            innermost = region
+    return innermost.end() - 1 if innermost else None
+
+@emvee_action('move_to_bracket')
+class MoveToBracket(SelectionAction):
+    is_motion = True
+
+    def __init__(self, amount, *, extend=False):
+        super().__init__(amount)
+        self.extend = bool(extend)
+
+    def transform(self, view, selection):
+        extend = self.extend or get_mode(view) == SELECT_MODE
+        index = BracketIndex.get(view)
+        for region in selection:
+            if index:
+                target = index.jump_target(region.b)
             else:
-                err('No such emvee action:', action)
-                name_match_threshold = 0.6
-                matches = []
-                for name in all_actions:
-                    if difflib.SequenceMatcher(None, action, name).ratio() > name_match_threshold:
-                        matches.append(name)
-                if matches:
-                    err('Did you mean:', '\n  '.join(matches))
-
-# class EmveeAction:
-#   """Base class for emvee actions."""
-#   clearGlobalStateOnCompletion = True
-
-# class ExitToNormalMode(EmveeAction):
-#   def __init__(self, amount):
-#     self.amount = amount or 1
-
-#   def run(self, subl, edit):
-#     selection = []
-#     for region in subl.view.sel():
-#       region.a = region.b
-#       selection.append(region)
-#     subl.view.sel().clear()
-#     subl.view.sel().add_all(selection)
-#     set_mode(subl.view, NORMAL_MODE)
-
-# @emvee_action("enter_insert_mode")
-# class EnterInsertMode(EmveeAction):
-#   def __init__(self, amount, *, append=False, location='current'):
-#     '''location: current, line_limit'''
-#     self.amount = amount or 1
-#     self.append = bool(append)
-#     self.location = location
-
-#   def run(self, subl, edit):
-#     if self.location == 'current':
-#       if self.append:
-#         selection = []
-#         for region in subl.view.sel():
-#           isExtended = region.size() > 0
-#           if not (subl.view.classify(region.b) & sublime.CLASS_LINE_END):
-#             region.b += 1
-#           if not isExtended:
-#             region.a = region.b
-#           selection.append(region)
-#         subl.view.sel().clear();
-#         subl.view.sel().add_all(selection);
-#       else:
-#         pass # Stay where we are and enter insert mode.
-#     elif self.location == 'line_limit':
-#       if self.append:
-#         subl.view.run_command('move_to', { 'to': 'hardeol', 'extend': False })
-#       else:
-#         subl.view.run_command('move_to', { 'to': 'hardbol', 'extend': False })
-
-#     set_mode(subl.view, INSERT_MODE)
-
-# @emvee_action("exit_insert_mode")
-# class ExitInsertMode(ExitToNormalMode): pass
-
-# @emvee_action("enter_select_mode")
-# class EnterSelectMode(EmveeAction):
-#   def __init__(self, amount, *, append=False):
-#     self.amount = amount or 1
-#     self.append = bool(append)
-
-#   def run(self, subl, edit):
-#     set_mode(subl.view, SELECT_MODE)
-
-# @emvee_action("exit_select_mode")
-# class ExitSelectMode(ExitToNormalMode): pass
-
-# @emvee_action("push_digit")
-# class PushDigit(EmveeAction):
-#   def __init__(self, _, *, digit):
-#     self.digit = int(digit)
-#     self.clearGlobalStateOnCompletion = False
-
-#   def run(self, subl, edit):
-#     debug_log("push digit!", self.digit)
-#     oldAmount = current_state.amount or 0
-#     newAmount = oldAmount * 10 + self.digit
-#     if newAmount > 9999:
-#         newAmount = 9999 # TODO This is an arbitrary limit. What value should it have?
-#     current_state.amount = newAmount
-#     show_display_info(subl.view, str(newAmount), force=True, context='Prefix:')
-
-
-# @emvee_action("flatten_selections")
-# class FlattenSelections(EmveeAction):
-#   def __init__(self, amount):
-#     pass
-
-#   def run(self, subl, edit):
-#     selection = []
-#     for reg in subl.view.sel():
-#       if reg.a < reg.b and get_mode(subl.view) == NORMAL_MODE:
-#         reg.b -= 1
-#       reg.a = reg.b
-#       selection.append(reg)
-
-#     subl.view.sel().clear()
-#     subl.view.sel().add_all(selection)
-
-# @emvee_action('flip_cursors_within_selections')
-# class FlipCursorsWithinSelections(EmveeAction):
-#   def __init__(self, amount):
-#     self.amount = amount or 1
-
-#   def run(self, subl, edit):
-#     selection = []
-#     for reg in subl.view.sel():
-#       reg.a, reg.b = reg.b, reg.a
-#       selection.append(reg)
-
-#     subl.view.sel().clear()
-#     subl.view.sel().add_all(selection)
-
-# @emvee_action('move_by_char')
-# class MoveByChar(EmveeAction):
-#   def __init__(self, amount, *, forward=False, extend=False, stay_in_line=False):
-#     self.amount = amount or 1
-#     self.forward = bool(forward)
-#     self.extend = bool(extend)
-#     self.stay_in_line = bool(stay_in_line)
-
-#   def run(self, subl, edit):
-#     advance = self.amount if self.forward else -self.amount
-#     selection = []
-#     for region in subl.view.sel():
-#       line = subl.view.lines(region)[-1]
-#       region.b += advance
-#       if self.stay_in_line:
-#         if region.b < line.a:
-#           region.b = line.a
-#         if region.b > line.b:
-#           region.b = line.b
-#       if not self.extend:
-#         region.a = region.b
-#       selection.append(region)
-#     subl.view.sel().clear();
-#     subl.view.sel().add_all(selection);
-
-
-# @emvee_action('move_by_line')
-# class MoveByLine(EmveeAction):
-#   def __init__(self, amount, *, forward=False, extend=False):
-#     self.amount = amount or 1
-#     self.forward = bool(forward)
-#     self.extend = bool(extend)
-
-#   def run(self, subl, edit):
-#     args = {
-#       'forward': self.forward,
-#       'extend': self.extend,
-#       'by': 'lines'
-#     }
-#     for _ in range(self.amount):
-#       subl.view.run_command('move', args)
-
-
-# @emvee_action('move_by_word_begin')
-# class MoveByWordBegin(EmveeAction):
-#   def __init__(self, amount, *, forward=False, extend=False):
-#     self.amount = amount or 1
-#     self.forward = bool(forward)
-#     self.extend = bool(extend)
-
-#   def run(self, subl, edit):
-#     args = {
-#       'forward': self.forward,
-#       'extend': self.extend,
-#       'by': 'words'
-#     }
-
-#     for _ in range(self.amount):
-#       subl.view.run_command('move', args)
-
-
-# @emvee_action('move_by_word_end')
-# class MoveByWordEnd(EmveeAction):
-#   def __init__(self, amount, *, forward=False, extend=False):
-#     self.amount = amount or 1
-#     self.forward = bool(forward)
-#     self.extend = bool(extend)
-
-#   def run(self, subl, edit):
-#     args = {
-#       'forward': self.forward,
-#       'extend': self.extend,
-#       'by': 'word_ends'
-#     }
-
-#     for _ in range(self.amount):
-#       subl.view.run_command('move', args)
-
-
-# @emvee_action('move_by_subword_begin')
-# class MoveBySubwordBegin(EmveeAction):
-#   def __init__(self, amount, *, forward=False, extend=False):
-#     self.amount = amount or 1
-#     self.forward = bool(forward)
-#     self.extend = bool(extend)
-
-#   def run(self, subl, edit):
-#     args = {
-#       'forward': self.forward,
-#       'extend': self.extend,
-#       'by': 'subwords'
-#     }
-
-#     for _ in range(self.amount):
-#       subl.view.run_command('move', args)
-
-
-# @emvee_action('move_by_subword_end')
-# class MoveBySubwordEnd(EmveeAction):
-#   def __init__(self, amount, *, forward=False, extend=False):
-#     self.amount = amount or 1
-#     self.forward = bool(forward)
-#     self.extend = bool(extend)
-
-#   def run(self, subl, edit):
-#     args = {
-#       'forward': self.forward,
-#       'extend': self.extend,
-#       'by': 'subword_ends'
-#     }
-
-#     for _ in range(self.amount):
-#       subl.view.run_command('move', args)
-
-
-# @emvee_action('move_to_line_limit')
-# class MoveToLineLimit(EmveeAction):
-#   def __init__(self, amount, *, forward=False, extend=False):
-#     self.amount = amount or 1
-#     self.forward = bool(forward)
-#     self.extend = bool(extend)
-
-#   def run(self, subl, edit):
-#     args = {
-#       'extend': self.extend,
-#       'to': 'eol' if self.forward else 'bol'
-#     }
-#     for _ in range(self.amount):
-#       subl.view.run_command('move_to', args)
-
-
-# @emvee_action('move_by_empty_line')
-# class MoveByEmptyLine(EmveeAction):
-#   def __init__(self, amount, *, forward=True, extend=False, ignore_whitespace=True):
-#     self.amount = amount or 1
-#     self.forward = bool(forward)
-#     self.extend = bool(extend)
-#     self.ignore_whitespace = bool(ignore_whitespace)
-
-#   def run(self, subl, edit):
-#     selection = []
-#     if self.ignore_whitespace:
-#       # search for empty or "white" lines.
-#       increment = self.amount if self.forward else -self.amount
-#       for region in subl.view.sel():
-#         row, col = subl.view.rowcol(region.b)
-#         col = 0
-#         search_point = subl.view.text_point(row, col)
-#         found_non_empty_line = False
-#         while True:
-#           line_region = subl.view.line(search_point)
-#           line = subl.view.substr(line_region)
-#           line_is_empty = len(line.strip()) == 0
-#           if line_is_empty:
-#             if found_non_empty_line:
-#               break
-#           else:
-#             found_non_empty_line = True
-#           old_search_point = search_point
-#           search_point = next_line_point(subl.view, search_point, increment=increment)
-#           if search_point == old_search_point:
-#             break
-
-#         region.b = search_point
-#         if not self.extend:
-#           region.a = region.b
-
-#         selection.append(region)
-#     else:
-#       # Use built-in find_by_class
-#       for region in subl.view.sel():
-#         region.b = subl.view.find_by_class(region.b, self.forward, sublime.CLASS_EMPTY_LINE)
-#         if not self.extend:
-#           region.a = region.b
-#         selection.append(region)
-
-#     subl.view.sel().clear()
-#     subl.view.sel().add_all(selection)
-#     subl.view.show(subl.view.sel(), True)
-
-
-# @emvee_action("scroll")
-# class Scroll(EmveeAction):
-#   def __init__(self, amount, *, lines=0, delta_screens_x=0, delta_screens_y=0, center_cursor=False):
-#     self.amount = amount or 1
-#     self.lines = lines
-#     self.screens_x = delta_screens_x
-#     self.screens_y = delta_screens_y
-#     self.center_cursor = center_cursor
-
-#   def run(self, subl, edit):
-#     lines = self.lines
-#     screens_y = self.screens_y
-#     screens_x = self.screens_x
-
-#     if screens_y:
-#       extent = subl.view.viewport_extent()
-#       lines_per_screen = extent[1] / subl.view.line_height()
-#       lines += screens_y * lines_per_screen
-
-#     if lines:
-#       subl.view.run_command('scroll_lines', { 'amount': lines })
-
-#     if screens_x:
-#       position = subl.view.viewport_position()
-#       extent = subl.view.viewport_extent()
-#       maxExtent = subl.view.layout_extent()
-#       max_x = maxExtent[0] - extent[0]
-#       if max_x > 0:
-#         offset_x = screens_x * extent[0]
-#         new_x = position[0] + offset_x
-#         new_x = max(0, min(new_x, max_x))
-#         new_position = (new_x, position[1])
-#         subl.view.set_viewport_position(new_position)
-
-#     if self.center_cursor:
-#       selection = subl.view.sel()
-#       if len(selection) > 1:
-#         subl.view.show(subl.view.sel(), True)
-#       else:
-#         extent = subl.view.show_at_center(selection[0])
-
-# @emvee_action('select_line')
-# class ExpandSelectionToLine(EmveeAction):
-#   def __init__(self, amount, *, extend=False, complete_partial_lines=False, full_line=True):
-#     self.extend = bool(extend)
-#     self.complete_partial_lines = bool(complete_partial_lines)
-#     self.fullLine = bool(full_line)
-
-#   def run(self, subl, edit):
-#     getter = subl.view.full_line if self.fullLine else subl.view.line
-#     selection = []
-
-#     if self.complete_partial_lines:
-#       for reg in subl.view.sel():
-#         is_cursor_in_front = reg.a <= reg.b
-#         line_a = getter(reg.a)
-#         line_b = getter(reg.b)
-#         reg.a = min(line_a.a, line_b.a)
-#         reg.b = max(line_a.b, line_b.b)
-#         if not is_cursor_in_front:
-#           reg.a, reg.b = reg.b, reg.a
-#         selection.append(reg)
-#     else:
-#       for reg in subl.view.sel():
-#         line = getter(reg.b)
-#         reg.b = line.b
-#         if not self.extend:
-#           reg.a = line.a
-#         selection.append(reg)
-
-#     subl.view.sel().clear()
-#     subl.view.sel().add_all(selection)
-
-#     if len(selection) == 1:
-#       subl.view.show(selection[0], False)
-
-# class SplitSelectionByPatternInputHandler(sublime_plugin.TextInputHandler):
-#   def __init__(self, view):
-#     self.view = view
-#     self.original_selection = list(view.sel())
-#     self.show_hint = False
-
-#   def do_split(self, pattern):
-#     if not pattern:
-#       return []
-
-#     # For each empty selection, we consider the entire line of that cursor.
-#     working_selection = []
-#     for region in self.original_selection:
-#       if region.begin() == region.end():
-#         line = self.view.line(region)
-#         working_selection.append(line)
-#       else:
-#         working_selection.append(region)
-
-#     all_matches = self.view.find_all(pattern)
-#     matches = []
-#     for selection in working_selection:
-#       selection_matches = []
-#       for match in all_matches:
-#         if selection.contains(match):
-#           selection_matches.append(match)
-#       if len(selection_matches):
-#         matches.append((selection, selection_matches))
-#     return matches;
-
-#   def placeholder(self):
-#     return "Regular Expression"
-
-#   def preview(self, pattern):
-#     view = self.view
-
-#     split = self.do_split(pattern)
-
-#     if not len(split):
-#       return sublime.Html("<i>no matches</i>")
-
-#     num_selections = len(split)
-#     num_matches_total = sum(map(lambda x: len(x[1]), split))
-
-#     if num_selections == 1:
-#       return "{} matches".format(num_matches_total)
-#     else:
-#       return "{} matches in {} selections".format(num_matches_total, num_selections)
-
-#   def validate(self, pattern):
-#     return len(self.do_split(pattern)) > 0
-
-#   def cancel(self):
-#     self.view.sel().clear()
-#     self.view.sel().add_all(self.original_selection)
-
-#   def confirm(self, pattern):
-#     view = self.view
-
-#     split = self.do_split(pattern)
-#     results = []
-#     for match in split:
-#       results.extend(match[1])
-#     view.sel().clear()
-#     view.sel().add_all(results)
-
-# class SplitSelectionByPatternCommand(sublime_plugin.TextCommand):
-#   def run(self, edit, split_selection_by_pattern):
-#     pass
-
-#   def input(self, args):
-#     return SplitSelectionByPatternInputHandler(self.view)
-
-# @emvee_action('split_selection')
-# class SplitSelection(EmveeAction):
-#   def __init__(self, amount, *, forward):
-#     self.amount = amount # May be `None`
-#     self.forward = forward
-
-#   def run(self, subl, edit):
-#     subl.view.run_command('split_selection_by_pattern')
-
-# @emvee_action("delete")
-# class Delete(EmveeAction):
-#   def run(self, subl, edit, *, delta, by):
-#     supportedArgsForBy = ('char', 'word', 'line_from_cursor', 'line', 'full_line')
-#     if by not in supportedArgsForBy:
-#       raise ValueError('Don\'t know "{}". Supported arguments for "by": {}'.format(by, supportedArgsForBy))
-
-#     delta = int(delta)
-#     if delta == 0:
-#       return
-
-#     forward = delta > 0
-#     amount = abs(delta)
-
-#     #
-#     # By char
-#     #
-#     if by == 'char':
-#       sublCommand = 'right_delete' if forward else 'left_delete'
-
-#       subl.view.run_command('add_to_kill_ring', { 'forward': forward })
-#       for _ in range(amount):
-#         subl.view.run_command(sublCommand)
-
-#     #
-#     # By word
-#     #
-#     elif by == 'word':
-#       for _ in range(amount):
-#         subl.view.run_command('delete_word', { 'forward': forward })
-
-#     #
-#     # By line relative to the cursor
-#     #
-#     elif by in ('line_from_cursor', 'full_line_from_cursor'):
-#       sublCommand = 'right_delete' if forward else 'left_delete'
-#       selection = list(subl.view.sel())
-#       subl.view.sel().clear()
-#       func = getattr(subl.view, 'line' if by == 'line_from_cursor' else 'full_line')
-#       for index in range(len(selection)):
-#         region = selection[index]
-#         row, _ = subl.view.rowcol(region.end())
-#         line = func(subl.view.text_point(row + amount - 1, 0))
-#         if forward:
-#           region = sublime.Region(region.begin(), line.end())
-#         else:
-#           region = sublime.Region(line.begin(), region.end())
-#         selection[index] = region
-#       subl.view.sel().add_all(selection)
-#       subl.view.run_command('add_to_kill_ring', { 'forward': forward })
-#       subl.view.run_command(sublCommand)
-
-#     #
-#     # By line
-#     #
-#     elif by in ('line', 'full_line'):
-#       if forward:
-#         for _ in range(amount):
-#           selection = list(subl.view.sel())
-#           subl.view.sel().clear()
-#           func = getattr(subl.view, by)
-#           for index in range(len(selection)):
-#             selection[index] = func(selection[index])
-#           subl.view.sel().add_all(selection)
-#           subl.view.run_command('add_to_kill_ring', { 'forward': forward })
-#         subl.view.run_command('right_delete')
-#       else:
-#         err('line operations only support positive deltas.')
-
-#     if get_mode(subl.view) == 'select':
-#       set_mode(subl.view, NORMAL_MODE)
-
-
-# @emvee_action("swap_lines")
-# class SwapLines(EmveeAction):
-#   def __init__(self, amount, *, forward=True):
-#     self.amount = amount or 1
-#     self.forward = bool(forward)
-
-#   def run(self, subl, edit):
-#     cmdStr = 'swap_line_down' if self.forward else 'swap_line_up'
-#     for _ in range(self.amount):
-#       subl.view.run_command(cmdStr)
-
-
-# @emvee_action("swap_cursor_with_anchor")
-# class SwapCursorWithAnchor(EmveeAction):
-#   def run(self, subl, edit, *, side):
-#     supportedSides = ('toggle', 'begin', 'end', )
-#     if side not in supportedSides:
-#       raise ValueError('Don\'t know "{}". Supported arguments for "side": {}'.format(side, supportedSides))
-
-#     selection = list(subl.view.sel())
-#     subl.view.sel().clear()
-
-#     if side == 'toggle':
-#       selection = [sublime.Region(reg.b, reg.a) for reg in selection]
-#     elif side == 'begin':
-#       selection = [sublime.Region(reg.end(), reg.begin()) for reg in selection]
-#     elif side == 'end':
-#       selection = [sublime.Region(reg.begin(), reg.end()) for reg in selection]
-
-#     subl.view.sel().add_all(selection)
-
-# @emvee_action("integer_add")
-# class IntegerAdd(EmveeAction):
-#   def __init__(self, amount, delta):
-#     self.amount = amount or 1
-#     self.delta = delta
-
-#   def run(self, subl, edit):
-#     for reg in subl.view.sel():
-#       if reg.a == reg.b:
-#         reg = subl.view.word(reg)
-#         try:
-#           potentialReg = sublime.Region(reg.begin() - 1, reg.end())
-#           word = subl.view.substr(potentialReg)
-#           if word.startswith('-'):
-#             reg = potentialReg
-#         except:
-#           pass
-
-#       word = subl.view.substr(reg)
-#       try:
-#         value = int(word)
-#       except:
-#         continue
-#       value += self.delta
-#       newWord = str(value)
-#       subl.view.replace(edit, reg, newWord)
-
-# @emvee_action("insert_line")
-# class InsertLine(EmveeAction):
-#   def __init__(self, amount, above):
-#     self.amount = amount or 1
-#     self.above = bool(above)
-
-#   def run(self, subl, edit):
-#     if self.above:
-#       subl.view.run_command('move_to', { 'to': 'hardbol' })
-#     else:
-#       subl.view.run_command('move_to', { 'to': 'hardeol' })
-
-#     for _ in range(self.amount):
-#       subl.view.run_command('insert', { 'characters': '\n' })
-
-#     if self.above:
-#       subl.view.run_command('move', { 'by': 'lines', 'forward': False })
-#       subl.view.run_command('reindent', { 'force_indent': False })
-
-#     if get_mode(subl.view) != INSERT_MODE:
-#       subl.view.run_command('emvee', { 'action': 'enter_insert_mode' })
+                target = find_bracket_jump(view, region.b)
+            if target is None:
+                continue
+            region.b = target
+            if not extend:
+                region.a = region.b
+        return selection
+
+    def run(self, view, edit):
+        super().run(view, edit)
+        view.show(view.sel(), True)
+
+@emvee_action('select_text_object')
+class SelectTextObject(SelectionAction):
+    is_motion = True
+
+    def __init__(self, amount, *, object=None, inner=True, delimiter=None):
+        super().__init__(amount)
+        if object not in text_object_scanners:
+            raise ValueError('Don\'t know "{}". Supported arguments for "object": {}'.format(object, tuple(text_object_scanners)))
+        if object == 'brackets' and (not delimiter or len(delimiter) != 2):
+            raise ValueError('"brackets" need a pair of characters as "delimiter", e.g. "()"')
+        if object == 'quotes' and (not delimiter or len(delimiter) != 1):
+            raise ValueError('"quotes" need a single quote character as "delimiter"')
+        self.object = object
+        self.inner = bool(inner)
+        self.delimiter = delimiter
+
+    def args(self):
+        return self.object, self.inner, self.delimiter
+
+    def transform(self, view, selection):
+        found = find_text_objects(view, [region.b for region in selection], *self.args())
+        for index, region in enumerate(found):
+            if region:
+                selection[index] = sublime.Region(region.begin(), region.end())
+        if get_mode(view) != SELECT_MODE:
+            set_mode(view, SELECT_MODE)
+        return selection
+
+    def motion_ranges(self, view, edit, selection):
+        found = find_text_objects(view, [region.b for region in selection], *self.args())
+        return [found_region or sublime.Region(region.b) for region, found_region in zip(selection, found)]
+
+#
+# Search
+#
+
+# Number of SearchIndex instances kept around.
+SEARCH_INDEX_LIMIT = 16
+
+@functools.lru_cache(maxsize=64)
+def compile_search_pattern(pattern):
+    return re.compile(pattern, re.MULTILINE)
+
+class SearchIndex:
+    '''Sorted offsets of all matches of one pattern in a buffer.
+
+    The view is scanned lazily in chunks that end on a line boundary, only as
+    far as a lookup needs. Matches spanning a chunk boundary are not found.
+    Empty matches are ignored.'''
+    indexes = collections.OrderedDict()
+
+    def __init__(self, view, regex):
+        self.change_count = view.change_count()
+        self.regex = regex
+        self.starts = []
+        self.ends = []
+        # Everything before this point has been scanned.
+        self.scanned = 0
+
+    @classmethod
+    def get(cls, view, pattern):
+        '''Return the up to date index of `pattern` in `view`. Raises re.error
+        for invalid patterns.'''
+        buffer_id = BufferViews.attach(view)
+        Caches.touch(buffer_id)
+        key = (buffer_id, pattern)
+        index = cls.indexes.get(key)
+        if index is None or index.change_count != view.change_count():
+            Caches.count('search', False)
+            index = SearchIndex(view, compile_search_pattern(pattern))
+            cls.indexes[key] = index
+            while len(cls.indexes) > SEARCH_INDEX_LIMIT:
+                cls.indexes.popitem(last=False)
+            Caches.trim()
+        else:
+            Caches.count('search', True)
+            cls.indexes.move_to_end(key)
+        return index
+
+    @classmethod
+    def discard(cls, buffer_id):
+        for key in [key for key in cls.indexes if key[0] == buffer_id]:
+            del cls.indexes[key]
+
+    evict = discard
+
+    @classmethod
+    def cache_entries(cls):
+        for (buffer_id, pattern), index in cls.indexes.items():
+            yield buffer_id, list_size(index.starts) + list_size(index.ends)
+
+    def is_complete(self, view):
+        return self.scanned >= view.size()
+
+    def scan_chunk(self, view):
+        size = view.size()
+        begin = self.scanned
+        end = min(begin + SCAN_CHUNK_SIZE, size)
+        if end < size:
+            end = view.full_line(end).b
+        text = view.substr(sublime.Region(begin, end))
+        for match in self.regex.finditer(text):
+            if match.end() > match.start():
+                self.starts.append(begin + match.start())
+                self.ends.append(begin + match.end())
+        self.scanned = end
+
+    def scan_to(self, view, point):
+        while self.scanned < point and not self.is_complete(view):
+            self.scan_chunk(view)
+
+    def find(self, view, point, forward, count):
+        '''The index of the `count`th match after (or before) `point`, wrapping
+        around the end of the buffer. None if there are no matches.'''
+        if forward:
+            self.scan_to(view, point + 1)
+            i = bisect.bisect_right(self.starts, point)
+            while len(self.starts) - i < count and not self.is_complete(view):
+                self.scan_chunk(view)
+            if len(self.starts) - i >= count:
+                return i + count - 1
+        else:
+            self.scan_to(view, point)
+            i = bisect.bisect_left(self.starts, point)
+            if i >= count:
+                return i - count
+        self.scan_to(view, view.size())
+        if not self.starts:
+            return None
+        if forward:
+            return (i + count - 1) % len(self.starts)
+        return (i - count) % len(self.starts)
+
+    def all_regions(self, view):
+        self.scan_to(view, view.size())
+        return [sublime.Region(begin, end) for begin, end in zip(self.starts, self.ends)]
+
+Caches.register('search', SearchIndex)
+
+class LastSearch:
+    pattern = None
+    forward = True
+
+def get_search_index(view, pattern):
+    try:
+        return SearchIndex.get(view, pattern)
+    except re.error as e:
+        err('Invalid search pattern', repr(pattern), e)
+        sublime.status_message('Invalid search pattern: {}'.format(e))
+        return None
+
+@emvee_action('search')
+class Search(EmveeAction):
+    '''Ask for a pattern and jump to its `count`th match.'''
+    recordable = False
+
+    def __init__(self, amount, *, forward=True):
+        super().__init__(amount)
+        self.forward = bool(forward)
+
+    def run(self, view, edit):
+        window = view.window()
+        if not window:
+            return
+
+        def on_done(pattern):
+            if not pattern:
+                return
+            LastSearch.pattern = pattern
+            LastSearch.forward = self.forward
+            get_state(view).amount = self.count
+            view.run_command('emvee', { 'action': 'search_next', 'forward': True })
+
+        window.show_input_panel('Search:' if self.forward else 'Search backward:',
+                                LastSearch.pattern or '', on_done, None, None)
+
+@emvee_action('search_next')
+class SearchNext(SelectionAction):
+    '''Jump to the `count`th next match of the last search. `forward` is
+    relative to the direction of that search.'''
+    is_motion = True
+
+    def __init__(self, amount, *, forward=True):
+        super().__init__(amount)
+        self.forward = bool(forward)
+
+    def transform(self, view, selection):
+        if not LastSearch.pattern:
+            return selection
+        index = get_search_index(view, LastSearch.pattern)
+        if not index:
+            return selection
+        forward = self.forward == LastSearch.forward
+        extend = get_mode(view) == SELECT_MODE
+        for region in selection:
+            match = index.find(view, region.b, forward, self.amount)
+            if match is None:
+                sublime.status_message('Pattern not found: {}'.format(LastSearch.pattern))
+                break
+            region.b = index.starts[match]
+            if not extend:
+                region.a = region.b
+        return selection
+
+    def run(self, view, edit):
+        super().run(view, edit)
+        view.show(view.sel(), True)
+
+@emvee_action('search_select_all')
+class SearchSelectAll(SelectionAction):
+    '''Put a selection on every match. The pattern is the selected text, or
+    the last search for an empty selection, or the word under the caret.'''
+    def transform(self, view, selection):
+        if not selection:
+            return selection
+        first = selection[0]
+        if not first.empty():
+            pattern = re.escape(view.substr(first))
+        elif LastSearch.pattern:
+            pattern = LastSearch.pattern
+        else:
+            word = view.substr(view.word(first.b)).strip()
+            if not word:
+                return selection
+            pattern = r'\b' + re.escape(word) + r'\b'
+        index = get_search_index(view, pattern)
+        if not index:
+            return selection
+        matches = index.all_regions(view)
+        if not matches:
+            return selection
+        if get_mode(view) != SELECT_MODE:
+            set_mode(view, SELECT_MODE)
+        return matches
+
+    def run(self, view, edit):
+        super().run(view, edit)
+        view.show(view.sel(), True)
+
+#
+# Relative line numbers
+#
+
+# How long the caret or viewport has to rest before the numbers are redrawn.
+RELATIVE_NUMBERS_DELAY_MS = 30
+
+class RelativeNumbers:
+    '''Line numbers relative to the first caret, drawn as inline phantoms for
+    the visible lines only. Enabled by the `emvee_relative_line_numbers`
+    setting.
+
+    Each frame maps line starts to their phantom. While scrolling, the lines
+    that stay visible keep their label and their phantom, so only the lines
+    scrolled into view get new ones. Moving the caret changes the distance
+    of every line, which rebuilds all the labels.'''
+    phantom_sets = {}
+    frames = {}
+
+    @classmethod
+    def schedule(cls, view):
+        enabled = view.settings().get('emvee_relative_line_numbers', False) and not is_large_file(view)
+        if not enabled and view.id() not in cls.frames:
+            return
+        Delay.reset(('relative_numbers', view.id()), RELATIVE_NUMBERS_DELAY_MS, lambda: cls.update(view))
+
+    @classmethod
+    def discard(cls, view):
+        Delay.cancel(('relative_numbers', view.id()))
+        cls.phantom_sets.pop(view.id(), None)
+        cls.frames.pop(view.id(), None)
+
+    @classmethod
+    def clear(cls, view):
+        phantom_set = cls.phantom_sets.get(view.id())
+        if phantom_set:
+            phantom_set.update([])
+        cls.discard(view)
+
+    @classmethod
+    def update(cls, view):
+        if not view.is_valid():
+            return cls.discard(view)
+        enabled = view.settings().get('emvee_relative_line_numbers', False) and not is_large_file(view)
+        if not enabled or len(view.sel()) == 0:
+            return cls.clear(view)
+
+        caret_row = view.rowcol(view.sel()[0].b)[0]
+        visible = view.visible_region()
+        row = view.rowcol(visible.begin())[0]
+        width = len(str(view.rowcol(visible.end())[0] + 1))
+        previous = cls.frames.get(view.id(), {})
+        frame = {}
+        point = view.line(visible.begin()).a
+        while True:
+            distance = abs(row - caret_row)
+            label = str(distance or row + 1).rjust(width)
+            phantom = previous.get(point)
+            if not phantom or phantom.content != cls.html(label):
+                phantom = sublime.Phantom(sublime.Region(point), cls.html(label), sublime.LAYOUT_INLINE)
+            frame[point] = phantom
+            line = view.full_line(point)
+            if line.b >= visible.end() or line.b == point or line.b >= view.size():
+                break
+            point = line.b
+            row += 1
+
+        if frame.keys() == previous.keys() and all(frame[key] is previous[key] for key in frame):
+            return
+        cls.frames[view.id()] = frame
+        phantom_set = cls.phantom_sets.get(view.id())
+        if not phantom_set:
+            phantom_set = cls.phantom_sets[view.id()] = sublime.PhantomSet(view, 'emvee_relative_numbers')
+        phantom_set.update(list(frame.values()))
+
+    @staticmethod
+    @functools.lru_cache(maxsize=256)
+    def html(label):
+        return '<body style="margin: 0; padding: 0 0.5rem 0 0; color: color(var(--foreground) alpha(0.4));">{}</body>'.format(label.replace(' ', '&nbsp;'))
+
+#
+# Operators and registers
+#
+
+class Registers:
+    UNNAMED = '"'
+    contents = {}
+
+    @classmethod
+    def store(cls, name, texts, linewise):
+        '''Store one text per caret. The unnamed register always gets a copy.'''
+        cls.contents[cls.UNNAMED] = (texts, linewise)
+        if name:
+            cls.contents[name] = (texts, linewise)
+
+    @classmethod
+    def get(cls, name):
+        '''The texts in register `name` and whether they are whole lines.'''
+        return cls.contents.get(name or cls.UNNAMED, ([], False))
+
+    @classmethod
+    def cache_entries(cls):
+        # Registers hold what the user yanked, they are never evicted.
+        for texts, linewise in cls.contents.values():
+            yield None, sys.getsizeof(texts) + sum(sys.getsizeof(text) for text in texts)
+
+    @classmethod
+    def evict(cls, buffer_id):
+        pass
+
+Caches.register('registers', Registers)
+
+@emvee_action('select_register')
+class SelectRegister(EmveeAction):
+    '''Make `register` the one the next operator or paste uses.'''
+    consumes_amount = False
+    recordable = False
+
+    def __init__(self, amount, *, register):
+        super().__init__(amount)
+        self.register = str(register)
+
+    def run(self, view, edit):
+        get_state(view).register = self.register
+
+@emvee_action('operator')
+class SetOperator(EmveeAction):
+    '''Wait for a motion or text object and apply `operator` to its range.
+
+    The composition itself happens in `EmveeCommand.run`.'''
+    consumes_amount = False
+    recordable = False
+    operators = ('delete', 'change', 'yank')
+
+    def __init__(self, amount, *, operator):
+        super().__init__(amount)
+        if operator not in self.operators:
+            raise ValueError('Don\'t know "{}". Supported arguments for "operator": {}'.format(operator, self.operators))
+        self.operator = operator
+
+    def run(self, view, edit):
+        state = get_state(view)
+        state.operator = self.operator
+        state.operator_amount = state.amount
+        state.amount = None
+
+class CurrentLines(EmveeAction):
+    '''The full lines of each region and `count - 1` lines below.'''
+    is_motion = True
+    linewise = True
+
+    def motion_ranges(self, view, edit, selection):
+        result = []
+        for region in selection:
+            last_row = view.rowcol(region.end())[0] + self.amount - 1
+            last_line = view.full_line(view.text_point(last_row, 0))
+            result.append(sublime.Region(view.line(region.begin()).a, last_line.b))
+        return result
+
+class ApplyOperator(EmveeAction):
+    '''An operator applied to the ranges of a motion, as one edit.'''
+    def __init__(self, operator, register, motion):
+        super().__init__(motion.count)
+        self.operator = operator
+        self.register = register
+        self.motion = motion
+        self.is_change = operator != 'yank'
+
+    def run(self, view, edit):
+        linewise = self.motion.linewise
+        ranges = merge_regions(self.motion.motion_ranges(view, edit, list(view.sel())))
+        Registers.store(self.register, [view.substr(region) for region in ranges], linewise)
+        if linewise and self.operator == 'change':
+            # Keep the last line break so there is an empty line to type into.
+            for index, region in enumerate(ranges):
+                if view.substr(region.end() - 1) == '\n':
+                    ranges[index] = sublime.Region(region.begin(), region.end() - 1)
+
+        carets = []
+        if self.operator == 'yank':
+            carets = [region.begin() for region in ranges]
+        else:
+            for region in reversed(ranges):
+                view.erase(edit, region)
+            removed = 0
+            for region in ranges:
+                carets.append(region.begin() - removed)
+                removed += region.size()
+        set_selection(view, [sublime.Region(point) for point in carets])
+        set_mode(view, INSERT_MODE if self.operator == 'change' else NORMAL_MODE)
+
+@emvee_action('paste')
+class Paste(EmveeAction):
+    '''Insert the contents of the pending register `count` times, one text per
+    caret if the numbers match. Whole lines go below or above the caret line.'''
+    is_change = True
+
+    def __init__(self, amount, *, after=True):
+        super().__init__(amount)
+        self.after = bool(after)
+
+    def run(self, view, edit):
+        state = get_state(view)
+        texts, linewise = Registers.get(state.register)
+        state.register = None
+        if not texts:
+            return
+        selection = list(view.sel())
+        if len(texts) != len(selection):
+            texts = [('' if linewise else '\n').join(texts)] * len(selection)
+        for region, text in reversed(list(zip(selection, texts))):
+            text *= self.amount
+            if linewise:
+                if not text.endswith('\n'):
+                    text += '\n'
+                if not self.after:
+                    point = view.line(region.begin()).a
+                else:
+                    point = view.full_line(region.end()).b
+                    if view.substr(point - 1) != '\n':
+                        # The last line has no line break of its own.
+                        text = '\n' + text[:-1]
+            else:
+                point = region.begin()
+                if self.after:
+                    point = region.end()
+                    if region.empty() and not (view.classify(point) & sublime.CLASS_LINE_END):
+                        point += 1
+            view.insert(edit, point, text)
+
+#
+# Split selection
+#
+
+def split_selection(view, selection, regex, limit=None):
+    '''The non-empty matches of `regex` within each region of `selection`. An
+    empty region stands for its line.
+
+    Only the selected text is read, in chunks that end on a line boundary.
+    Matches spanning a chunk boundary are not found.'''
+    result = []
+    for region in selection:
+        if region.empty():
+            region = view.line(region)
+        begin, stop = region.begin(), region.end()
+        if limit is not None and stop - begin > limit:
+            stop = begin + limit
+            report_scan_limit(view, limit)
+        while begin < stop:
+            end = min(begin + SCAN_CHUNK_SIZE, stop)
+            if end < stop:
+                end = min(view.full_line(end).b, stop)
+            text = view.substr(sublime.Region(begin, end))
+            for match in regex.finditer(text):
+                if match.end() > match.start():
+                    result.append(sublime.Region(begin + match.start(), begin + match.end()))
+            begin = end
+    return result
+
+class SplitSelectionByPatternInputHandler(sublime_plugin.TextInputHandler):
+    def __init__(self, view):
+        self.view = view
+
+    def name(self):
+        return 'pattern'
+
+    def placeholder(self):
+        return 'Regular Expression'
+
+    def split(self, pattern):
+        if not pattern:
+            return []
+        try:
+            regex = compile_search_pattern(pattern)
+        except re.error:
+            return []
+        return split_selection(self.view, list(self.view.sel()), regex, scan_limit(self.view))
+
+    def preview(self, pattern):
+        if is_large_file(self.view):
+            return None
+        matches = self.split(pattern)
+        if not matches:
+            return sublime.Html('<i>no matches</i>')
+        return '{} matches'.format(len(matches))
+
+    def validate(self, pattern):
+        return len(self.split(pattern)) > 0
+
+class SplitSelectionByPatternCommand(sublime_plugin.TextCommand):
+    '''Select all matches of `pattern` within the current selection.'''
+    def run(self, edit, pattern):
+        view = self.view
+        try:
+            regex = compile_search_pattern(pattern)
+        except re.error as e:
+            err('Invalid pattern', pattern, e)
+            return
+        matches = split_selection(view, list(view.sel()), regex, scan_limit(view))
+        if matches:
+            set_selection(view, matches)
+
+    def input(self, args):
+        if 'pattern' not in args:
+            return SplitSelectionByPatternInputHandler(self.view)
+
+#
+# Repeat
+#
+
+class LastChange:
+    '''The last change made with an emvee action, for `repeat_change`.
+
+    `action` is the constructed action itself, so repeating it does not go
+    through lookup and argument parsing again. `name` and `kwargs` are what
+    it was made from, or what its motion was made from if it is an operator.
+    `text` is whatever was typed in INSERT mode right after the change.'''
+    action = None
+    name = None
+    kwargs = None
+    text = ''
+    typing_view_id = None
+
+    @classmethod
+    def capture(cls, view, action, name, kwargs):
+        cls.action = action
+        cls.name = name
+        cls.kwargs = kwargs
+        cls.text = ''
+        cls.typing_view_id = view.id()
+
+    @classmethod
+    def with_count(cls, count):
+        '''The last change made again with `count`, like `emvee` makes it.
+        For an operator the count goes to its motion.'''
+        action = cls.action
+        if isinstance(action, ApplyOperator):
+            if isinstance(action.motion, CurrentLines):
+                motion = CurrentLines(count)
+            else:
+                motion = make_action(cls.name, count, cls.kwargs)
+            return motion and ApplyOperator(action.operator, action.register, motion)
+        return make_action(cls.name, count, cls.kwargs)
+
+    @classmethod
+    def stop_typing(cls):
+        cls.typing_view_id = None
+
+    @classmethod
+    def on_text_command(cls, view, command_name, args):
+        if cls.typing_view_id != view.id():
+            return
+        if command_name == 'insert':
+            cls.text += (args or {}).get('characters', '')
+        elif command_name == 'left_delete':
+            cls.text = cls.text[:-1]
+
+@emvee_action('repeat_change')
+class RepeatChange(EmveeAction):
+    '''Repeat the last change at every caret. A count replaces the count of
+    the original change.'''
+    def run(self, view, edit):
+        action = LastChange.action
+        if action is None:
+            return
+        if self.count is not None and self.count != action.count:
+            action = LastChange.with_count(self.count)
+            if action is None:
+                return
+            # Later repeats keep the new count.
+            LastChange.action = action
+        action.run(view, edit)
+
+        text = LastChange.text
+        if text:
+            for region in reversed(list(view.sel())):
+                view.insert(edit, region.b, text)
+        if get_mode(view) == INSERT_MODE:
+            EnterNormalMode(1).run(view, edit)
+
+#
+# Session recording
+#
+
+# Size at which the session log is rotated, and how many logs are kept.
+SESSION_LOG_SIZE = 8 * 1024 * 1024
+SESSION_LOG_FILES = 3
+# How long recorded entries are kept in memory before they are written.
+SESSION_FLUSH_MS = 1000
+# Default of the `emvee_replay_threshold` setting. Replayed actions slower
+# than this factor times their baseline are reported as regressions.
+REPLAY_THRESHOLD = 1.5
+# Actions that wait for user input and cannot be replayed.
+UNREPLAYABLE_ACTIONS = ('search',)
+
+def session_path(name):
+    return os.path.join(sublime.cache_path(), 'Emvee', name)
+
+def session_log_path(index=0):
+    return session_path('session.jsonl' if index == 0 else 'session.{}.jsonl'.format(index))
+
+class SessionRecorder:
+    '''Logs every emvee action while the `emvee_record_session` setting is
+    on, one JSON array per line:
+
+        [timestamp, context queries, action, kwargs, caret count, buffer size, duration]
+
+    where the context queries are the (key, operator, operand) triples asked
+    since the previous action. Recording only appends to a list, the log is
+    written and rotated on the async thread.'''
+    enabled = False
+    queries = []
+    entries = []
+    flush_scheduled = False
+
+    @classmethod
+    def update_enabled(cls):
+        cls.enabled = bool(sublime.load_settings('Preferences.sublime-settings').get('emvee_record_session', False))
+
+    @classmethod
+    def record(cls, view, action, kwargs, duration):
+        cls.entries.append((time.time(), cls.queries, action, kwargs, len(view.sel()), view.size(), duration))
+        cls.queries = []
+        if not cls.flush_scheduled:
+            cls.flush_scheduled = True
+            sublime.set_timeout_async(cls.flush, SESSION_FLUSH_MS)
+
+    @classmethod
+    def flush(cls):
+        entries, cls.entries = cls.entries, []
+        cls.flush_scheduled = False
+        path = session_log_path()
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if os.path.exists(path) and os.path.getsize(path) > SESSION_LOG_SIZE:
+                for index in range(SESSION_LOG_FILES - 1, 0, -1):
+                    if os.path.exists(session_log_path(index - 1)):
+                        os.replace(session_log_path(index - 1), session_log_path(index))
+            with open(path, 'a', encoding='utf-8') as log:
+                for entry in entries:
+                    log.write(json.dumps(entry, separators=(',', ':')) + '\n')
+        except OSError as e:
+            err('Cannot write session log', path, e)
+
+class EmveeReplaySessionCommand(sublime_plugin.WindowCommand):
+    '''Replay a session log in a new scratch tab and compare the median time
+    of each action, including its context queries, with the baseline. Every
+    action runs with as many carets as it was recorded with, spread evenly
+    over the text.
+
+    The baseline is written if there is none yet or `update_baseline` is set.'''
+    def run(self, path=None, update_baseline=False):
+        path = path or session_log_path()
+        try:
+            with open(path, encoding='utf-8') as log:
+                entries = [json.loads(line) for line in log if line.strip()]
+        except (OSError, ValueError) as e:
+            err('Cannot read session log', path, e)
+            return
+        if not entries:
+            return
+
+        was_recording = SessionRecorder.enabled
+        SessionRecorder.enabled = False
+        try:
+            timings = self.replay(entries)
+        finally:
+            SessionRecorder.enabled = was_recording
+        self.report(timings, update_baseline)
+
+    def replay(self, entries):
+        view = self.window.new_file()
+        view.set_scratch(True)
+        line = 'The quick brown fox (jumps) over "the" lazy dog.\n'
+        size = max(entry[5] for entry in entries)
+        view.run_command('append', { 'characters': (line * (size // len(line) + 1))[:size] })
+        set_mode(view, NORMAL_MODE)
+
+        listener = EmveeEventListener()
+        timings = collections.defaultdict(list)
+        for timestamp, queries, action, kwargs, carets, size, duration in entries:
+            if action in UNREPLAYABLE_ACTIONS:
+                continue
+            if len(view.sel()) != carets:
+                self.spread_carets(view, carets)
+            start = time.perf_counter()
+            for key, operator, operand in queries:
+                if key != 'emvee_display_current_mode':
+                    listener.on_query_context(view, key, operator, operand, True)
+            view.run_command('emvee', dict(kwargs, action=action))
+            timings[action].append(time.perf_counter() - start)
+        view.close()
+        return timings
+
+    @staticmethod
+    def spread_carets(view, carets):
+        size = view.size()
+        carets = max(min(carets, size + 1), 1)
+        view.sel().clear()
+        view.sel().add_all([sublime.Region(i * size // carets) for i in range(carets)])
+
+    def report(self, timings, update_baseline):
+        baseline_path = session_path('baseline.json')
+        try:
+            with open(baseline_path, encoding='utf-8') as baseline_file:
+                baseline = json.load(baseline_file)
+        except (OSError, ValueError):
+            baseline = None
+        threshold = sublime.load_settings('Preferences.sublime-settings').get('emvee_replay_threshold', REPLAY_THRESHOLD)
+
+        medians = {}
+        regressions = 0
+        for action, times in sorted(timings.items()):
+            median = sorted(times)[len(times) // 2]
+            medians[action] = median
+            expected = baseline.get(action) if baseline else None
+            verdict = ''
+            if expected:
+                verdict = '{:.2f}x'.format(median / expected)
+                if median > expected * threshold:
+                    verdict += ' REGRESSION'
+                    regressions += 1
+            print('emvee: replay {:<24} {:>6} runs {:>10.1f} us  {}'.format(action, len(times), median * 1e6, verdict))
+
+        if baseline is None or update_baseline:
+            os.makedirs(os.path.dirname(baseline_path), exist_ok=True)
+            with open(baseline_path, 'w', encoding='utf-8') as baseline_file:
+                json.dump(medians, baseline_file, indent=2, sort_keys=True)
+            sublime.status_message('Emvee: replay baseline written')
+        else:
+            sublime.status_message('Emvee: replay found {} regressions, see console'.format(regressions))
+
+#
+# Profiling
+#
+
+# Number of `emvee` commands profiled by default.
+PROFILE_COUNT = 50
+# Number of functions listed in the profile report.
+PROFILE_REPORT_LIMIT = 20
+
+class Profiler:
+    '''Profiles the next `count` runs of the `emvee` command and the context
+    queries in between with cProfile.
+
+    Arming swaps EmveeCommand.run and EmveeEventListener.on_query_context for
+    profiling wrappers and disarming puts the originals back, so there is no
+    cost at all while no profile is being taken.'''
+    profile = None
+    window = None
+    remaining = 0
+    originals = None
+    # Whether a profiled call is running, nested calls are part of it.
+    running = False
+
+    @classmethod
+    def arm(cls, window, count):
+        cls.window = window
+        cls.remaining = count
+        if cls.profile is not None:
+            return
+        cls.profile = cProfile.Profile()
+        cls.originals = (EmveeCommand.run, EmveeEventListener.on_query_context)
+        EmveeCommand.run = cls.wrap(EmveeCommand.run, counts=True)
+        EmveeEventListener.on_query_context = cls.wrap(EmveeEventListener.on_query_context, counts=False)
+        sublime.status_message('Emvee: profiling the next {} commands'.format(count))
+
+    @classmethod
+    def disarm(cls):
+        if cls.profile is None:
+            return
+        EmveeCommand.run, EmveeEventListener.on_query_context = cls.originals
+        profile = cls.profile
+        cls.profile = cls.originals = None
+        sublime.set_timeout(lambda: cls.report(profile), 0)
+
+    @classmethod
+    def wrap(cls, method, counts):
+        @functools.wraps(method)
+        def profiled(*args, **kwargs):
+            if cls.running or cls.profile is None:
+                return method(*args, **kwargs)
+            cls.running = True
+            try:
+                return cls.profile.runcall(method, *args, **kwargs)
+            finally:
+                cls.running = False
+                if counts:
+                    cls.remaining -= 1
+                    if cls.remaining <= 0:
+                        cls.disarm()
+        return profiled
+
+    @classmethod
+    def report(cls, profile):
+        path = session_path('profile-{}.pstats'.format(datetime.datetime.now().strftime('%Y%m%d-%H%M%S')))
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            profile.dump_stats(path)
+        except OSError as e:
+            err('Cannot write profile', path, e)
+            path = None
+
+        stream = io.StringIO()
+        if path:
+            stream.write('Profile written to {}\n'.format(path))
+        if tracemalloc and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            stream.write('Traced memory {:.1f} KB, peak {:.1f} KB\n'.format(current / 1024, peak / 1024))
+        try:
+            pstats.Stats(profile, stream=stream).sort_stats('cumulative').print_stats(PROFILE_REPORT_LIMIT)
+        except TypeError:
+            # Nothing was profiled.
+            stream.write('No calls were profiled.\n')
+
+        window = cls.window if cls.window and cls.window.is_valid() else sublime.active_window()
+        if window is None:
+            print(stream.getvalue())
+            return
+        panel = window.create_output_panel('emvee_profile')
+        panel.run_command('append', { 'characters': stream.getvalue() })
+        window.run_command('show_panel', { 'panel': 'output.emvee_profile' })
+
+class EmveeProfileCommand(sublime_plugin.WindowCommand):
+    '''Profile the next `count` emvee commands, or stop profiling early.'''
+    def run(self, count=PROFILE_COUNT):
+        if Profiler.profile is not None:
+            Profiler.disarm()
+        else:
+            Profiler.arm(self.window, max(int(count), 1))
+
+#
+# Persisted state
+#
+
+# How long after a view was left its state is written.
+PERSIST_DELAY_MS = 2000
+# Files up to this size are identified by a hash of their whole content,
+# larger ones by their size and a hash of their first and last chunk.
+PERSIST_FULL_HASH_LIMIT = 4 * 1024 * 1024
+
+def persist_path(name):
+    return os.path.join(sublime.cache_path(), 'Emvee', 'state', name)
+
+def content_hash(view):
+    size = view.size()
+    digest = hashlib.sha1(str(size).encode('ascii'))
+    if size <= PERSIST_FULL_HASH_LIMIT:
+        parts = [sublime.Region(0, size)]
+    else:
+        parts = [sublime.Region(0, SCAN_CHUNK_SIZE), sublime.Region(size - SCAN_CHUNK_SIZE, size)]
+    for region in parts:
+        digest.update(view.substr(region).encode('utf-8', 'surrogatepass'))
+    return digest.hexdigest()
+
+def read_store(path):
+    try:
+        with open(path, 'rb') as store:
+            return json.loads(zlib.decompress(store.read()).decode('utf-8'))
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, zlib.error) as e:
+        err('Cannot read state', path, e)
+        return None
+
+def write_store(path, data):
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'wb') as store:
+            store.write(zlib.compress(json.dumps(data, separators=(',', ':')).encode('utf-8')))
+        os.replace(path + '.tmp', path)
+    except OSError as e:
+        err('Cannot write state', path, e)
+
+class PersistedState:
+    '''Keeps the mode of each file and the registers and last search across
+    sessions, unless the `emvee_persist_state` setting is off.
+
+    Every file has its own zlib-compressed JSON store, named after a hash of
+    its path and holding a hash of its content. A store is only read once its
+    view is activated or loaded, whichever comes last, on the async thread,
+    and only applied if the content still matches. Writes are debounced and happen on
+    the async thread as well.'''
+    GLOBAL_STORE = 'global.bin'
+    restored = set()
+    applied = set()
+    global_loaded = False
+    pending = {}
+
+    @staticmethod
+    def is_enabled():
+        return sublime.load_settings('Preferences.sublime-settings').get('emvee_persist_state', True)
+
+    @staticmethod
+    def store_name(path):
+        return hashlib.sha1(path.encode('utf-8')).hexdigest() + '.bin'
+
+    @classmethod
+    def restore(cls, view):
+        if view.id() in cls.restored or not cls.is_enabled():
+            return
+        # The content hash would not match yet, `on_load` restores it later.
+        if view.is_loading():
+            return
+        cls.restored.add(view.id())
+        path = view.file_name()
+        load_global = not cls.global_loaded
+        cls.global_loaded = True
+
+        def load():
+            if load_global:
+                global_data = read_store(persist_path(cls.GLOBAL_STORE))
+                if global_data:
+                    sublime.set_timeout(lambda: cls.apply_global(global_data), 0)
+            if not path:
+                return
+            data = read_store(persist_path(cls.store_name(path)))
+            if data and data.get('path') == path and view.is_valid() and data.get('hash') == content_hash(view):
+                sublime.set_timeout(lambda: cls.apply(view, data), 0)
+        sublime.set_timeout_async(load, 0)
+
+    @classmethod
+    def apply(cls, view, data):
+        if view.is_valid() and ViewFlags.is_active(view) and data.get('mode') in all_modes:
+            cls.applied.add(view.id())
+            set_mode(view, data['mode'])
+
+    @classmethod
+    def apply_global(cls, data):
+        # Anything set in this session already wins over the stored state.
+        for name, (texts, linewise) in data.get('registers', {}).items():
+            Registers.contents.setdefault(name, (texts, linewise))
+        search = data.get('search')
+        if search and LastSearch.pattern is None:
+            LastSearch.pattern, LastSearch.forward = search
+
+    @classmethod
+    def save(cls, view, closing=False):
+        '''Write the state of `view` after a pause. The content hash is taken
+        right away if the view is about to close.'''
+        # A view that was never activated still has its default state.
+        if view.id() not in cls.restored:
+            return
+        path = view.file_name()
+        if path:
+            data = { 'path': path, 'mode': get_mode(view) }
+            if closing:
+                data['hash'] = content_hash(view)
+            cls.pending[cls.store_name(path)] = (view, data)
+        cls.pending[cls.GLOBAL_STORE] = (None, {
+            'registers': dict(Registers.contents),
+            'search': [LastSearch.pattern, LastSearch.forward] if LastSearch.pattern else None,
+        })
+        Delay.reset('persist', PERSIST_DELAY_MS, cls.flush)
+
+    @classmethod
+    def flush(cls):
+        pending, cls.pending = cls.pending, {}
+
+        def write():
+            for name, (view, data) in pending.items():
+                if view is not None and 'hash' not in data:
+                    if not view.is_valid():
+                        continue
+                    data['hash'] = content_hash(view)
+                write_store(persist_path(name), data)
+        sublime.set_timeout_async(write, 0)
+
+#
+# Macros
+#
+
+def compile_macro(actions):
+    '''Turn a list of recorded actions into a plan for `run_plan`.
+
+    Each step of the plan is a pair of (is_selection_step, action).'''
+    return tuple((isinstance(action, SelectionAction), action) for action in actions)
+
+def run_plan(view, edit, plan, repeat=1):
+    '''Run all steps of `plan`, `repeat` times, within the given edit.
+
+    Consecutive selection steps operate on a selection kept in Python. It is
+    only written back to the view before a step that needs it, and once at the
+    very end.'''
+    selection = None
+    for _ in range(repeat):
+        for is_selection_step, action in plan:
+            if is_selection_step:
+                if selection is None:
+                    selection = list(view.sel())
+                selection = action.transform(view, selection)
+            else:
+                if selection is not None:
+                    set_selection(view, selection)
+                    selection = None
+                action.run(view, edit)
+    if selection is not None:
+        set_selection(view, selection)
+
+class MacroRecorder:
+    register = None
+    actions = None
+    macros = {}
+
+    @classmethod
+    def is_recording(cls):
+        return cls.actions is not None
+
+    @classmethod
+    def start(cls, register):
+        cls.register = register
+        cls.actions = []
+        debug_log('macro[{}] recording'.format(register))
+
+    @classmethod
+    def stop(cls):
+        if cls.actions is None:
+            return
+        debug_log('macro[{}] recorded {} actions'.format(cls.register, len(cls.actions)))
+        cls.macros[cls.register] = compile_macro(cls.actions)
+        cls.register = None
+        cls.actions = None
+
+    @classmethod
+    def record(cls, action):
+        if cls.actions is not None:
+            cls.actions.append(action)
+
+@emvee_action('record_macro')
+class RecordMacro(EmveeAction):
+    '''Start recording emvee actions into `register`, or stop recording.'''
+    recordable = False
+
+    def __init__(self, amount, *, register='q'):
+        super().__init__(amount)
+        self.register = str(register)
+
+    def run(self, view, edit):
+        if MacroRecorder.is_recording():
+            MacroRecorder.stop()
+        else:
+            MacroRecorder.start(self.register)
+
+@emvee_action('replay_macro')
+class ReplayMacro(EmveeAction):
+    '''Replay the macro in `register` as many times as the count says.
+
+    The whole replay happens within this command's edit, so it is undone in
+    one step.'''
+    recordable = False
+
+    def __init__(self, amount, *, register='q'):
+        super().__init__(amount)
+        self.register = str(register)
+
+    def run(self, view, edit):
+        plan = MacroRecorder.macros.get(self.register)
+        if plan is None:
+            err('No macro recorded in register', self.register)
+            return
+        run_plan(view, edit, plan, repeat=self.amount)
+        view.show(view.sel(), True)
+
+#
+# Batch execution
+#
+
+# Threads that plan edits from buffer snapshots.
+BATCH_WORKERS = 4
+# Views snapshotted or changed per slice of main thread time. Sublime Text
+# stays responsive between slices, which is also when a batch can be cancelled.
+BATCH_SLICE = 16
+
+class Batch:
+    '''An `emvee_batch` run over the views of a window or group.
+
+    For plannable actions a snapshot of the text and selection of each view is
+    taken on the main thread and planned by a thread pool. Each plan is then
+    applied in one edit, or if the view changed since its snapshot, the
+    action runs on the view directly. Other actions always run directly.'''
+    current = None
+    executor = None
+
+    def __init__(self, window, views, action, args):
+        self.window = window
+        self.views = views
+        self.action = action
+        self.args = args
+        self.pending = collections.deque(views)
+        # (view, change count, future) in the order of `views`.
+        self.planned = collections.deque()
+        self.done = 0
+        self.failed = 0
+        self.cancelled = False
+
+    def start(self):
+        if Batch.current:
+            Batch.current.cancelled = True
+        Batch.current = self
+        if self.action.plannable and Batch.executor is None:
+            Batch.executor = concurrent.futures.ThreadPoolExecutor(BATCH_WORKERS)
+        sublime.set_timeout(self.step, 0)
+
+    def step(self):
+        if self.cancelled:
+            self.finish('cancelled')
+            return
+        for _ in range(BATCH_SLICE):
+            if not self.planned or not self.planned[0][2].done():
+                break
+            self.apply(*self.planned.popleft())
+        for _ in range(BATCH_SLICE):
+            if not self.pending:
+                break
+            view = self.pending.popleft()
+            if not view.is_valid():
+                self.failed += 1
+            elif self.action.plannable:
+                text = view.substr(sublime.Region(0, view.size()))
+                selection = [(region.a, region.b) for region in view.sel()]
+                separators = view.settings().get('word_separators', '')
+                future = Batch.executor.submit(self.action.plan, text, selection, separators)
+                self.planned.append((view, view.change_count(), future))
+            else:
+                self.run_directly(view)
+        if not self.pending and not self.planned:
+            self.finish('done')
+            return
+        self.window.status_message('Emvee: {} {}/{} views'.format(self.action.name, self.done, len(self.views)))
+        # Poll less often once only plans are outstanding.
+        sublime.set_timeout(self.step, 0 if self.pending else 10)
+
+    def apply(self, view, change_count, future):
+        try:
+            edits = future.result()
+        except Exception as e:
+            err('Cannot plan', self.action.name, 'for', view.file_name() or view.id(), e)
+            self.failed += 1
+            return
+        if not view.is_valid():
+            self.failed += 1
+        elif view.change_count() != change_count:
+            self.run_directly(view)
+        else:
+            if edits:
+                view.run_command('emvee_batch_apply', { 'edits': edits })
+            self.done += 1
+
+    def run_directly(self, view):
+        view.run_command('emvee_batch_apply', { 'action': self.action.name, 'amount': self.action.count, 'args': self.args })
+        self.done += 1
+
+    def finish(self, outcome):
+        for _, _, future in self.planned:
+            future.cancel()
+        self.planned.clear()
+        if Batch.current is self:
+            Batch.current = None
+        message = 'Emvee: {} {} on {}/{} views'.format(self.action.name, outcome, self.done, len(self.views))
+        if self.failed:
+            message += ', {} failed'.format(self.failed)
+        self.window.status_message(message)
+
+    @classmethod
+    def shutdown(cls):
+        if cls.current:
+            cls.current.cancelled = True
+        if cls.executor:
+            cls.executor.shutdown(wait=False)
+            cls.executor = None
+
+class EmveeBatchCommand(sublime_plugin.WindowCommand):
+    '''Run the emvee `action` with `args` on every view of the window, or of
+    the active group if `group` is set. Each view gets its own undo step.'''
+    def run(self, action, args=None, amount=None, group=False):
+        args = args or {}
+        emvee_action = make_action(action, amount, args)
+        if not emvee_action:
+            return
+        window = self.window
+        views = window.views_in_group(window.active_group()) if group else window.views()
+        views = [view for view in views if ViewFlags.is_active(view) and not view.is_loading()]
+        Batch(window, views, emvee_action, args).start()
+
+class EmveeCancelBatchCommand(sublime_plugin.ApplicationCommand):
+    def run(self):
+        if Batch.current:
+            Batch.current.cancelled = True
+
+    def is_enabled(self):
+        return Batch.current is not None
+
+class EmveeBatchApplyCommand(sublime_plugin.TextCommand):
+    '''Apply the planned `edits` of a batch, or run `action` on this view
+    without the pending count, operator and macro recording of the `emvee`
+    command.'''
+    def run(self, edit, edits=None, action=None, amount=None, args=None):
+        view = self.view
+        if edits is not None:
+            for begin, end, text in reversed(edits):
+                view.replace(edit, sublime.Region(begin, end), text)
+            return
+        emvee_action = make_action(action, amount, args or {})
+        if emvee_action:
+            emvee_action.run(view, edit)
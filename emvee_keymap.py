@@ -1,6 +1,6 @@
 import json
 
-def get_keymap(): return [
+def get_keymap(): return ([
   define(['f1'], [ ], None, context=[
       { 'key': 'emvee_display_current_mode' },
       { 'key': 'emvee_early_out' },
@@ -48,6 +48,10 @@ def get_keymap(): return [
   define(['z', 'h'], ['NORMAL', 'SELECT'], 'scroll', { 'delta_screens_x': -0.5, 'delta_screens_y': -0.0 }),
   define(['z', 'l'], ['NORMAL', 'SELECT'], 'scroll', { 'delta_screens_x': +0.5, 'delta_screens_y': -0.0 }),
   define(['z', 'z'], ['NORMAL', 'SELECT'], 'scroll', { 'center_cursor': True }),
+  define(['ctrl+d'], ['NORMAL', 'SELECT'], 'move_by_page', { 'forward': True, 'pages': 0.5 }),
+  define(['ctrl+u'], ['NORMAL', 'SELECT'], 'move_by_page', { 'forward': False, 'pages': 0.5 }),
+  define(['ctrl+f'], ['NORMAL', 'SELECT'], 'move_by_page', { 'forward': True, 'pages': 1.0 }),
+  define(['ctrl+b'], ['NORMAL', 'SELECT'], 'move_by_page', { 'forward': False, 'pages': 1.0 }),
 
   comment('',
           'Enter INSERT mode',
@@ -81,6 +85,11 @@ def get_keymap(): return [
   define(['g', 'l'], ['NORMAL'], 'move_to_line_limit', { 'forward': True }),
   define(['g', 'h'], ['SELECT'], 'move_to_line_limit', { 'forward': False, 'extend': True }),
   define(['g', 'l'], ['SELECT'], 'move_to_line_limit', { 'forward': True, 'extend': True }),
+  comment('Move by display lines: wrapped lines count once per row. g+j and g+k travel between panes.'),
+  define(['g', 'down'], ['NORMAL', 'SELECT'], 'move_by_display_line', { 'forward': True }),
+  define(['g', 'up'], ['NORMAL', 'SELECT'], 'move_by_display_line', { 'forward': False }),
+  define(['g', '0'], ['NORMAL', 'SELECT'], 'move_to_display_line_limit', { 'forward': False }),
+  define(['g', '$'], ['NORMAL', 'SELECT'], 'move_to_display_line_limit', { 'forward': True }),
   define(['alt+h'], ['NORMAL'], 'move_to_line_limit', { 'forward': False }),
   define(['alt+l'], ['NORMAL'], 'move_to_line_limit', { 'forward': True }),
   define(['alt+shift+h'], ['NORMAL'], 'move_to_line_limit', { 'forward': False, 'extend': True }),
@@ -98,12 +107,13 @@ def get_keymap(): return [
   define(['{'], ['NORMAL', 'SELECT'], 'move_by_empty_line', { 'forward': False, 'select': True }),
   define(['}'], ['NORMAL', 'SELECT'], 'move_by_empty_line', { 'forward': True, 'select': True }),
 
-  define(['alt+k'], ['NORMAL', 'SELECT'], 'swap_line_up', builtin=True),
-  define(['alt+j'], ['NORMAL', 'SELECT'], 'swap_line_down', builtin=True),
+  define(['alt+k'], ['NORMAL', 'SELECT'], 'swap_lines', { 'forward': False }),
+  define(['alt+j'], ['NORMAL', 'SELECT'], 'swap_lines', { 'forward': True }),
 
   define([' '], ['NORMAL', 'SELECT'], 'flip_cursors_within_selections'),
 
-  define(['d'], ['NORMAL', 'SELECT'], 'right_delete', builtin=True),
+  define(['x'], ['NORMAL', 'SELECT'], 'delete', { 'by': 'char', 'delta': 1 }),
+  define(['d'], ['SELECT'], 'right_delete', builtin=True),
   define(['D'], ['NORMAL', 'SELECT'], 'delete_to_eol'),
   define(['ctrl+D'], ['NORMAL', 'SELECT'], 'delete_line'),
 
@@ -120,16 +130,38 @@ def get_keymap(): return [
   define(['alt+shift+f'], ['NORMAL', 'SELECT'], 'find_char', { 'forward': True, 'extend': True }),
 
   comment('Move cursor between matching parens, brackets, and braces.'),
-  define(['m'], ['NORMAL', 'SELECT'], 'move_to', { 'to': 'brackets', 'extend': False }, builtin=True),
-  define(['M'], ['NORMAL', 'SELECT'], 'move_to', { 'to': 'brackets', 'extend': True }, builtin=True),
+  define(['m'], ['NORMAL', 'SELECT'], 'move_to_bracket', { 'extend': False }),
+  define(['M'], ['NORMAL', 'SELECT'], 'move_to_bracket', { 'extend': True }),
+
+  comment('Operators: followed by a motion or text object, or doubled for whole lines.'),
+  define(['d'], ['NORMAL'], 'operator', { 'operator': 'delete' }),
+  define(['c'], ['NORMAL'], 'operator', { 'operator': 'change' }),
+  define(['y'], ['NORMAL'], 'operator', { 'operator': 'yank' }),
+  define(['p'], ['NORMAL', 'SELECT'], 'paste', { 'after': True }),
+  define(['P'], ['NORMAL', 'SELECT'], 'paste', { 'after': False }),
+  ] + [define(['"', register], ['NORMAL', 'SELECT'], 'select_register', { 'register': register }) for register in registers] + [
+
+  comment('Text objects: alt+i selects the inner object, alt+a the object and its surroundings.',
+          'alt+d followed by i or a deletes it.'),
+  ] + text_object_bindings(['alt+i'], ['NORMAL', 'SELECT'], 'select_text_object', { 'inner': True })
+    + text_object_bindings(['alt+a'], ['NORMAL', 'SELECT'], 'select_text_object', { 'inner': False })
+    + text_object_bindings(['alt+d', 'i'], ['NORMAL'], 'delete', { 'by': 'text_object', 'inner': True })
+    + text_object_bindings(['alt+d', 'a'], ['NORMAL'], 'delete', { 'by': 'text_object', 'inner': False }) + [
 
   comment('Join lines'),
-  define(['J'], ['NORMAL', 'SELECT'], 'join_lines', { }, builtin=True),
+  define(['J'], ['NORMAL', 'SELECT'], 'join_lines'),
 
   comment('Integer manipulation'),
   define(['='], ['NORMAL', 'SELECT'], 'integer_add', { 'delta': 1 }),
   define(['alt+='], ['NORMAL', 'SELECT'], 'integer_add', { 'delta': -1 }),
 
+  comment('Repeat the last change'),
+  define(['.'], ['NORMAL', 'SELECT'], 'repeat_change'),
+
+  comment('Macros'),
+  define(['q'], ['NORMAL', 'SELECT'], 'record_macro', { 'register': 'q' }),
+  define(['@'], ['NORMAL', 'SELECT'], 'replay_macro', { 'register': 'q' }),
+
   comment('Undo, redo'),
   define(['u'],     ['NORMAL', 'SELECT'], 'undo', builtin=True),
   define(['r'],     ['NORMAL', 'SELECT'], 'redo', builtin=True),
@@ -137,11 +169,11 @@ def get_keymap(): return [
   define(['alt+r'], ['NORMAL', 'SELECT'], 'soft_redo', builtin=True),
 
   comment('Find/Search'),
-  define(['/'], ['NORMAL', 'SELECT'], 'show_panel', { 'panel': 'incremental_find', 'reverse': False }, builtin=True),
-  define(['?'], ['NORMAL', 'SELECT'], 'show_panel', { 'panel': 'incremental_find', 'reverse': True }, builtin=True),
-  define(['n'], ['NORMAL', 'SELECT'], 'find_next', builtin=True),
-  define(['N'], ['NORMAL', 'SELECT'], 'find_prev', builtin=True),
-  define(['alt+n'], ['NORMAL', 'SELECT'], 'find_all_under', builtin=True),
+  define(['/'], ['NORMAL', 'SELECT'], 'search', { 'forward': True }),
+  define(['?'], ['NORMAL', 'SELECT'], 'search', { 'forward': False }),
+  define(['n'], ['NORMAL', 'SELECT'], 'search_next', { 'forward': True }),
+  define(['N'], ['NORMAL', 'SELECT'], 'search_next', { 'forward': False }),
+  define(['alt+n'], ['NORMAL', 'SELECT'], 'search_select_all'),
 
   comment('',
           'Origami',
@@ -159,8 +191,31 @@ def get_keymap(): return [
   define(['g', 'K'], ['NORMAL', 'SELECT'], 'clone_file_to_pane', { 'direction': 'up'    }, builtin=True),
   define(['g', 'L'], ['NORMAL', 'SELECT'], 'clone_file_to_pane', { 'direction': 'right' }, builtin=True),
   define(['g', 'g'], ['NORMAL', 'SELECT'], 'toggle_zoom_pane', { 'fraction': 0.9 }, builtin=True),
+])
+
+registers = 'abcdefghijklmnopqrstuvwxyz"'
+
+text_objects = [
+  ('w',  { 'object': 'word' }),
+  ('p',  { 'object': 'paragraph' }),
+  ('(',  { 'object': 'brackets', 'delimiter': '()' }),
+  (')',  { 'object': 'brackets', 'delimiter': '()' }),
+  ('b',  { 'object': 'brackets', 'delimiter': '()' }),
+  ('[',  { 'object': 'brackets', 'delimiter': '[]' }),
+  (']',  { 'object': 'brackets', 'delimiter': '[]' }),
+  ('{',  { 'object': 'brackets', 'delimiter': '{}' }),
+  ('}',  { 'object': 'brackets', 'delimiter': '{}' }),
+  ('B',  { 'object': 'brackets', 'delimiter': '{}' }),
+  ('<',  { 'object': 'brackets', 'delimiter': '<>' }),
+  ('>',  { 'object': 'brackets', 'delimiter': '<>' }),
+  ('"',  { 'object': 'quotes', 'delimiter': '"' }),
+  ("'",  { 'object': 'quotes', 'delimiter': "'" }),
+  ('`',  { 'object': 'quotes', 'delimiter': '`' }),
 ]
 
+def text_object_bindings(prefix, modes, action, args):
+  return [define(prefix + [key], modes, action, dict(args, **object_args)) for key, object_args in text_objects]
+
 def define(keys, modes, action, args=None, *, builtin=False, next_mode=None, context=[]):
   def result_maker(newline):
     nonlocal keys, modes, action, args, builtin, next_mode, context
@@ -0,0 +1,38 @@
+import sublime
+import unittest
+
+from Emvee import emvee
+
+class EmveeTestCase(unittest.TestCase):
+    '''A scratch view in NORMAL mode for running emvee actions against.
+
+    These tests need Sublime Text and are run with the UnitTesting package.'''
+    def setUp(self):
+        self.view = sublime.active_window().new_file()
+        self.view.set_scratch(True)
+
+    def tearDown(self):
+        if self.view.is_valid():
+            self.view.close()
+
+    def set_text(self, text, carets=(0,)):
+        if self.view.size():
+            self.set_carets((sublime.Region(0, self.view.size()),))
+            self.view.run_command('right_delete')
+        self.view.run_command('append', { 'characters': text })
+        self.set_carets(carets)
+        emvee.set_mode(self.view, emvee.NORMAL_MODE)
+
+    def set_carets(self, carets):
+        selection = self.view.sel()
+        selection.clear()
+        selection.add_all([caret if isinstance(caret, sublime.Region) else sublime.Region(caret) for caret in carets])
+
+    def run_action(self, action, **kwargs):
+        self.view.run_command('emvee', dict(kwargs, action=action))
+
+    def text(self):
+        return self.view.substr(sublime.Region(0, self.view.size()))
+
+    def carets(self):
+        return [region.b for region in self.view.sel()]
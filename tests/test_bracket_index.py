@@ -0,0 +1,47 @@
+import collections
+import time
+
+import sublime
+
+from Emvee import emvee
+from .emvee_test_case import EmveeTestCase
+
+Position = collections.namedtuple('Position', 'pt')
+Change = collections.namedtuple('Change', 'a b str')
+
+LINE = 'def f(a[0], b{1}) -> (c[2], {d})\n'
+
+class TestBracketIndex(EmveeTestCase):
+    def build(self):
+        return emvee.finish(emvee.build_bracket_index(self.view))
+
+    def insert(self, index, point, text):
+        self.set_carets((point,))
+        self.view.run_command('insert', { 'characters': text })
+        return index.repair(self.view, [Change(Position(point), Position(point), text)])
+
+    def test_repair_matches_rebuild(self):
+        self.set_text('a(b[c]d)e\n{f}\n', carets=(2,))
+        index = self.build()
+        self.assertTrue(self.insert(index, 2, '(x)'))
+        self.assertTrue(self.insert(index, 12, ' '))
+        rebuilt = self.build()
+        for point in range(self.view.size() + 1):
+            self.assertEqual(index.jump_target(point), rebuilt.jump_target(point))
+            self.assertEqual(index.enclosing(point), rebuilt.enclosing(point))
+
+    def test_benchmark_50k_lines(self):
+        self.set_text(LINE * 50000, carets=(100,))
+        start = time.perf_counter()
+        index = self.build()
+        build_time = time.perf_counter() - start
+
+        times = []
+        for i in range(100):
+            start = time.perf_counter()
+            self.assertTrue(self.insert(index, 100 + i, 'x'))
+            times.append(time.perf_counter() - start)
+        repair_time = sorted(times)[len(times) // 2]
+        print('emvee: bracket index over 50k lines: build {:.1f} ms, repair {:.3f} ms'.format(build_time * 1000, repair_time * 1000))
+        # Typing must not cost a noticeable fraction of a rebuild.
+        self.assertLess(repair_time, build_time / 100)
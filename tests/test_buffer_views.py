@@ -0,0 +1,44 @@
+from Emvee import emvee
+from .emvee_test_case import EmveeTestCase
+
+class TestBufferViews(EmveeTestCase):
+    def clone(self, count):
+        window = self.view.window()
+        clones = []
+        for _ in range(count):
+            window.focus_view(self.view)
+            window.run_command('clone_file')
+            clones.append(window.active_view())
+        return clones
+
+    def close(self, view):
+        view.close()
+        # Closing sends on_close too, detaching twice is harmless.
+        emvee.EmveeEventListener().on_close(view)
+
+    def entries(self, buffer_id):
+        return [key for key in emvee.Indexer.indexes if key[0] == buffer_id]
+
+    def test_clones_share_one_index(self):
+        self.set_text('a\nb\n\nc\n')
+        buffer_id = self.view.buffer_id()
+        clones = self.clone(4)
+        self.assertEqual(len(set(clone.id() for clone in clones + [self.view])), 5)
+
+        index = emvee.finish(emvee.build_line_index(self.view))
+        emvee.Indexer.indexes[(emvee.BufferViews.attach(self.view), 'lines')] = index
+        for clone in clones:
+            self.assertEqual(clone.buffer_id(), buffer_id)
+            self.assertIs(emvee.Indexer.get(clone, 'lines'), index)
+        self.assertEqual(self.entries(buffer_id), [(buffer_id, 'lines')])
+        self.assertEqual(emvee.BufferViews.counts[buffer_id], 5)
+
+        for clone in clones:
+            self.close(clone)
+        self.assertEqual(self.entries(buffer_id), [(buffer_id, 'lines')])
+        self.assertEqual(emvee.BufferViews.counts[buffer_id], 1)
+
+        # The last view of the buffer frees the index.
+        self.close(self.view)
+        self.assertEqual(self.entries(buffer_id), [])
+        self.assertNotIn(buffer_id, emvee.BufferViews.counts)
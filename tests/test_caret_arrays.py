@@ -0,0 +1,68 @@
+import time
+import unittest
+from unittest import mock
+
+import sublime
+
+from Emvee import emvee
+from .emvee_test_case import EmveeTestCase
+
+CASES = [
+    ('move_by_char', { 'forward': True }, emvee.NORMAL_MODE),
+    ('move_by_char', { 'forward': False, 'stay_in_line': True }, emvee.SELECT_MODE),
+    ('move_by_char', { 'forward': True, 'stay_in_line': True }, emvee.NORMAL_MODE),
+    ('enter_normal_mode', {}, emvee.SELECT_MODE),
+    ('enter_insert_mode', { 'append': True }, emvee.NORMAL_MODE),
+    ('enter_insert_mode', { 'location': 'line_limit' }, emvee.NORMAL_MODE),
+    ('enter_insert_mode', { 'location': 'line_limit', 'append': True }, emvee.NORMAL_MODE),
+    ('select', { 'mode': 'line' }, emvee.SELECT_MODE),
+]
+
+class TestCaretArrays(EmveeTestCase):
+    def set_lines(self, count):
+        '''One region per line, of varying length and direction, and a fresh
+        line index.'''
+        lines = ['x' * (i % 7) for i in range(count)]
+        carets = []
+        start = 0
+        for i, line in enumerate(lines):
+            a = start + (0 if i % 3 else len(line))
+            b = start + min(i % 5, len(line))
+            carets.append(sublime.Region(a, b))
+            start += len(line) + 1
+        self.set_text('\n'.join(lines) + '\n', carets)
+        index = emvee.finish(emvee.build_line_index(self.view))
+        emvee.Indexer.indexes[(emvee.BufferViews.attach(self.view), 'lines')] = index
+
+    def transform_all(self, name, value):
+        '''The result of every case with `emvee.<name>` set to `value`.'''
+        results = []
+        with mock.patch.object(emvee, name, value):
+            for action, kwargs, mode in CASES:
+                emvee.set_mode(self.view, mode)
+                selection = [sublime.Region(region.a, region.b) for region in self.view.sel()]
+                regions = emvee.make_action(action, None, kwargs).transform(self.view, selection)
+                results.append((action, kwargs, [(region.a, region.b) for region in regions]))
+        return results
+
+    def test_arrays_match_regions(self):
+        self.set_lines(1200)
+        self.assertEqual(self.transform_all('numpy', None), self.transform_all('CARET_ARRAY_THRESHOLD', float('inf')))
+
+    @unittest.skipUnless(emvee.numpy, 'NumPy is not installed')
+    def test_numpy_matches_array(self):
+        self.set_lines(1200)
+        self.assertEqual(self.transform_all('numpy', emvee.numpy), self.transform_all('numpy', None))
+
+    def test_benchmark_carets(self):
+        times = {}
+        for count in (1000, 10000, 100000):
+            self.set_lines(count)
+            start = time.perf_counter()
+            for action, kwargs, mode in CASES[:3]:
+                emvee.set_mode(self.view, mode)
+                self.run_action(action, **kwargs)
+            times[count] = time.perf_counter() - start
+            print('emvee: {} carets: {:.1f} ms, {:.2f} us per caret'.format(count, times[count] * 1000, times[count] / count * 1e6))
+        # The cost per caret must not grow with the number of carets.
+        self.assertLess(times[100000], 20 * times[10000])
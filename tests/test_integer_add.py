@@ -0,0 +1,84 @@
+import time
+from unittest import mock
+
+import sublime
+
+from Emvee import emvee
+from .emvee_test_case import EmveeTestCase
+
+class TestIntegerAdd(EmveeTestCase):
+    def assert_plan_matches_run(self, text, carets, separators):
+        self.view.settings().set('word_separators', separators)
+        self.set_text(text, carets=carets)
+        action = emvee.make_action('integer_add', None, { 'delta': 5 })
+        selection = [(region.a, region.b) for region in self.view.sel()]
+        planned = text
+        for begin, end, replacement in reversed(action.plan(text, selection, separators)):
+            planned = planned[:begin] + replacement + planned[end:]
+        self.run_action('integer_add', delta=5)
+        self.assertEqual(self.text(), planned)
+
+    def test_plan_matches_run(self):
+        self.assert_plan_matches_run('a = 12, b = -3\n', (5, 13), "./\\()\"'-:,.;<>~!@#$%^&*|+=[]{}`~?")
+
+    def test_plan_matches_run_with_other_separators(self):
+        self.assert_plan_matches_run('v12x34 7_8\n', (2, 8), 'x_')
+
+    def test_count(self):
+        self.set_text('a = 12\n', carets=(5,))
+        self.run_action('push_digit', digit=3)
+        self.run_action('integer_add', delta=1)
+        self.assertEqual(self.text(), 'a = 15\n')
+        self.run_action('repeat_change')
+        self.assertEqual(self.text(), 'a = 18\n')
+
+    def test_counted_repeat(self):
+        self.set_text('a = 12\n', carets=(5,))
+        self.run_action('integer_add', delta=-1)
+        self.run_action('push_digit', digit=4)
+        self.run_action('repeat_change')
+        self.assertEqual(self.text(), 'a = 7\n')
+        self.run_action('repeat_change')
+        self.assertEqual(self.text(), 'a = 3\n')
+
+    def test_benchmark_repeat_10k(self):
+        self.set_text('x = 0\n', carets=(4,))
+        self.run_action('integer_add', delta=1)
+        start = time.perf_counter()
+        for _ in range(10000):
+            self.run_action('repeat_change')
+        elapsed = time.perf_counter() - start
+        print('emvee: 10k repeated changes: {:.1f} ms, {:.3f} ms each'.format(elapsed * 1000, elapsed / 10))
+        self.assertEqual(self.text(), 'x = 10001\n')
+
+    def test_benchmark_batch_500_views(self):
+        text = 'a = 1, b = -2\n' * 200
+        carets = [sublime.Region(row * 14 + column) for row in range(200) for column in (4, 12)]
+        views = []
+        try:
+            for _ in range(500):
+                view = sublime.active_window().new_file()
+                view.set_scratch(True)
+                view.run_command('append', { 'characters': text })
+                view.sel().clear()
+                view.sel().add_all(carets)
+                views.append(view)
+
+            # Run the main thread loop of the batch here rather than after the test.
+            callbacks = []
+            with mock.patch.object(emvee.sublime, 'set_timeout', lambda callback, delay=0: callbacks.append(callback)):
+                start = time.perf_counter()
+                batch = emvee.Batch(sublime.active_window(), views, emvee.make_action('integer_add', None, { 'delta': 5 }), { 'delta': 5 })
+                batch.start()
+                while callbacks:
+                    callbacks.pop(0)()
+                    if callbacks and not batch.pending:
+                        time.sleep(0.001)
+                elapsed = time.perf_counter() - start
+            print('emvee: batch over 500 views: {:.1f} ms, {:.2f} ms per view'.format(elapsed * 1000, elapsed / 500 * 1000))
+            self.assertEqual(batch.done, 500)
+            for view in views:
+                self.assertEqual(view.substr(sublime.Region(0, view.size())), 'a = 6, b = 3\n' * 200)
+        finally:
+            for view in views:
+                view.close()
@@ -0,0 +1,14 @@
+from .emvee_test_case import EmveeTestCase
+
+class TestJoinLines(EmveeTestCase):
+    def test_join_one_caret(self):
+        self.set_text('a\n  b\nc\n', carets=(0,))
+        self.run_action('join_lines')
+        self.assertEqual(self.text(), 'a b\nc\n')
+        self.assertEqual(self.carets(), [1])
+
+    def test_join_several_carets(self):
+        self.set_text('a\n  b\nc\n  d\ne\n', carets=(0, 6))
+        self.run_action('join_lines')
+        self.assertEqual(self.text(), 'a b\nc d\ne\n')
+        self.assertEqual(self.carets(), [1, 5])
@@ -0,0 +1,55 @@
+import os
+import time
+
+from Emvee import emvee
+from .emvee_test_case import EmveeTestCase
+
+LINE = 'def f(a[0], b{1}) -> (c[2], {d})\n'
+
+MB = 1024 * 1024
+
+# Building a 100 MB or 1 GB buffer takes minutes and most of the memory of a
+# workstation, so only the 1 MB size runs by default.
+SIZES = [1 * MB]
+if os.environ.get('EMVEE_LARGE_BENCHMARKS'):
+    SIZES += [100 * MB, 1024 * MB]
+
+ACTIONS = [
+    ('move_by_char', {}),
+    ('move_by_word_begin', {}),
+    ('move_by_empty_line', {}),
+    ('move_to_bracket', {}),
+    ('select_text_object', { 'object': 'paragraph', 'inner': True }),
+]
+
+class TestLargeFiles(EmveeTestCase):
+    def fill(self, size):
+        self.set_text(LINE * (size // len(LINE)), carets=(size // 2,))
+
+    def test_benchmark_matrix(self):
+        times = {}
+        for size in SIZES:
+            self.fill(size)
+            large = emvee.is_large_file(self.view)
+            self.assertEqual(large, size >= emvee.LARGE_FILE_SIZE)
+            for action, kwargs in ACTIONS:
+                self.set_carets((size // 2,))
+                start = time.perf_counter()
+                self.run_action(action, **kwargs)
+                elapsed = time.perf_counter() - start
+                print('emvee: {} over {} MB: {:.1f} ms'.format(action, size // MB, elapsed * 1000))
+                if large:
+                    times.setdefault(action, []).append(elapsed)
+            if large:
+                self.assertIsNone(emvee.Indexer.peek(self.view, 'lines'))
+                self.assertIsNone(emvee.Indexer.peek(self.view, 'brackets'))
+        # The scanners stop at the scan limit, so a 1 GB file costs what a 100 MB one does.
+        for action, elapsed in times.items():
+            self.assertLess(max(elapsed), 3 * min(elapsed) + 0.01, action)
+
+    def test_no_index_is_built(self):
+        self.view.settings().set('emvee_large_file_size', MB // 2)
+        self.fill(1 * MB)
+        self.assertIsNone(emvee.Indexer.get(self.view, 'lines'))
+        emvee.Indexer.schedule(self.view, 'brackets')
+        self.assertNotIn((self.view.buffer_id(), 'brackets'), emvee.Indexer.jobs)
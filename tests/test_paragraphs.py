@@ -0,0 +1,36 @@
+import sublime
+
+from Emvee import emvee
+from .emvee_test_case import EmveeTestCase
+
+PARAGRAPH = 'word word\nmore text\n\n'
+
+class TestParagraphs(EmveeTestCase):
+    def count_reads(self, carets):
+        '''Characters read from the view to resolve a paragraph at every caret.'''
+        self.set_text(PARAGRAPH * carets)
+        emvee.Indexer.drop(self.view, 'lines')
+        read = [0]
+        substr = self.view.substr
+
+        def counting_substr(region):
+            text = substr(region)
+            read[0] += len(text)
+            return text
+        self.view.substr = counting_substr
+        points = [i * len(PARAGRAPH) for i in range(carets)]
+        regions = emvee.scan_paragraphs(self.view, points, False)
+        self.assertEqual(regions[1], sublime.Region(len(PARAGRAPH), 2 * len(PARAGRAPH)))
+        return read[0]
+
+    def test_select_paragraph(self):
+        self.set_text('a\nb\n\nc\n', carets=(2,))
+        self.run_action('select_text_object', object='paragraph', inner=True)
+        self.assertEqual(list(self.view.sel()), [sublime.Region(0, 4)])
+
+    def test_work_is_linear_in_carets(self):
+        reads = [self.count_reads(carets) for carets in (200, 400, 800)]
+        for carets, read in zip((200, 400, 800), reads):
+            # One pass: about the text between the first and the last caret.
+            self.assertLess(read, 2 * carets * len(PARAGRAPH))
+        self.assertLess(reads[2], 4.5 * reads[0])
@@ -0,0 +1,58 @@
+import time
+
+import sublime
+
+from Emvee import emvee
+from .emvee_test_case import EmveeTestCase
+
+# Time there is for a frame at 60 Hz.
+FRAME_TIME = 1 / 60
+
+class TestRelativeNumbers(EmveeTestCase):
+    def setUp(self):
+        super().setUp()
+        self.view.settings().set('emvee_relative_line_numbers', True)
+        self.set_text('line\n' * 10000, carets=(0,))
+        self.show_rows(0, 60)
+
+    def tearDown(self):
+        emvee.RelativeNumbers.discard(self.view)
+        super().tearDown()
+
+    def show_rows(self, first, last):
+        '''Pretend rows `first` to `last` are the visible ones.'''
+        region = sublime.Region(self.view.text_point(first, 0), self.view.text_point(last, 0))
+        self.view.visible_region = lambda: region
+
+    def phantoms(self):
+        return emvee.RelativeNumbers.frames[self.view.id()]
+
+    def test_scrolling_reuses_phantoms(self):
+        emvee.RelativeNumbers.update(self.view)
+        before = self.phantoms()
+        self.show_rows(10, 70)
+        emvee.RelativeNumbers.update(self.view)
+        after = self.phantoms()
+        kept = [point for point in after if point in before]
+        self.assertEqual(len(kept), 50)
+        for point in kept:
+            self.assertIs(after[point], before[point])
+
+    def test_benchmark_frame_time(self):
+        caret_times = []
+        scroll_times = []
+        for row in range(1, 101):
+            self.set_carets((self.view.text_point(row, 0),))
+            start = time.perf_counter()
+            emvee.RelativeNumbers.update(self.view)
+            caret_times.append(time.perf_counter() - start)
+
+            self.show_rows(row, row + 60)
+            start = time.perf_counter()
+            emvee.RelativeNumbers.update(self.view)
+            scroll_times.append(time.perf_counter() - start)
+        caret_time = sorted(caret_times)[len(caret_times) // 2]
+        scroll_time = sorted(scroll_times)[len(scroll_times) // 2]
+        print('emvee: relative numbers frame: caret move {:.3f} ms, scroll {:.3f} ms'.format(caret_time * 1000, scroll_time * 1000))
+        self.assertLess(caret_time, FRAME_TIME)
+        self.assertLess(scroll_time, FRAME_TIME)
@@ -0,0 +1,26 @@
+from .emvee_test_case import EmveeTestCase
+
+class TestRepeatChange(EmveeTestCase):
+    def test_count_after_delete_word(self):
+        self.set_text('one two three four five six\n')
+        self.run_action('operator', operator='delete')
+        self.run_action('move_by_word_begin', forward=True)
+        self.assertEqual(self.text(), 'two three four five six\n')
+        self.run_action('push_digit', digit=3)
+        self.run_action('repeat_change')
+        self.assertEqual(self.text(), 'five six\n')
+
+    def test_count_after_delete_char(self):
+        self.set_text('abcdefg\n')
+        self.run_action('delete', by='char', delta=1)
+        self.assertEqual(self.text(), 'bcdefg\n')
+        self.run_action('push_digit', digit=3)
+        self.run_action('repeat_change')
+        self.assertEqual(self.text(), 'efg\n')
+
+    def test_repeat_without_count(self):
+        self.set_text('abcdefg\n')
+        self.run_action('push_digit', digit=2)
+        self.run_action('delete', by='char', delta=1)
+        self.run_action('repeat_change')
+        self.assertEqual(self.text(), 'efg\n')
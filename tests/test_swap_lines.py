@@ -0,0 +1,62 @@
+import time
+
+import sublime
+
+from .emvee_test_case import EmveeTestCase
+
+class TestSwapLines(EmveeTestCase):
+    def swap(self, forward, count=None):
+        if count:
+            self.run_action('push_digit', digit=count)
+        self.run_action('swap_lines', forward=forward)
+
+    def test_first_line(self):
+        self.set_text('a\nb\nc\n', carets=(0,))
+        self.swap(False)
+        self.assertEqual(self.text(), 'a\nb\nc\n')
+        self.swap(True)
+        self.assertEqual(self.text(), 'b\na\nc\n')
+        self.assertEqual(self.carets(), [2])
+
+    def test_last_line(self):
+        self.set_text('a\nb\nc', carets=(4,))
+        self.swap(True)
+        self.assertEqual(self.text(), 'a\nb\nc')
+        self.swap(False)
+        self.assertEqual(self.text(), 'a\nc\nb')
+        self.assertEqual(self.carets(), [2])
+
+    def test_last_line_before_final_newline(self):
+        self.set_text('a\nb\nc\n', carets=(4,))
+        self.swap(True)
+        self.assertEqual(self.text(), 'a\nb\nc\n')
+        # A caret after the final newline is on no line.
+        self.set_carets((0, 6))
+        self.swap(True)
+        self.assertEqual(self.text(), 'b\na\nc\n')
+        self.assertEqual(self.carets(), [2, 6])
+
+    def test_count_stops_at_the_end(self):
+        self.set_text('a\nb\nc\n', carets=(0,))
+        self.swap(True, count=5)
+        self.assertEqual(self.text(), 'b\nc\na\n')
+
+    def test_selection_keeps_its_lines(self):
+        self.set_text('a\nb\nc\n', carets=(sublime.Region(2, 6),))
+        self.swap(False)
+        self.assertEqual(self.text(), 'b\nc\na\n')
+        self.assertEqual(list(self.view.sel()), [sublime.Region(0, 4)])
+
+    def test_benchmark_block_of_1k_lines_by_5k(self):
+        lines = ['line {}'.format(i) for i in range(10000)]
+        self.set_text('\n'.join(lines) + '\n')
+        self.set_carets((sublime.Region(self.view.text_point(1000, 0), self.view.text_point(2000, 0)),))
+        for digit in (5, 0, 0, 0):
+            self.run_action('push_digit', digit=digit)
+        start = time.perf_counter()
+        self.run_action('swap_lines', forward=True)
+        elapsed = time.perf_counter() - start
+        print('emvee: moving 1k lines by 5k lines: {:.1f} ms'.format(elapsed * 1000))
+        moved = lines[:1000] + lines[2000:7000] + lines[1000:2000] + lines[7000:]
+        self.assertEqual(self.text(), '\n'.join(moved) + '\n')
+        self.assertEqual(list(self.view.sel()), [sublime.Region(self.view.text_point(6000, 0), self.view.text_point(7000, 0))])
@@ -0,0 +1,60 @@
+from Emvee import emvee
+from .emvee_test_case import EmveeTestCase
+
+class CountingView:
+    '''Forwards to a view and counts the methods called on it.'''
+    def __init__(self, view):
+        self.view = view
+        self.calls = []
+
+    def __getattr__(self, name):
+        self.calls.append(name)
+        return getattr(self.view, name)
+
+# Every event but on_close, which cleans up after any view.
+EVENTS = [
+    ('on_new', ()),
+    ('on_load', ()),
+    ('on_activated', ()),
+    ('on_deactivated', ()),
+    ('on_pre_close', ()),
+    ('on_modified', ()),
+    ('on_selection_modified', ()),
+    ('on_text_command', ('insert', { 'characters': 'x' })),
+    ('on_post_text_command', ('insert', { 'characters': 'x' })),
+    ('on_query_context', ('emvee_current_mode', 0, 'NORMAL', True)),
+]
+
+class TestViewFlags(EmveeTestCase):
+    def assert_only_flag_lookups(self, setting, value):
+        self.view.settings().set(setting, value)
+        self.assertFalse(emvee.ViewFlags.is_active(self.view))
+        computed = [0]
+        compute = emvee.ViewFlags.compute
+
+        def counting_compute(view):
+            computed[0] += 1
+            return compute(view)
+        emvee.ViewFlags.compute = counting_compute
+        try:
+            listener = emvee.EmveeEventListener()
+            for event, args in EVENTS:
+                view = CountingView(self.view)
+                getattr(listener, event)(view, *args)
+                # The lookup in ViewFlags.active is all a handler may do.
+                self.assertEqual(view.calls, ['id'], event)
+        finally:
+            emvee.ViewFlags.compute = compute
+        self.assertEqual(computed[0], 0)
+
+    def test_disabled_view(self):
+        self.assert_only_flag_lookups('emvee_enabled', False)
+
+    def test_widget(self):
+        self.assert_only_flag_lookups('is_widget', True)
+
+    def test_enabling_updates_the_flag(self):
+        self.view.settings().set('emvee_enabled', False)
+        self.assertFalse(emvee.ViewFlags.is_active(self.view))
+        self.view.settings().set('emvee_enabled', True)
+        self.assertTrue(emvee.ViewFlags.is_active(self.view))